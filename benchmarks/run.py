@@ -0,0 +1,547 @@
+# Copyright (c) 2023, Timur Moziev
+# All rights reserved.
+
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Benchmarks of the PDF Rush core paths on synthetic PDF folders. Runs without
+# a display and writes JSON results that can be compared across versions:
+#
+#   python benchmarks/run.py --output before.json
+#   python benchmarks/run.py --output after.json
+#   python benchmarks/run.py compare before.json after.json
+
+import sys, os
+import argparse
+import hashlib
+import io
+import json
+import platform
+import queue
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz
+import numpy
+from PIL import Image
+import pdf_rush_engine as engine
+
+# Bump when generated folders change, so stale ones are generated again
+CORPUS_VERSION = 1
+# Generated folders are kept here between runs
+CORPUS_FOLDER = os.path.join(engine.user_cache_dir(), "benchmark-corpus")
+# Number of files and pages of every folder at scale 1
+CORPUS_SIZES = {
+    "small": {"files": 400, "pages": (1, 6)},
+    "scans": {"files": 3, "pages": (40, 40)},
+    "rotated": {"files": 60, "pages": (10, 10)},
+}
+# Pixel size of scanned pages
+SCAN_SIZE = (1700, 2200)
+# How many times each benchmark is repeated
+REPEATS = 7
+# Optimized saves of the scans take seconds, they are repeated fewer times
+OPTIMIZE_REPEATS = 3
+# Fast benchmarks are called in a loop for at least this many seconds per run
+MIN_RUN_TIME = 0.05
+# Edits made by the bookkeeping benchmark
+BOOKKEEPING_EDITS = 10000
+# Page size the viewer renders at
+VIEW_SIZE = (1024, 700)
+# How much zoomed views are scaled from the page fitted to the viewer
+ZOOM = 4
+# Slowdown reported as a regression by compare
+REGRESSION_THRESHOLD = 0.25
+
+SAMPLE_TEXT = (
+    "The quick brown fox jumps over the lazy dog while the committee reviews "
+    "quarterly budget reports, shipping manifests and legal correspondence."
+)
+
+
+def write_text_pdf(path, page_count, rng, rotations=None):
+    doc = fitz.open()
+    for page_index in range(page_count):
+        page = doc.new_page()
+        for line in range(rng.randint(10, 40)):
+            page.insert_text((72, 72 + line * 16), SAMPLE_TEXT[: rng.randint(20, 140)])
+        if rotations is not None:
+            page.set_rotation(rotations[page_index])
+    doc.save(path, garbage=1, deflate=True)
+    doc.close()
+
+
+def write_scan_pdf(path, page_count, rng):
+    # Pages are single JPEG images with text-like stripes and paper noise
+    numpy_rng = numpy.random.default_rng(rng.randrange(1 << 32))
+    width, height = SCAN_SIZE
+    doc = fitz.open()
+    for page_index in range(page_count):
+        pixels = numpy.full((height, width), 232, numpy.float32)
+        for top in range(200, height - 200, 40):
+            length = int(numpy_rng.integers(width // 3, width - 400))
+            pixels[top : top + 18, 200 : 200 + length] *= numpy_rng.uniform(
+                0.1, 1.0, (18, length)
+            )
+        pixels += numpy_rng.normal(0, 6, pixels.shape)
+        buffer = io.BytesIO()
+        Image.fromarray(numpy.clip(pixels, 0, 255).astype(numpy.uint8)).save(
+            buffer, "JPEG", quality=75
+        )
+        page = doc.new_page(width=width * 72 / 200, height=height * 72 / 200)
+        page.insert_image(page.rect, stream=buffer.getvalue())
+    doc.save(path)
+    doc.close()
+
+
+def generate_corpus(scale):
+    # Returns {folder name: folder path}. Folders depend only on the scale and
+    # CORPUS_VERSION, so results of different versions are comparable.
+    corpus_path = os.path.join(CORPUS_FOLDER, f"v{CORPUS_VERSION}-scale{scale}")
+    folders = {name: os.path.join(corpus_path, name) for name in CORPUS_SIZES}
+    done_marker = os.path.join(corpus_path, "complete")
+    if os.path.exists(done_marker):
+        return folders
+
+    shutil.rmtree(corpus_path, ignore_errors=True)
+    rng = random.Random(CORPUS_VERSION)
+    for name, size in CORPUS_SIZES.items():
+        os.makedirs(folders[name])
+        file_count = max(1, round(size["files"] * scale))
+        for file_number in range(file_count):
+            path = os.path.join(folders[name], f"{name}-{file_number:04}.pdf")
+            page_count = rng.randint(*size["pages"])
+            if name == "scans":
+                write_scan_pdf(path, page_count, rng)
+            elif name == "rotated":
+                rotations = [rng.choice((0, 90, 180, 270)) for _ in range(page_count)]
+                write_text_pdf(path, page_count, rng, rotations)
+            else:
+                write_text_pdf(path, page_count, rng)
+    with open(done_marker, "w") as f:
+        f.write("ok")
+    return folders
+
+
+def calibrate():
+    # Fixed work independent of PDF Rush, measured next to the benchmarks to
+    # tell a slower machine from slower code
+    values = random.Random(CORPUS_VERSION).choices(range(1 << 20), k=20000)
+
+    def work():
+        sorted(values)
+        hashlib.sha1(str(values).encode()).digest()
+
+    return min(measure(work))
+
+
+def pdf_paths(folder_path):
+    return sorted(
+        os.path.join(folder_path, file)
+        for file in os.listdir(folder_path)
+        if file.lower().endswith(".pdf")
+    )
+
+
+def measure(function, repeats=REPEATS, setup=None):
+    # Returns seconds of every run of function(). With setup, its result is
+    # passed to function and made untimed before every call; without it, fast
+    # functions are called in a loop and the average call is returned.
+    runs = []
+    for _ in range(repeats):
+        if setup is not None:
+            state = setup()
+            start = time.perf_counter()
+            function(state)
+            runs.append(time.perf_counter() - start)
+            continue
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= MIN_RUN_TIME:
+                break
+        runs.append(elapsed / calls)
+    return runs
+
+
+def load_folder(folder_path):
+    # Same as PDFEditorApp.load_files: page rotations of every file through
+    # the folder index
+    results = queue.Queue()
+    engine.index_files(
+        pdf_paths(folder_path),
+        engine.DocumentPool(engine.MAX_OPEN_DOCUMENTS),
+        engine.FolderIndex(folder_path),
+        results,
+        threading.Event(),
+    )
+    pages = engine.PageTable()
+    while True:
+        result = results.get()
+        if result is None:
+            return pages
+        file_path, rotations, key, error = result
+        if error is None:
+            pages.add_file(file_path, rotations)
+
+
+def clear_index_cache():
+    shutil.rmtree(os.path.join(engine.user_cache_dir(), "index"), ignore_errors=True)
+
+
+def page_keys(pages, limit):
+    step = max(1, len(pages) // limit)
+    return [
+        (*pages.page(page_number), pages.rotation(*pages.locate(page_number)))
+        for page_number in range(0, len(pages), step)
+    ][:limit]
+
+
+def bench_load(folders, results):
+    for name, folder_path in folders.items():
+        results[f"load_files/{name}/cold"] = {
+            "runs": measure(lambda _: load_folder(folder_path), setup=clear_index_cache)
+        }
+        load_folder(folder_path)
+        results[f"load_files/{name}/cached"] = {
+            "runs": measure(lambda: load_folder(folder_path))
+        }
+
+
+def bench_show_page(folders, results):
+    # Same as PDFEditorApp.show_current_page on a cache miss, per page
+    for name, folder_path in folders.items():
+        keys = page_keys(load_folder(folder_path), 40)
+
+        def show_pages(keys=keys):
+            doc_pool = engine.DocumentPool(engine.MAX_OPEN_DOCUMENTS)
+            for key in keys:
+                engine.render_page(doc_pool, key, *VIEW_SIZE)
+
+        runs = measure(show_pages)
+        results[f"show_current_page/{name}"] = {
+            "runs": [seconds / len(keys) for seconds in runs],
+            "unit": "per page",
+        }
+
+        # Same as PDFEditorApp.draw_tiles on the first zoom into a page: the
+        # tiles covering the view around the page center
+        zoomed = []
+        doc_pool = engine.DocumentPool(engine.MAX_OPEN_DOCUMENTS)
+        for key in keys[:10]:
+            width, height = engine.render_page(doc_pool, key, *VIEW_SIZE).size
+            width, height = width * ZOOM, height * ZOOM
+            columns = range(
+                (width - VIEW_SIZE[0]) // 2 // engine.TILE_SIZE,
+                (width + VIEW_SIZE[0]) // 2 // engine.TILE_SIZE + 1,
+            )
+            rows = range(
+                (height - VIEW_SIZE[1]) // 2 // engine.TILE_SIZE,
+                (height + VIEW_SIZE[1]) // 2 // engine.TILE_SIZE + 1,
+            )
+            zoomed.append(
+                [
+                    (key, width, height, column, row)
+                    for column in columns
+                    for row in rows
+                ]
+            )
+
+        def zoom_pages(zoomed=zoomed):
+            doc_pool = engine.DocumentPool(engine.MAX_OPEN_DOCUMENTS)
+            for tiles in zoomed:
+                for tile in tiles:
+                    engine.render_tile(doc_pool, *tile)
+
+        runs = measure(zoom_pages)
+        results[f"show_zoomed_page/{name}"] = {
+            "runs": [seconds / len(zoomed) for seconds in runs],
+            "unit": "per page",
+        }
+
+
+def bench_bookkeeping(folders, results):
+    # Same as the edit handlers: an edit updates the counters of one file,
+    # update_unsaved_changes_listbox lists every changed file with PageTable
+    loaded = [load_folder(folder_path) for folder_path in folders.values()]
+
+    def load_pages():
+        pages = engine.PageTable()
+        for folder_pages in loaded:
+            for file_id, file_path in enumerate(folder_pages.files):
+                pages.add_file(file_path, folder_pages.file_rotations(file_id))
+        return pages
+
+    rng = random.Random(CORPUS_VERSION)
+    page_count = len(load_pages())
+    edits = [rng.randrange(page_count) for _ in range(BOOKKEEPING_EDITS)]
+
+    def edit_pages(pages):
+        for page_number in edits:
+            file_id, page_index = pages.locate(page_number)
+            if page_number % 3:
+                pages.rotate(file_id, page_index, 90)
+            else:
+                pages.toggle_deleted(file_id, page_index)
+            pages.has_changes(file_id)
+
+    edited = load_pages()
+    edit_pages(edited)
+
+    corpus_path = os.path.commonpath(list(folders.values()))
+
+    def list_changed_files():
+        return [
+            edited.changes_text(file_id, corpus_path)
+            for file_id in edited.changed_files()
+        ]
+
+    runs = measure(edit_pages, setup=load_pages)
+    results["edit_page"] = {
+        "runs": [seconds / len(edits) for seconds in runs],
+        "unit": "per edit",
+    }
+    results["update_unsaved_changes_listbox"] = {
+        "runs": measure(list_changed_files),
+        "files": len(list_changed_files()),
+    }
+
+
+def bench_save(folders, results, work_folder):
+    # Same as PDFEditorApp.save_changes: rotation-only files are updated
+    # incrementally, files with deleted pages are written again, optimized
+    # scans get their images downsampled
+    for name, deleting, optimize, repeats in (
+        ("rotated", False, None, REPEATS),
+        ("small", True, None, REPEATS),
+        ("scans", False, {"image_dpi": 150}, OPTIMIZE_REPEATS),
+    ):
+        pages = load_folder(folders[name])
+        if optimize is not None:
+            name += "-optimized"
+        output_folder = os.path.join(work_folder, f"save-{name}")
+
+        def make_jobs():
+            shutil.rmtree(output_folder, ignore_errors=True)
+            os.makedirs(output_folder)
+            jobs = []
+            for file_id, file_path in enumerate(pages.files):
+                rotations = [
+                    (rotation + 90) % 360 for rotation in pages.file_rotations(file_id)
+                ]
+                deleted_pages = {0} if deleting and len(rotations) > 1 else set()
+                target_path = os.path.join(output_folder, os.path.basename(file_path))
+                jobs.append(
+                    (file_path, target_path, rotations, deleted_pages, optimize)
+                )
+            return jobs
+
+        def save(jobs):
+            saved = queue.Queue()
+            engine.save_files(jobs, None, saved, threading.Event())
+            while True:
+                result = saved.get()
+                if result is None:
+                    return
+                if result["error"] is not None:
+                    raise RuntimeError(f"{result['file']}: {result['error']}")
+
+        results[f"save_changes/{name}"] = {
+            "runs": measure(save, repeats, setup=make_jobs),
+            "files": len(pages.files),
+        }
+
+
+def bench_merge(folders, results, work_folder):
+    for name in ("small", "scans"):
+        file_paths = pdf_paths(folders[name])
+        output_path = os.path.join(work_folder, f"merged-{name}.pdf")
+
+        def merge():
+            result = engine.merge_pdfs(file_paths, output_path)
+            if result["error"] is not None or result["failures"]:
+                raise RuntimeError(result["error"] or result["failures"])
+
+        results[f"merge_files/{name}"] = {
+            "runs": measure(merge, repeats=max(1, REPEATS // 2)),
+            "files": len(file_paths),
+        }
+
+
+BENCHMARKS = {
+    "load": bench_load,
+    "show": bench_show_page,
+    "bookkeeping": bench_bookkeeping,
+    "save": bench_save,
+    "merge": bench_merge,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    folders = generate_corpus(args.scale)
+    corpus = {
+        name: {
+            "files": len(pdf_paths(folder_path)),
+            "bytes": sum(os.path.getsize(path) for path in pdf_paths(folder_path)),
+        }
+        for name, folder_path in folders.items()
+    }
+    results = {}
+    calibration = calibrate()
+    user_cache_dir = engine.user_cache_dir
+    with tempfile.TemporaryDirectory() as work_folder:
+        # Folder indexes and thumbnails of benchmark runs never mix with the
+        # user's ones. Cache paths are resolved in this process only, worker
+        # processes get them as arguments.
+        cache_folder = os.path.join(work_folder, "cache")
+        engine.user_cache_dir = lambda: cache_folder
+        try:
+            for name in args.only or BENCHMARKS:
+                print(f"Running {name}...", file=sys.stderr)
+                benchmark = BENCHMARKS[name]
+                if name in ("save", "merge"):
+                    benchmark(folders, results, work_folder)
+                else:
+                    benchmark(folders, results)
+        finally:
+            engine.user_cache_dir = user_cache_dir
+    calibration = (calibration + calibrate()) / 2
+
+    for result in results.values():
+        result["median"] = statistics.median(result["runs"])
+        result["min"] = min(result["runs"])
+
+    with open(os.path.join(os.path.dirname(engine.__file__), "version.json")) as f:
+        version = json.load(f)
+    report = {
+        "version": f"{version.get('major', 0)}.{version.get('minor', 0)}.{version.get('patch', 0)}",
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pymupdf": fitz.VersionBind,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": args.scale,
+        "calibration": calibration,
+        "corpus": corpus,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    for name, result in results.items():
+        print(
+            f"{name:45} {format_seconds(result['median']):>10} {result.get('unit', '')}",
+            file=sys.stderr,
+        )
+    return 0
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f} us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.1f} ms"
+    return f"{seconds:.2f} s"
+
+
+def compare(args):
+    # Exit code 1 if any benchmark got slower by more than the threshold
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline["scale"] != current["scale"]:
+        print("Results were measured at different scales", file=sys.stderr)
+        return 2
+
+    speed = 1
+    if args.normalize:
+        speed = current["calibration"] / baseline["calibration"]
+        print(f"Current machine runs the calibration {speed:.2f}x as long")
+
+    regressions = 0
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:45} {format_seconds(result[args.statistic]):>10}   new")
+            continue
+        change = result[args.statistic] / speed / before[args.statistic] - 1
+        regressed = change > args.threshold
+        regressions += regressed
+        print(
+            f"{name:45} {format_seconds(before[args.statistic]):>10} -> "
+            f"{format_seconds(result[args.statistic]):>10} {change:+7.1%}"
+            + ("  REGRESSION" if regressed else "")
+        )
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDF Rush benchmarks")
+    commands = parser.add_subparsers(dest="command")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="multiplies the number of generated files (0.1 for a quick run)",
+    )
+    parser.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), help="run only these"
+    )
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="slowdown reported as a regression, 0.25 is 25%%",
+    )
+    compare_parser.add_argument(
+        "--statistic",
+        choices=("min", "median"),
+        default="min",
+        help="compare the best or the median run (default: min)",
+    )
+    compare_parser.add_argument(
+        "--normalize",
+        action="store_true",
+        help="scale current times by the calibration, for results of "
+        "different machines or a noisy one",
+    )
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        return compare(args)
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,19 +5,101 @@
 # LICENSE file in the root directory of this source tree.
 
 import sys, os
-import PyPDF2
+import bisect
+import datetime
+import math
+import multiprocessing
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import tkinter as tk
-from tkinter import filedialog, messagebox, simpledialog
-import fitz
+from tkinter import filedialog, messagebox, simpledialog, ttk
 from PIL import Image, ImageTk
 import json
 import webbrowser
+from pdf_rush_engine import (
+    RENDER_CACHE_BUDGET,
+    MAX_OPEN_DOCUMENTS,
+    METRICS_ENABLED,
+    BLANK_SCORE_THRESHOLD,
+    OUTPUT_FOLDER_NAME,
+    ORIENTATION_MIN_CONFIDENCE,
+    THUMBNAIL_SIZE,
+    THUMBNAIL_WORKERS,
+    TILE_CACHE_BUDGET,
+    TILE_SIZE,
+    DocumentPool,
+    FolderIndex,
+    FolderScan,
+    PagePrefetcher,
+    PageTable,
+    RenderCache,
+    detect_blank_pages,
+    detect_rotations,
+    index_files,
+    index_key,
+    prune_thumbnails,
+    main as engine_main,
+    merge_files,
+    metrics,
+    refresh_files,
+    render_thumbnail,
+    render_tile,
+    save_files,
+    save_folder_index,
+    thumbnail_path,
+)
 
 if getattr(sys, "frozen", False):
     application_path = os.path.dirname(sys.executable)
 else:
     application_path = os.path.dirname(os.path.abspath(__file__))
 
+# How many pages before and after the current one are rendered in background
+PREFETCH_PAGES = 3
+# Marker drawn over pages that are going to be deleted
+DELETED_MARKER_TEXT = "EXTERMINATE"
+DELETED_MARKER_COLOR = "#e53333"
+# Delay before the page is rendered again for a resized window, in milliseconds
+RESIZE_DELAY = 150
+# How often the UI picks up results of background tasks, in milliseconds
+TASK_POLL_INTERVAL = 50
+# How often the UI checks whether the current page has been rendered, in milliseconds
+RENDER_POLL_INTERVAL = 10
+# Every zoom step scales the page by this factor, zooming in stops after
+# MAX_ZOOM_LEVEL steps from the page fitted to the canvas
+ZOOM_STEP = 2**0.5
+MAX_ZOOM_LEVEL = 8
+# How far a zoomed page moves per mouse wheel step, in pixels
+SCROLL_STEP = 120
+# Room around each thumbnail in the overview, in pixels
+THUMBNAIL_PADDING = 12
+# Height of the page number under each thumbnail, in pixels
+THUMBNAIL_CAPTION_HEIGHT = 18
+# Thumbnails kept decoded in memory by the overview
+THUMBNAIL_MEMORY_ITEMS = 512
+# How often the overview picks up rendered thumbnails, in milliseconds
+THUMBNAIL_POLL_INTERVAL = 50
+# Outline of the current page in the overview
+CURRENT_PAGE_COLOR = "#3366cc"
+# How often the debug overlay shows new timings, in milliseconds
+METRICS_OVERLAY_INTERVAL = 500
+# Loaded files are checked for changes on disk when the window gets focus,
+# but not more often than this, in seconds
+RESCAN_MIN_INTERVAL = 2
+# Slow rescans wait this many times their duration before the next one
+RESCAN_COST_FACTOR = 20
+# Choices of the file size menu under "Replace existing", values are the
+# optimize options of save_pdf
+OPTIMIZE_CHOICES = {
+    "Keep file size": None,
+    "Optimize size": {},
+    "Optimize size, images 300 dpi": {"image_dpi": 300},
+    "Optimize size, images 150 dpi": {"image_dpi": 150},
+}
+
 
 class PDFEditorApp:
     def __init__(self):
@@ -26,21 +108,51 @@ class PDFEditorApp:
         self.root.title(self.app_name)
         self.current_page = 0
         self.total_files = 0
-        self.file_number = {}
-        self.file_pages = {}
-        self.all_pages = []
+        self.pages = PageTable()
         self.pdf_files = []
         self.num_pages = 0
         self.canvas_width = 1024
         self.canvas_height = 700
-        self.page_rotations = {}
-        self.page_rotations_init = {}
-        self.deleted_pages = {}
-        self.unsaved_changes = {}
+        self.changed_files = []
+        self.blank_review = None
+        self.rotation_review = None
+        self.index_failures = []
+        # Index keys of loaded files, to find files changed on disk
+        self.file_keys = {}
+        self.folder_index = None
+        # Where files are loaded from, None when a single file was opened
+        self.folder_scan = None
+        self.last_rescan = 0
+        self.rescan_interval = RESCAN_MIN_INTERVAL
+        self.rescan_pending = False
         self.current_folder = application_path
-        self.output_folder = os.path.join(self.current_folder, "_pdf_rush")
+        self.output_folder = os.path.join(self.current_folder, OUTPUT_FOLDER_NAME)
         self.replace_existing = tk.BooleanVar()
+        self.optimize_size = tk.StringVar(value=next(iter(OPTIMIZE_CHOICES)))
         self.img_tk = None
+        self.page_bbox = (0, 0, 0, 0)
+        self.resize_job = None
+        self.doc_pool = DocumentPool(MAX_OPEN_DOCUMENTS)
+        self.render_cache = RenderCache(RENDER_CACHE_BUDGET)
+        self.prefetcher = PagePrefetcher(self.render_cache, self.doc_pool)
+        self.prefetcher.start()
+        self.render_job = None
+        self.render_job_start = 0
+        self.tile_cache = RenderCache(TILE_CACHE_BUDGET, "tile_cache")
+        self.tile_renderer = PagePrefetcher(self.tile_cache, self.doc_pool, render_tile)
+        self.tile_renderer.start()
+        # Zoom steps from the page fitted to the canvas, whose size is
+        # fit_size. Zoomed pages are zoom_size large and shown in tiles, tiles
+        # maps (column, row) to (canvas item, photo, is placeholder).
+        self.zoom_level = 0
+        self.fit_size = None
+        self.zoom_size = None
+        self.tiles = {}
+        self.tile_poll_job = None
+        self.drag_start = None
+        self.overview = None
+        self.metrics_overlay = None
+        self.tasks = TaskScheduler(self.root, self.show_task_progress)
         self.create_ui()
 
     def get_version_info(self):
@@ -65,6 +177,31 @@ class PDFEditorApp:
             self.canvas_frame, width=self.canvas_width, height=self.canvas_height
         )
         self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.canvas.bind("<Configure>", self.on_canvas_resize)
+        self.canvas.bind(
+            "<Control-MouseWheel>",
+            lambda event: self.zoom(1 if event.delta > 0 else -1, event.x, event.y),
+        )
+        self.canvas.bind(
+            "<Control-Button-4>", lambda event: self.zoom(1, event.x, event.y)
+        )
+        self.canvas.bind(
+            "<Control-Button-5>", lambda event: self.zoom(-1, event.x, event.y)
+        )
+        self.canvas.bind(
+            "<MouseWheel>",
+            lambda event: self.pan(0, SCROLL_STEP if event.delta > 0 else -SCROLL_STEP),
+        )
+        self.canvas.bind(
+            "<Shift-MouseWheel>",
+            lambda event: self.pan(SCROLL_STEP if event.delta > 0 else -SCROLL_STEP, 0),
+        )
+        self.canvas.bind("<Button-4>", lambda event: self.pan(0, SCROLL_STEP))
+        self.canvas.bind("<Button-5>", lambda event: self.pan(0, -SCROLL_STEP))
+        self.canvas.bind("<Shift-Button-4>", lambda event: self.pan(SCROLL_STEP, 0))
+        self.canvas.bind("<Shift-Button-5>", lambda event: self.pan(-SCROLL_STEP, 0))
+        self.canvas.bind("<ButtonPress-1>", self.start_drag)
+        self.canvas.bind("<B1-Motion>", self.drag)
 
         self.file_info_frame = tk.Frame(self.main_frame, padx=10, pady=5)
         self.file_info_frame.pack(side=tk.RIGHT, fill=tk.Y, expand=True)
@@ -83,6 +220,11 @@ class PDFEditorApp:
         )
         load_button.pack(side=tk.TOP, pady=5)
 
+        load_button = tk.Button(
+            self.file_info_frame, text="Load folder tree", command=self.ask_tree
+        )
+        load_button.pack(side=tk.TOP, pady=5)
+
         self.folder_info_label = tk.Label(self.file_info_frame, text="", anchor=tk.W)
         self.folder_info_label.pack(anchor=tk.W)
 
@@ -113,6 +255,23 @@ class PDFEditorApp:
         )
         self.save_button.pack(anchor=tk.W, pady=10)
 
+        self.status_label = tk.Label(self.file_info_frame, text="", anchor=tk.W)
+        self.status_label.pack(anchor=tk.W)
+
+        self.progress_frame = tk.Frame(self.file_info_frame)
+        self.progress_frame.pack(anchor=tk.W, fill=tk.X)
+        self.progress_bar = ttk.Progressbar(
+            self.progress_frame, orient=tk.HORIZONTAL, mode="determinate", maximum=1
+        )
+        self.progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.cancel_button = tk.Button(
+            self.progress_frame,
+            text="Cancel",
+            command=self.cancel_task,
+            state="disabled",
+        )
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+
         self.replace_checkbox = tk.Checkbutton(
             self.file_info_frame,
             text="Replace existing",
@@ -120,6 +279,11 @@ class PDFEditorApp:
         )
         self.replace_checkbox.pack(anchor=tk.W)
 
+        self.optimize_menu = tk.OptionMenu(
+            self.file_info_frame, self.optimize_size, *OPTIMIZE_CHOICES
+        )
+        self.optimize_menu.pack(anchor=tk.W)
+
         self.about_button = tk.Button(
             self.file_info_frame, text="About", command=self.show_about_info
         )
@@ -168,10 +332,44 @@ class PDFEditorApp:
             self.file_info_frame, text="Merge Files", command=self.merge_files
         )
         self.merge_button.pack(side=tk.TOP, pady=5)
+        self.overview_button = tk.Button(
+            self.file_info_frame, text="Overview", command=self.show_overview
+        )
+        self.overview_button.pack(side=tk.TOP, pady=5)
+        self.blank_button = tk.Button(
+            self.file_info_frame, text="Find Blank Pages", command=self.find_blank_pages
+        )
+        self.blank_button.pack(side=tk.TOP, pady=5)
+        self.rotation_button = tk.Button(
+            self.file_info_frame, text="Find Rotations", command=self.find_rotations
+        )
+        self.rotation_button.pack(side=tk.TOP, pady=5)
+        self.root.bind("o", lambda event: self.show_overview())
+        self.root.bind("<plus>", lambda event: self.zoom(1))
+        self.root.bind("<equal>", lambda event: self.zoom(1))
+        self.root.bind("<minus>", lambda event: self.zoom(-1))
+        self.root.bind("0", lambda event: self.zoom(-MAX_ZOOM_LEVEL))
+        self.root.bind("<F12>", lambda event: self.toggle_metrics_overlay())
+        self.root.bind("<FocusIn>", self.on_focus_in)
         self.root.mainloop()
-        
+
+    def show_overview(self):
+        if self.overview is None:
+            self.overview = ThumbnailOverview(self)
+            if self.current_page < self.num_pages:
+                self.overview.set_current_page(self.current_page)
+        else:
+            self.overview.lift()
+
+    def toggle_metrics_overlay(self):
+        if self.metrics_overlay is None:
+            metrics.enabled = True
+            self.metrics_overlay = MetricsOverlay(self)
+        else:
+            self.metrics_overlay.close()
+
     def show_help(self):
-        message = f"Keyboard bindings:\nUp Arrow: go to the previous page\nDown Arrow: go to the next page\nSpace: go to any page (from total)\nRight Arrow: rotate the current page clockwise\nLeft Arrow: rotate the current page counter-clockwise\nDelete: mark page as deleted\nEnter: Save changes"
+        message = f"Keyboard bindings:\nUp Arrow: go to the previous page\nDown Arrow: go to the next page\nSpace: go to any page (from total)\nRight Arrow: rotate the current page clockwise\nLeft Arrow: rotate the current page counter-clockwise\nDelete: mark page as deleted\nEnter: Save changes\nO: show thumbnails of all pages\n+ / - or Ctrl+Mouse Wheel: zoom in / out, drag or scroll to move the zoomed page\n0: show the whole page\nF12: show timings of loading, rendering and saving"
         show_custom_message_box(f"{self.app_name} help", message)
 
     def show_about_info(self):
@@ -188,8 +386,9 @@ class PDFEditorApp:
         )
         if file_path:
             self.current_folder = os.path.dirname(file_path)
-            self.output_folder = os.path.join(self.current_folder, "_pdf_rush")
+            self.output_folder = os.path.join(self.current_folder, OUTPUT_FOLDER_NAME)
             self.pdf_files = [os.path.basename(file_path)]
+            self.folder_scan = None
             self.load_files()
 
     def ask_folder(self):
@@ -197,62 +396,258 @@ class PDFEditorApp:
         if folder_path:
             self.load_folder(folder_path)
 
-    def load_folder(self, folder_path):
+    def ask_tree(self):
+        folder_path = filedialog.askdirectory()
+        if folder_path:
+            folder_scan = FolderScanDialog(self.root, folder_path).result
+            if folder_scan is not None:
+                self.load_folder(folder_path, folder_scan)
+
+    def load_folder(self, folder_path, folder_scan=None):
         self.reset_session()
         self.current_folder = folder_path
-        self.output_folder = os.path.join(self.current_folder, "_pdf_rush")
-        self.pdf_files = [
-            file
-            for file in os.listdir(self.current_folder)
-            if file.lower().endswith(".pdf")
-        ]
+        self.output_folder = os.path.join(self.current_folder, OUTPUT_FOLDER_NAME)
+        self.folder_scan = folder_scan or FolderScan(folder_path)
         self.load_files()
-        pass
 
     def load_files(self):
-        if self.pdf_files:
-            self.all_pages = []
-            self.page_rotations = {}
-            self.page_rotations_init = {}
-            self.deleted_pages = {}
-            self.unsaved_changes = {}
-            self.total_files = len(self.pdf_files)
-            self.file_number = {}
-            self.file_pages = {}
-            file_count = 0
-            for pdf_file in self.pdf_files:
-                file_path = os.path.join(self.current_folder, pdf_file)
-                try:
-                    pdf_reader = PyPDF2.PdfReader(file_path)
-                    for i, page in enumerate(pdf_reader.pages):
-                        self.all_pages.append((file_path, i))
-                        self.page_rotations[(file_path, i)] = page.rotation
-                        self.page_rotations_init[(file_path, i)] = page.rotation
-                    self.unsaved_changes[file_path] = {"rot": 0, "del": 0}
-                    file_count += 1
-                    self.file_number[file_path] = file_count
-                    self.file_pages[file_path] = len(pdf_reader.pages)
-                except:
-                    messagebox.showinfo("Oops...", f"Failed to open {file_path}")
-                    continue
-            self.num_pages = len(self.all_pages)
-            self.current_page = min(self.num_pages - 1, self.current_page)
+        # Files are indexed while folder_scan finds them, pages show up as
+        # soon as their file is indexed
+        self.stop_analysis()
+        self.pages = PageTable()
+        self.total_files = 0
+        self.num_pages = 0
+        self.render_cache.clear()
+        self.index_failures = []
+        self.file_keys = {}
+        self.folder_index = FolderIndex(self.current_folder)
+        if self.folder_scan is not None:
+            file_paths = self.folder_scan.iter_files()
+            files_found = None
+        else:
+            file_paths = [
+                os.path.join(self.current_folder, pdf_file)
+                for pdf_file in self.pdf_files
+            ]
+            files_found = len(file_paths)
+        target_page = self.current_page
+        self.tasks.start(
+            "index",
+            index_files,
+            (file_paths, self.doc_pool, self.folder_index),
+            lambda batch: self.on_index_results(batch, target_page, files_found),
+            lambda cancelled: self.on_index_finished(target_page, cancelled),
+            "Looking for PDF files...",
+        )
+        self.folder_info_label.config(
+            text=f"Folder: {os.path.basename(self.current_folder)}"
+        )
 
-            self.folder_info_label.config(
-                text=f"Folder: {os.path.basename(self.current_folder)}"
-            )
+        self.update_unsaved_changes_listbox()
+        if self.overview is not None:
+            self.overview.reset()
+
+    def stop_analysis(self):
+        # Results of these tasks refer to the pages of the current session
+        for name in ("index", "refresh", "blank", "rotations"):
+            self.tasks.discard(name)
+        for review in (self.blank_review, self.rotation_review):
+            if review is not None:
+                review.close()
+
+    def show_task_progress(self):
+        task = self.tasks.current()
+        if task is None and self.rescan_pending:
+            # After on_finish of the task that stopped the rescan
+            self.root.after(TASK_POLL_INTERVAL, self.resume_rescan)
+        if task is None:
+            self.status_label.config(text="")
+            self.progress_bar.configure(value=0)
+            self.cancel_button.configure(state="disabled")
+            return
+        self.status_label.config(text=task.text)
+        self.progress_bar.configure(value=task.done / task.total if task.total else 0)
+        self.cancel_button.configure(
+            state="disabled" if task.cancel_event.is_set() else "normal"
+        )
 
+    def cancel_task(self):
+        task = self.tasks.current()
+        if task is not None:
+            self.tasks.cancel(task.name)
+
+    def on_index_results(self, batch, target_page, files_found):
+        page_shown = self.num_pages > target_page
+        for file_path, rotations, key, error in batch:
+            if file_path is not None:
+                self.file_keys[file_path] = key
+            if error is not None:
+                self.index_failures.append(file_path or error)
+                continue
+            self.pages.add_file(file_path, rotations)
+        pages_added = len(self.pages) != self.num_pages
+        self.num_pages = len(self.pages)
+        self.total_files = len(self.pages.files)
+        if pages_added and self.overview is not None:
+            self.overview.redraw()
+
+        indexed = len(self.pages.files) + len(self.index_failures)
+        if files_found is None:
+            # The number of files is known when the folder scan ends
+            progress_text = f"Indexing {indexed} file(s) found so far..."
+        else:
+            progress_text = f"Indexing {indexed}/{files_found} file(s)..."
+        self.tasks.set_progress("index", indexed, files_found or 0, progress_text)
+
+        if self.num_pages > 0:
+            if page_shown:
+                self.show_page_info()
+            elif self.num_pages > target_page:
+                self.current_page = target_page
+                self.show_current_page()
+                self.enable_control_buttons()
+            # Files are rewritten from the complete index only
+            self.save_button.configure(state="disabled")
+
+    def on_index_finished(self, target_page, cancelled):
+        if 0 < self.num_pages <= target_page:
+            self.current_page = self.num_pages - 1
             self.show_current_page()
-            self.update_unsaved_changes_listbox()
-
             self.enable_control_buttons()
-        else:
+        if self.num_pages > 0:
+            self.save_button.configure(state="normal")
+
+        if self.index_failures:
+            messagebox.showinfo(
+                "Oops...",
+                f"Failed to open {len(self.index_failures)} file(s):\n"
+                + "\n".join(self.index_failures),
+            )
+        elif self.num_pages == 0 and not cancelled:
             messagebox.showinfo("No Files Found", "No PDF files found in the folder.")
 
+    def on_focus_in(self, event):
+        # Focus events of all widgets reach the root binding
+        if event.widget is self.root:
+            self.rescan_files()
+
+    def rescan_files(self):
+        # Picks up files changed, added or removed since they were loaded
+        if (
+            not self.file_keys
+            or self.tasks.running("refresh")
+            or self.busy()
+            or time.monotonic() - self.last_rescan < self.rescan_interval
+        ):
+            return
+        self.last_rescan = time.monotonic()
+        refresh = {"updates": {}, "keys": {}, "failures": []}
+        self.tasks.start(
+            "refresh",
+            refresh_files,
+            (
+                dict(self.file_keys),
+                self.folder_scan,
+                self.doc_pool,
+                self.folder_index,
+            ),
+            lambda batch: self.on_refresh_results(batch, refresh),
+            lambda cancelled: self.on_refresh_finished(refresh, cancelled),
+            "Checking files for changes...",
+        )
+
+    def on_refresh_results(self, batch, refresh):
+        for file_path, rotations, key, error in batch:
+            if file_path is None:
+                refresh["failures"].append(error)
+                continue
+            # Applied with the updates, a stopped rescan finds them again
+            refresh["keys"][file_path] = key
+            if error is not None:
+                refresh["failures"].append(f"{os.path.basename(file_path)}: {error}")
+            # Files that can't be opened anymore leave the session
+            refresh["updates"][file_path] = rotations
+
+    def on_refresh_finished(self, refresh, cancelled):
+        duration = time.monotonic() - self.last_rescan
+        self.rescan_interval = max(RESCAN_MIN_INTERVAL, duration * RESCAN_COST_FACTOR)
+        updates = refresh["updates"]
+        if cancelled or not updates:
+            return
+        for file_path, key in refresh["keys"].items():
+            if updates[file_path] is None and key is None:
+                self.file_keys.pop(file_path, None)
+            else:
+                self.file_keys[file_path] = key
+        discarded = [
+            os.path.basename(file_path)
+            for file_path in updates
+            if file_path in self.pages.file_ids
+            and self.pages.has_changes(self.pages.file_ids[file_path])
+        ]
+        self.update_files(updates)
+        if discarded:
+            messagebox.showinfo(
+                "Files changed",
+                f"{len(discarded)} file(s) changed on disk, their unsaved edits were discarded:\n"
+                + "\n".join(discarded),
+            )
+        if refresh["failures"]:
+            messagebox.showinfo(
+                "Oops...",
+                f"Failed to open {len(refresh['failures'])} file(s):\n"
+                + "\n".join(refresh["failures"]),
+            )
+
+    def update_files(self, file_rotations):
+        # Replaces the pages of some files without loading the others again,
+        # see PageTable.update_files. The current page stays in view.
+        location = None
+        if self.current_page < self.num_pages:
+            location = self.pages.locate(self.current_page)
+        self.stop_analysis()
+        new_ids = self.pages.update_files(file_rotations)
+        # Pending renders may show pages of the old files
+        self.render_job = None
+        self.render_cache.discard_files(file_rotations)
+        self.tile_cache.discard_files(file_rotations)
+        for file_path in file_rotations:
+            self.doc_pool.invalidate(file_path)
+        self.num_pages = len(self.pages)
+        self.total_files = len(self.pages.files)
+
+        if location is not None:
+            file_id, page_index = location
+            new_id = new_ids[file_id]
+            if new_id is not None:
+                self.current_page = self.pages.starts[new_id] + min(
+                    page_index, self.pages.page_count(new_id) - 1
+                )
+        self.current_page = max(0, min(self.current_page, self.num_pages - 1))
+
+        self.update_unsaved_changes_listbox()
+        if self.overview is not None:
+            self.overview.clear()
+            self.overview.redraw()
+        if self.num_pages == 0:
+            self.reset_zoom()
+            self.canvas.delete("all")
+            for label in (
+                self.file_name_label,
+                self.page_number_label,
+                self.page_info_label,
+            ):
+                label.config(text="")
+            self.disable_control_buttons()
+            return
+        self.enable_control_buttons()
+        self.show_current_page()
+
     def disable_control_buttons(self):
         for widget in (
             self.save_button,
             self.replace_checkbox,
+            self.optimize_menu,
             self.canvas,
             self.unsaved_changes_listbox,
             self.prev_button,
@@ -267,6 +662,7 @@ class PDFEditorApp:
         for widget in (
             self.save_button,
             self.replace_checkbox,
+            self.optimize_menu,
             self.canvas,
             self.unsaved_changes_listbox,
             self.prev_button,
@@ -278,17 +674,24 @@ class PDFEditorApp:
             widget.configure(state="normal")
 
     def reset_session(self):
+        self.stop_analysis()
         self.pdf_files = []
-        self.all_pages = []
-        self.file_number = {}
-        self.file_pages = {}
-        self.page_rotations = {}
-        self.page_rotations_init = {}
-        self.deleted_pages = {}
-        self.unsaved_changes = {}
+        self.pages = PageTable()
+        self.changed_files = []
         self.total_files = 0
         self.num_pages = 0
+        # A render still running may put a page of the old files into the
+        # cache, its poll must not show it
+        self.render_job = None
+        self.render_cache.clear()
+        self.tile_cache.clear()
+        self.prefetcher.schedule([])
+        self.reset_zoom()
+        self.fit_size = None
+        self.doc_pool.close_all()
         self.canvas.delete("all")
+        if self.overview is not None:
+            self.overview.reset()
         self.file_name_label.config(text="")
         self.page_number_label.config(text="")
         self.page_info_label.config(text="")
@@ -297,55 +700,26 @@ class PDFEditorApp:
         self.disable_control_buttons()
 
     def show_current_page(self):
+        self.reset_zoom()
+        job = (self.page_key(self.current_page), self.canvas_width, self.canvas_height)
+        img = self.render_cache.get(job)
+        if img is None:
+            # The prefetcher renders the page first. Scheduling another page
+            # replaces the request, so quickly skipped pages are never rendered.
+            self.show_page_info()
+            if job != self.render_job:
+                self.render_job = job
+                self.render_job_start = time.perf_counter()
+                self.prefetch_neighbours(job)
+                self.root.after(RENDER_POLL_INTERVAL, self.poll_render, job)
+            return
+        self.render_job = None
         self.canvas.delete("all")
-        file_path, page_index = self.all_pages[self.current_page]
-        file_pages = self.file_pages[file_path]
-        page_rotation = self.page_rotations[(file_path, page_index)]
-        page_rotation_init = self.page_rotations_init[(file_path, page_index)]
-        page_deleted = page_index in self.deleted_pages.get(file_path, set())
-
-        doc = fitz.open(file_path)
-        rotated_page = doc.load_page(page_index)
-        rotated_page.set_rotation(page_rotation)
-
-        if page_deleted:
-            watermark_text = "EXTERMINATE"
-            watermark_color = (
-                0.9,
-                0.2,
-                0.2,
-            )
-            watermark_font_size = rotated_page.rect.width / 12
-
-            watermark_width = fitz.get_text_length(
-                watermark_text, "helvetica-bold", fontsize=watermark_font_size
-            )
-            watermark_x = (rotated_page.rect.width - watermark_width) / 2
-            watermark_y = rotated_page.rect.height / 2
-
-            rotated_page.insert_text(
-                (watermark_x, watermark_y),
-                watermark_text,
-                fontsize=watermark_font_size,
-                color=watermark_color,
-                rotate=page_rotation,
-                fontname="helvetica-bold",
-            )
+        new_width, new_height = img.size
+        self.fit_size = img.size
 
-        pix = rotated_page.get_pixmap()
-        doc.close()
-
-        img_width, img_height = pix.width, pix.height
-        scale_factor = min(
-            self.canvas_width / img_width, self.canvas_height / img_height
-        )
-        new_width = int(img_width * scale_factor)
-        new_height = int(img_height * scale_factor)
-
-        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
-        img = img.resize((new_width, new_height), Image.ANTIALIAS)
-
-        self.img_tk = ImageTk.PhotoImage(img)
+        with metrics.timer("display.photo"):
+            self.img_tk = ImageTk.PhotoImage(img)
 
         x_position = (self.canvas_width - new_width) / 2
         y_position = (self.canvas_height - new_height) / 2
@@ -353,9 +727,75 @@ class PDFEditorApp:
         self.canvas.create_image(
             x_position, y_position, anchor=tk.NW, image=self.img_tk
         )
+        self.page_bbox = (
+            x_position,
+            y_position,
+            x_position + new_width,
+            y_position + new_height,
+        )
+
+        self.draw_page_overlay()
+        self.show_page_info()
+        self.prefetch_neighbours()
+        if self.overview is not None:
+            self.overview.set_current_page(self.current_page)
+
+    def poll_render(self, job):
+        if job != self.render_job:
+            return
+        if job in self.render_cache:
+            self.render_job = None
+            metrics.record("display.wait", time.perf_counter() - self.render_job_start)
+            self.show_current_page()
+        elif job in self.prefetcher.failures:
+            self.render_job = None
+            self.fit_size = None
+            self.canvas.delete("all")
+            self.canvas.create_text(
+                self.canvas_width / 2,
+                self.canvas_height / 2,
+                text=f"Failed to render the page: {self.prefetcher.failures[job]}",
+            )
+            self.show_page_info()
+        else:
+            self.root.after(RENDER_POLL_INTERVAL, self.poll_render, job)
+
+    def draw_page_overlay(self):
+        # Markers live on the canvas above the cached page image, changing
+        # them never renders the page again
+        self.canvas.delete("overlay")
+        file_id, page_index = self.pages.locate(self.current_page)
+        x0, y0, x1, y1 = self.page_bbox
+
+        if self.pages.is_deleted(file_id, page_index):
+            self.canvas.create_rectangle(
+                x0,
+                y0,
+                x1,
+                y1,
+                outline=DELETED_MARKER_COLOR,
+                width=4,
+                tags="overlay",
+            )
+            self.canvas.create_text(
+                (x0 + x1) / 2,
+                (y0 + y1) / 2,
+                text=DELETED_MARKER_TEXT,
+                fill=DELETED_MARKER_COLOR,
+                font=("Helvetica", -max(int((x1 - x0) / 12), 1), "bold"),
+                tags="overlay",
+            )
+
+    def show_page_info(self):
+        file_id, page_index = self.pages.locate(self.current_page)
+        file_path = self.pages.files[file_id]
+        file_pages = self.pages.page_count(file_id)
+        page_rotation = self.pages.rotation(file_id, page_index)
+        page_rotation_init = self.pages.rotation_init(file_id, page_index)
+        page_deleted = self.pages.is_deleted(file_id, page_index)
 
         self.file_name_label.config(
-            text=f"File {self.file_number[file_path]}/{self.total_files}: {os.path.basename(file_path)}"
+            text=f"File {file_id + 1}/{self.total_files}: {os.path.relpath(file_path, self.current_folder)}"
         )
         self.page_number_label.config(
             text=f"Page in file: {page_index + 1}/{file_pages}. Page in folder: {self.current_page + 1}/{self.num_pages}"
@@ -364,8 +804,256 @@ class PDFEditorApp:
             text=f"Rotation: {page_rotation}° (initial: {page_rotation_init}°), to delete: {'YES' if page_deleted else 'no'}"
         )
 
+    def on_canvas_resize(self, event):
+        if (event.width, event.height) == (self.canvas_width, self.canvas_height):
+            return
+        if self.resize_job is not None:
+            self.root.after_cancel(self.resize_job)
+        self.resize_job = self.root.after(
+            RESIZE_DELAY, self.resize_canvas, event.width, event.height
+        )
+
+    def resize_canvas(self, width, height):
+        self.resize_job = None
+        self.canvas_width = width
+        self.canvas_height = height
+        # Pages rendered for the old size won't be shown again
+        self.render_cache.clear()
+        self.tile_cache.clear()
+        if self.current_page < self.num_pages:
+            self.show_current_page()
+
+    def reset_zoom(self):
+        # Back to the whole page, pending tiles are not rendered anymore
+        self.zoom_level = 0
+        self.tiles = {}
+        self.tile_renderer.schedule([])
+
+    def zoom_page_size(self, level):
+        scale = ZOOM_STEP**level
+        return round(self.fit_size[0] * scale), round(self.fit_size[1] * scale)
+
+    def zoom(self, steps, x=None, y=None):
+        # Zooms by steps around the canvas point x, y, which keeps showing the
+        # same spot of the page. The canvas center by default.
+        if self.num_pages == 0 or self.render_job is not None or self.fit_size is None:
+            return
+        level = max(0, min(self.zoom_level + steps, MAX_ZOOM_LEVEL))
+        if level == self.zoom_level:
+            return
+        if level == 0:
+            self.show_current_page()
+            return
+        if x is None:
+            x, y = self.canvas_width / 2, self.canvas_height / 2
+        x0, y0, x1, y1 = self.page_bbox
+        spot_x = max(0, min((x - x0) / (x1 - x0), 1))
+        spot_y = max(0, min((y - y0) / (y1 - y0), 1))
+
+        self.zoom_level = level
+        self.zoom_size = self.zoom_page_size(level)
+        # Neighbouring pages can wait while the visible tiles are rendered
+        self.prefetcher.schedule([])
+        self.tiles = {}
+        self.canvas.delete("all")
+        width, height = self.zoom_size
+        self.place_page(x - spot_x * width, y - spot_y * height)
+        self.draw_tiles()
+        self.draw_page_overlay()
+
+    def place_page(self, left, top):
+        # Moves the zoomed page to left, top, but not further than its edges
+        # reach the canvas edges. Pages narrower than the canvas are centered.
+        width, height = self.zoom_size
+        if width <= self.canvas_width:
+            left = (self.canvas_width - width) / 2
+        else:
+            left = max(self.canvas_width - width, min(left, 0))
+        if height <= self.canvas_height:
+            top = (self.canvas_height - height) / 2
+        else:
+            top = max(self.canvas_height - height, min(top, 0))
+        # Whole pixels keep the tiles seamless
+        left, top = round(left), round(top)
+        self.page_bbox = (left, top, left + width, top + height)
+
+    def pan(self, dx, dy):
+        if self.zoom_level == 0:
+            return
+        x0, y0 = self.page_bbox[:2]
+        self.place_page(x0 + dx, y0 + dy)
+        self.canvas.move("tile", self.page_bbox[0] - x0, self.page_bbox[1] - y0)
+        self.draw_tiles()
+        self.draw_page_overlay()
+
+    def start_drag(self, event):
+        self.drag_start = (event.x, event.y)
+
+    def drag(self, event):
+        if self.drag_start is None:
+            return
+        x, y = self.drag_start
+        self.drag_start = (event.x, event.y)
+        self.pan(event.x - x, event.y - y)
+
+    def draw_tiles(self):
+        # Shows the tiles of the zoomed page in view, the ones in the middle
+        # are rendered first. Until a tile is rendered, a part of a lower
+        # resolution image is shown in its place. Tiles out of view are
+        # dropped, so memory doesn't grow with zoom or page size.
+        key = self.page_key(self.current_page)
+        width, height = self.zoom_size
+        x0, y0 = self.page_bbox[:2]
+        columns = range(
+            max(0, -x0) // TILE_SIZE,
+            (min(width, self.canvas_width - x0) - 1) // TILE_SIZE + 1,
+        )
+        rows = range(
+            max(0, -y0) // TILE_SIZE,
+            (min(height, self.canvas_height - y0) - 1) // TILE_SIZE + 1,
+        )
+        center_x = (self.canvas_width / 2 - x0) / TILE_SIZE - 0.5
+        center_y = (self.canvas_height / 2 - y0) / TILE_SIZE - 0.5
+        visible = sorted(
+            ((column, row) for row in rows for column in columns),
+            key=lambda tile: (tile[0] - center_x) ** 2 + (tile[1] - center_y) ** 2,
+        )
+
+        with metrics.timer("display.tiles"):
+            for tile in set(self.tiles).difference(visible):
+                self.canvas.delete(self.tiles.pop(tile)[0])
+            missing = []
+            for column, row in visible:
+                shown = self.tiles.get((column, row))
+                if shown is not None and not shown[2]:
+                    continue
+                job = (key, width, height, column, row)
+                if job in self.tile_renderer.failures:
+                    continue
+                if shown is not None and job not in self.tile_cache:
+                    missing.append(job)
+                    continue
+                img = self.tile_cache.get(job)
+                placeholder = img is None
+                if placeholder:
+                    missing.append(job)
+                    img = self.placeholder_tile(job)
+                with metrics.timer("display.photo"):
+                    photo = ImageTk.PhotoImage(img)
+                if shown is not None:
+                    self.canvas.delete(shown[0])
+                item = self.canvas.create_image(
+                    x0 + column * TILE_SIZE,
+                    y0 + row * TILE_SIZE,
+                    anchor=tk.NW,
+                    image=photo,
+                    tags="tile",
+                )
+                self.tiles[(column, row)] = (item, photo, placeholder)
+        self.canvas.tag_raise("overlay")
+
+        self.tile_renderer.schedule(missing)
+        if missing and self.tile_poll_job is None:
+            self.tile_poll_job = self.root.after(RENDER_POLL_INTERVAL, self.poll_tiles)
+
+    def poll_tiles(self):
+        self.tile_poll_job = None
+        if self.zoom_level > 0:
+            self.draw_tiles()
+
+    def placeholder_tile(self, job):
+        # Scales up the part of the sharpest lower resolution image in memory
+        # that shows the tile: tiles of lower zoom levels or the whole page
+        key, width, height, column, row = job
+        box = (
+            column * TILE_SIZE,
+            row * TILE_SIZE,
+            min((column + 1) * TILE_SIZE, width),
+            min((row + 1) * TILE_SIZE, height),
+        )
+        size = (box[2] - box[0], box[3] - box[1])
+        for level in range(self.zoom_level - 1, -1, -1):
+            if level == 0:
+                lower_width, lower_height = self.fit_size
+            else:
+                lower_width, lower_height = self.zoom_page_size(level)
+            scale_x, scale_y = lower_width / width, lower_height / height
+            lower_box = (
+                box[0] * scale_x,
+                box[1] * scale_y,
+                box[2] * scale_x,
+                box[3] * scale_y,
+            )
+            if level == 0:
+                img = self.render_cache.get(
+                    (key, self.canvas_width, self.canvas_height)
+                )
+            else:
+                img, lower_box = self.lower_tiles(
+                    (key, lower_width, lower_height), lower_box
+                )
+            if img is not None:
+                return img.resize(size, Image.BILINEAR, box=lower_box)
+        return Image.new("RGB", size, "white")
+
+    def lower_tiles(self, page, box):
+        # Joins the rendered tiles of a lower zoom level that cover box.
+        # Returns the image and box moved onto it, or None if a tile is
+        # missing.
+        first_column, first_row = int(box[0] // TILE_SIZE), int(box[1] // TILE_SIZE)
+        last_column = (math.ceil(box[2]) - 1) // TILE_SIZE
+        last_row = (math.ceil(box[3]) - 1) // TILE_SIZE
+        img = Image.new(
+            "RGB",
+            (
+                (last_column - first_column + 1) * TILE_SIZE,
+                (last_row - first_row + 1) * TILE_SIZE,
+            ),
+        )
+        for column in range(first_column, last_column + 1):
+            for row in range(first_row, last_row + 1):
+                job = page + (column, row)
+                tile = self.tile_cache.get(job) if job in self.tile_cache else None
+                if tile is None:
+                    return None, box
+                img.paste(
+                    tile,
+                    (
+                        (column - first_column) * TILE_SIZE,
+                        (row - first_row) * TILE_SIZE,
+                    ),
+                )
+        left, top = first_column * TILE_SIZE, first_row * TILE_SIZE
+        return img, (box[0] - left, box[1] - top, box[2] - left, box[3] - top)
+
+    def page_key(self, page_number):
+        file_id, page_index = self.pages.locate(page_number)
+        return (
+            self.pages.files[file_id],
+            page_index,
+            self.pages.rotation(file_id, page_index),
+        )
+
+    def prefetch_neighbours(self, current_job=None):
+        jobs = [] if current_job is None else [current_job]
+        for distance in range(1, PREFETCH_PAGES + 1):
+            for page_number in (
+                self.current_page + distance,
+                self.current_page - distance,
+            ):
+                if 0 <= page_number < self.num_pages:
+                    jobs.append(
+                        (
+                            self.page_key(page_number),
+                            self.canvas_width,
+                            self.canvas_height,
+                        )
+                    )
+        self.prefetcher.schedule(jobs)
+
     def previous_page(self):
-        if self.current_page > 0:
+        # current_page may point past the loaded pages while indexing
+        if 0 < self.current_page < self.num_pages:
             self.current_page -= 1
             self.show_current_page()
 
@@ -389,131 +1077,1130 @@ class PDFEditorApp:
             self.show_current_page()
 
     def rotate_page(self, degree=90):
-        file_path, page_index = self.all_pages[self.current_page]
-        self.page_rotations[(file_path, page_index)] = (
-            self.page_rotations[(file_path, page_index)] + degree
-        ) % 360
+        # Also with no pages loaded, e.g. after opening an empty file
+        if self.tasks.running("save") or self.current_page >= self.num_pages:
+            return
+        file_id, page_index = self.pages.locate(self.current_page)
+        self.pages.rotate(file_id, page_index, degree)
         self.show_current_page()
-        self.update_unsaved_changes_listbox()
+        self.update_unsaved_changes_row(file_id)
 
     def delete_page(self):
-        file_path, page_index = self.all_pages[self.current_page]
-        deleted_pages_set = self.deleted_pages.setdefault(file_path, set())
+        if self.tasks.running("save"):
+            return
+        self.toggle_page_deleted(self.current_page)
+
+    def toggle_page_deleted(self, page_number):
+        if page_number >= self.num_pages:
+            return
+        file_id, page_index = self.pages.locate(page_number)
+        self.pages.toggle_deleted(file_id, page_index)
+        if page_number == self.current_page:
+            self.draw_page_overlay()
+            self.show_page_info()
+        if self.overview is not None:
+            self.overview.update_page(page_number)
+        self.update_unsaved_changes_row(file_id)
+
+    def find_blank_pages(self):
+        if self.busy() or self.num_pages == 0:
+            return
+
+        threshold = simpledialog.askfloat(
+            "Find Blank Pages",
+            "Pages are marked as deleted from this blank score\n"
+            "(0 to 1, higher finds fewer pages):",
+            parent=self.root,
+            initialvalue=BLANK_SCORE_THRESHOLD,
+            minvalue=0,
+            maxvalue=1,
+        )
+        if threshold is None:
+            return
+
+        if self.blank_review is not None:
+            self.blank_review.close()
+        files = [
+            (file_path, self.pages.page_count(file_id))
+            for file_id, file_path in enumerate(self.pages.files)
+        ]
+        search = {
+            "threshold": threshold,
+            "analyzed": 0,
+            "suggestions": [],
+            "failures": [],
+        }
+        self.stop_rescan()
+        self.tasks.start(
+            "blank",
+            detect_blank_pages,
+            (files,),
+            lambda batch: self.on_blank_results(batch, search),
+            lambda cancelled: self.on_blank_finished(search),
+            f"Checking 0/{self.num_pages} pages for blank ones...",
+        )
 
-        if page_index in deleted_pages_set:
-            deleted_pages_set.remove(page_index)
-            self.unsaved_changes[file_path]["del"] -= 1
+    def on_blank_results(self, batch, search):
+        suggestions = search["suggestions"]
+        for file_path, first_page, scores, error in batch:
+            if error is not None:
+                search["failures"].append(
+                    f"{os.path.basename(file_path or '')}: {error}"
+                )
+            if file_path is None:
+                continue
+            file_id = self.pages.file_ids[file_path]
+            search["analyzed"] += len(scores)
+            for page_index, score in enumerate(scores, first_page):
+                if score < search["threshold"] or self.pages.is_deleted(
+                    file_id, page_index
+                ):
+                    continue
+                page_number = self.pages.starts[file_id] + page_index
+                self.toggle_page_deleted(page_number)
+                suggestions.append((page_number, score))
+
+        self.tasks.set_progress(
+            "blank",
+            search["analyzed"],
+            self.num_pages,
+            f"Checked {search['analyzed']}/{self.num_pages} pages, {len(suggestions)} blank",
+        )
+
+    def on_blank_finished(self, search):
+        failures = search["failures"]
+        if failures:
+            messagebox.showinfo(
+                "Oops...",
+                f"Failed to check {len(failures)} part(s) of files:\n"
+                + "\n".join(failures),
+            )
+        if search["suggestions"]:
+            self.blank_review = BlankPageReview(self, sorted(search["suggestions"]))
         else:
-            deleted_pages_set.add(page_index)
-            self.unsaved_changes[file_path]["del"] += 1
+            messagebox.showinfo(
+                "No Blank Pages", "No blank pages found with this blank score."
+            )
 
-        self.show_current_page()
-        self.update_unsaved_changes_listbox()
+    def find_rotations(self):
+        if self.busy() or self.num_pages == 0:
+            return
+
+        if self.rotation_review is not None:
+            self.rotation_review.close()
+        files = [
+            (file_path, self.pages.page_count(file_id))
+            for file_id, file_path in enumerate(self.pages.files)
+        ]
+        search = {"analyzed": 0, "proposals": {}, "failures": []}
+        self.stop_rescan()
+        self.tasks.start(
+            "rotations",
+            detect_rotations,
+            # The app's index, so proposals survive its next save. busy()
+            # and stop_rescan make sure no other task uses it meanwhile.
+            (files, self.folder_index),
+            lambda batch: self.on_rotation_results(batch, search),
+            lambda cancelled: self.on_rotation_finished(search),
+            f"Checking 0/{self.num_pages} pages for rotations...",
+        )
+
+    def on_rotation_results(self, batch, search):
+        # Proposals map file ids to (page_index, rotation, confidence) of pages
+        # whose detected rotation differs from the one in the file
+        proposals = search["proposals"]
+        for file_path, first_page, page_proposals, error in batch:
+            if error is not None:
+                search["failures"].append(
+                    f"{os.path.basename(file_path or '')}: {error}"
+                )
+            if file_path is None:
+                continue
+            file_id = self.pages.file_ids[file_path]
+            search["analyzed"] += len(page_proposals)
+            for page_index, (change, confidence) in enumerate(
+                page_proposals, first_page
+            ):
+                if change and confidence >= ORIENTATION_MIN_CONFIDENCE:
+                    rotation = self.pages.rotation_init(file_id, page_index)
+                    proposals.setdefault(file_id, []).append(
+                        (page_index, (rotation + change) % 360, confidence)
+                    )
+
+        proposed_pages = sum(
+            len(file_proposals) for file_proposals in proposals.values()
+        )
+        self.tasks.set_progress(
+            "rotations",
+            search["analyzed"],
+            self.num_pages,
+            f"Checked {search['analyzed']}/{self.num_pages} pages, {proposed_pages} to rotate",
+        )
+
+    def on_rotation_finished(self, search):
+        failures = search["failures"]
+        if failures:
+            messagebox.showinfo(
+                "Oops...",
+                f"Failed to check {len(failures)} part(s) of files:\n"
+                + "\n".join(failures),
+            )
+        if search["proposals"]:
+            self.rotation_review = RotationReview(
+                self, sorted(search["proposals"].items())
+            )
+        else:
+            messagebox.showinfo("No Rotations", "All pages seem to be upright.")
+
+    def apply_rotations(self, file_id, file_proposals):
+        for page_index, rotation, confidence in file_proposals:
+            self.pages.rotate(
+                file_id,
+                page_index,
+                rotation - self.pages.rotation(file_id, page_index),
+            )
+            if self.overview is not None:
+                self.overview.update_page(self.pages.starts[file_id] + page_index)
+        self.update_unsaved_changes_row(file_id)
+        if self.pages.locate(self.current_page)[0] == file_id:
+            self.show_current_page()
 
     def update_unsaved_changes_listbox(self):
         self.unsaved_changes_listbox.delete(0, tk.END)
-        for file_path, changes in self.unsaved_changes.items():
-            changes["rot"] = 0
-            for page in range(self.file_pages[file_path]):
-                if ((file_path, page) in self.page_rotations) and self.page_rotations[
-                    (file_path, page)
-                ] != self.page_rotations_init[(file_path, page)]:
-                    changes["rot"] += 1
-            num_rotations = changes["rot"]
-            num_deletions = changes["del"]
-            if num_rotations > 0 or num_deletions > 0:
-                file_name = os.path.basename(file_path)
-                self.unsaved_changes_listbox.insert(
-                    tk.END, f"{file_name} (rot {num_rotations}, del {num_deletions})"
-                )
+        self.changed_files = self.pages.changed_files()
+        for file_id in self.changed_files:
+            self.unsaved_changes_listbox.insert(
+                tk.END, self.pages.changes_text(file_id, self.current_folder)
+            )
+
+    def update_unsaved_changes_row(self, file_id):
+        # Listbox rows follow file order, changed_files mirrors them
+        row = bisect.bisect_left(self.changed_files, file_id)
+        has_row = row < len(self.changed_files) and self.changed_files[row] == file_id
+        if has_row:
+            self.unsaved_changes_listbox.delete(row)
+        if self.pages.has_changes(file_id):
+            self.unsaved_changes_listbox.insert(
+                row, self.pages.changes_text(file_id, self.current_folder)
+            )
+            if not has_row:
+                self.changed_files.insert(row, file_id)
+        elif has_row:
+            del self.changed_files[row]
+
+    def busy(self):
+        # Page numbers have to stay valid while these tasks run. Checking
+        # files for changes only waits for them, see stop_rescan.
+        return any(
+            self.tasks.running(name) for name in ("index", "save", "blank", "rotations")
+        )
+
+    def stop_rescan(self):
+        # Called right before starting a task busy() waits for. A running
+        # check for changed files is stopped, it runs again when no task is
+        # left, see show_task_progress.
+        if not self.tasks.running("refresh"):
+            return
+        self.tasks.discard("refresh")
+        self.last_rescan = 0
+        self.rescan_pending = True
+        self.status_label.config(text="Checking files for changes paused...")
+
+    def resume_rescan(self):
+        if self.rescan_pending and self.tasks.current() is None:
+            self.rescan_pending = False
+            self.rescan_files()
 
     def save_changes(self):
+        if self.busy():
+            return
+
         save_folder = self.output_folder
         replace_existing = self.replace_existing.get()
+        optimize = OPTIMIZE_CHOICES[self.optimize_size.get()]
+
+        # Optimizing saves all files, also those without edits
+        jobs = []
+        for file_id, file_path in enumerate(self.pages.files):
+            if optimize is not None or self.pages.has_changes(file_id):
+                if replace_existing and os.path.exists(file_path):
+                    target_path = file_path
+                else:
+                    # Files of subfolders keep their place in the tree
+                    target_path = os.path.join(
+                        save_folder, os.path.relpath(file_path, self.current_folder)
+                    )
+                jobs.append(
+                    (
+                        file_path,
+                        target_path,
+                        self.pages.file_rotations(file_id),
+                        self.pages.file_deleted(file_id),
+                        optimize,
+                    )
+                )
+
+        if not jobs:
+            messagebox.showinfo("No Changes", "No files were edited or saved.")
+            return
 
         if not os.path.exists(save_folder):
             os.makedirs(save_folder)
 
-        saved_files = []
+        # The save task keeps the files closed until it ends. Neighbours wait,
+        # a page still waiting to be shown is rendered.
+        self.prefetcher.schedule([] if self.render_job is None else [self.render_job])
+        blocked = {path for job in jobs for path in job[:2]}
+        if self.overview is not None:
+            self.overview.pause()
+
+        self.save_button.configure(state="disabled")
+        self.stop_rescan()
+        save = {
+            # Other files may be loaded before the save ends
+            "pages": self.pages,
+            "current_folder": self.current_folder,
+            "folder": save_folder,
+            "jobs": jobs,
+            "blocked": blocked,
+            "optimize": optimize,
+            "bytes_before": 0,
+            "bytes_after": 0,
+            "saved": [],
+            "saved_paths": set(),
+            "failures": [],
+        }
+        self.tasks.start(
+            "save",
+            save_files,
+            (jobs, self.doc_pool),
+            lambda batch: self.on_save_results(batch, save),
+            lambda cancelled: self.on_save_finished(save),
+            f"Saving 0/{len(jobs)} file(s)...",
+        )
 
-        for file_path in self.unsaved_changes:
-            changes = self.unsaved_changes[file_path]
-            num_rotations = changes["rot"]
-            num_deletions = changes["del"]
-            if num_rotations > 0 or num_deletions > 0:
-                pdf_reader = PyPDF2.PdfReader(file_path)
-                pdf_writer = PyPDF2.PdfWriter()
-                for i, page in enumerate(pdf_reader.pages):
-                    if i not in self.deleted_pages.get(file_path, set()):
-                        page.rotation = self.page_rotations[(file_path, i)]
-                        pdf_writer.add_page(page)
+    def on_save_results(self, batch, save):
+        for result in batch:
+            file_name = result["file"] and os.path.relpath(
+                result["file"], save["current_folder"]
+            )
+            if result["error"] is None:
+                if save["optimize"] is not None:
+                    save["bytes_before"] += result["bytes_before"]
+                    save["bytes_after"] += result["bytes_after"]
+                    file_name += ": " + size_change_text(
+                        result["bytes_before"], result["bytes_after"]
+                    )
+                save["saved"].append(file_name)
+                save["saved_paths"].add(result["file"])
+            else:
+                save["failures"].append(f"{file_name}: {result['error']}")
+        done = len(save["saved"]) + len(save["failures"])
+        self.tasks.set_progress(
+            "save",
+            done,
+            len(save["jobs"]),
+            f"Saving {done}/{len(save['jobs'])} file(s): {file_name}",
+        )
 
-                if replace_existing and os.path.exists(file_path):
-                    with open(file_path, "wb") as f:
-                        pdf_writer.write(f)
-                else:
-                    with open(
-                        os.path.join(save_folder, os.path.basename(file_path)), "wb"
-                    ) as f:
-                        pdf_writer.write(f)
+    def on_save_finished(self, save):
+        saved_files, failures = save["saved"], save["failures"]
+        self.save_button.configure(state="normal")
+        self.doc_pool.unblock(save["blocked"])
+        if self.overview is not None:
+            self.overview.resume()
+        # Before the dialog, a paused rescan resumes while it is open
+        if self.pages is save["pages"]:
+            self.update_saved_files(save)
+        if self.render_job is not None:
+            self.prefetch_neighbours(self.render_job)
+
+        summary_message = (
+            f"{len(saved_files)} file(s) saved to {save['folder']}:\n"
+            + "\n".join(saved_files)
+        )
+        if save["optimize"] is not None and saved_files:
+            summary_message += "\n\nIn total: " + size_change_text(
+                save["bytes_before"], save["bytes_after"]
+            )
+        if failures:
+            summary_message += (
+                f"\n\nFailed to save {len(failures)} file(s):\n" + "\n".join(failures)
+            )
+            messagebox.showinfo("Saved with errors", summary_message)
+        else:
+            messagebox.showinfo("Saved", summary_message)
 
-                saved_files.append(os.path.basename(file_path))
+    def update_saved_files(self, save):
+        # The saved pages are known, so saved files are not parsed again.
+        # Replaced files get the saved pages, files saved elsewhere are
+        # unchanged and lose their edits. Other files keep theirs.
+        file_rotations = {}
+        for file_path, target_path, rotations, deleted_pages, _ in save["jobs"]:
+            if file_path not in save["saved_paths"]:
+                continue
+            if target_path != file_path:
+                file_id = self.pages.file_ids[file_path]
+                file_rotations[file_path] = self.pages.file_rotations_init(file_id)
+                continue
+            rotations = [
+                rotation
+                for page_index, rotation in enumerate(rotations)
+                if page_index not in deleted_pages
+            ]
+            try:
+                key = index_key(file_path)
+            except OSError:
+                key = None
+            self.file_keys[file_path] = key
+            if key is not None:
+                self.folder_index.store(file_path, key, rotations)
+            file_rotations[file_path] = rotations
+        self.tasks.start(
+            "index_save",
+            save_folder_index,
+            (self.folder_index,),
+            lambda batch: None,
+            lambda cancelled: None,
+            "Saving the folder index...",
+        )
+        if file_rotations:
+            self.update_files(file_rotations)
 
-        self.deleted_pages.clear()
-        self.unsaved_changes.clear()
+    def merge_files(self):
+        if self.tasks.running("merge"):
+            return
+        if self.num_pages == 0:
+            messagebox.showinfo(
+                "Nothing to merge", "Open a folder with PDF files first."
+            )
+            return
 
-        if saved_files:
-            num_saved_files = len(saved_files)
-            summary_message = (
-                f"{num_saved_files} file(s) saved to {save_folder}:\n"
-                + "\n".join(saved_files)
+        selected_files = filedialog.askopenfilenames(
+            filetypes=[("Portable Document Format", ".pdf")]
+        )
+        if not selected_files:
+            return
+
+        output_file_path = filedialog.asksaveasfilename(
+            filetypes=[("Portable Document Format", ".pdf")],
+            defaultextension=".pdf",
+        )
+        if not output_file_path:
+            return
+
+        # Pages of the currently opened file go first
+        current_file_path, current_page_index = self.pages.page(self.current_page)
+        file_paths = [current_file_path] + list(selected_files)
+
+        merge = {}
+        self.tasks.start(
+            "merge",
+            merge_files,
+            (file_paths, output_file_path, self.doc_pool),
+            lambda batch: self.on_merge_results(batch, merge),
+            lambda cancelled: self.on_merge_finished(merge["result"]),
+            f"Merging 0/{len(file_paths)} file(s)...",
+        )
+
+    def on_merge_results(self, batch, merge):
+        # Progress tuples are followed by the merge_pdfs result
+        for message in batch:
+            if isinstance(message, dict):
+                merge["result"] = message
+                continue
+            done, total, file_path, error = message
+            self.tasks.set_progress(
+                "merge",
+                done,
+                total,
+                f"Merging {done}/{total} file(s): {os.path.basename(file_path)}",
             )
-            messagebox.showinfo("Saved", summary_message)
-            self.load_files()
+
+    def on_merge_finished(self, result):
+        self.doc_pool.unblock([result["target"]])
+        if result["cancelled"]:
+            messagebox.showinfo("Merge Cancelled", "Merged file was not saved.")
+            return
+        if result["error"] is not None:
+            messagebox.showinfo(
+                "Error", f"Failed to merge PDF files: {result['error']}"
+            )
+            return
+        summary_message = f"PDF files merged successfully: {result['target']}"
+        if result["failures"]:
+            failures = [
+                f"{os.path.basename(file_path)}: {error}"
+                for file_path, error in result["failures"]
+            ]
+            summary_message += f"\n\nSkipped {len(failures)} file(s):\n" + "\n".join(
+                failures
+            )
+        messagebox.showinfo("Merge Complete", summary_message)
+
+
+class BackgroundTask:
+    # One run of target(*args, results, cancel) on a worker thread
+
+    def __init__(self, name, on_results, on_finish):
+        self.name = name
+        self.on_results = on_results
+        self.on_finish = on_finish
+        self.results = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.done = 0
+        self.total = 0
+        self.text = ""
+
+
+class TaskScheduler:
+    # Background tasks of the app by name. Targets put results into a queue
+    # and None when finished; results are handed to on_results in batches on
+    # the Tk thread. Cancelled tasks finish their work and still report,
+    # discarded ones are never heard from again.
+
+    def __init__(self, root, on_change):
+        self.root = root
+        self.on_change = on_change
+        self.tasks = {}
+
+    def start(self, name, target, args, on_results, on_finish, text=""):
+        self.discard(name)
+        task = BackgroundTask(name, on_results, on_finish)
+        task.text = text
+        self.tasks[name] = task
+        threading.Thread(
+            target=target, args=args + (task.results, task.cancel_event), daemon=True
+        ).start()
+        self.root.after(TASK_POLL_INTERVAL, self.poll, task)
+        self.on_change()
+        return task
+
+    def running(self, name):
+        return name in self.tasks
+
+    def current(self):
+        # The most recently started task is the one shown in the status bar
+        return next(reversed(self.tasks.values()), None)
+
+    def cancel(self, name):
+        task = self.tasks.get(name)
+        if task is not None and not task.cancel_event.is_set():
+            task.cancel_event.set()
+            task.text = f"Cancelling... {task.text}"
+            self.on_change()
+
+    def discard(self, name):
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            task.cancel_event.set()
+            self.on_change()
+
+    def set_progress(self, name, done, total, text):
+        task = self.tasks.get(name)
+        if task is not None:
+            task.done, task.total = done, total
+            task.text = f"Cancelling... {text}" if task.cancel_event.is_set() else text
+            self.on_change()
+
+    def poll(self, task):
+        if self.tasks.get(task.name) is not task:
+            return
+        batch = []
+        finished = False
+        while True:
+            try:
+                result = task.results.get_nowait()
+            except queue.Empty:
+                break
+            if result is None:
+                finished = True
+                break
+            batch.append(result)
+
+        if batch:
+            task.on_results(batch)
+            if self.tasks.get(task.name) is not task:
+                return
+        if finished:
+            del self.tasks[task.name]
+            self.on_change()
+            task.on_finish(task.cancel_event.is_set())
         else:
-            messagebox.showinfo("No Changes", "No files were edited or saved.")
+            self.root.after(TASK_POLL_INTERVAL, self.poll, task)
+
+
+class ThumbnailOverview(tk.Toplevel):
+    # Grid of all loaded pages. Only cells in view get canvas items. Missing
+    # thumbnails are rendered by worker processes into the disk cache at the
+    # rotation stored in the file; rotations and deletions made since are
+    # applied on top, so editing never renders a thumbnail again.
+
+    def __init__(self, app):
+        super().__init__(app.root)
+        self.app = app
+        self.title(f"{app.app_name} overview")
+        self.cell_width = THUMBNAIL_SIZE + THUMBNAIL_PADDING
+        self.cell_height = THUMBNAIL_SIZE + THUMBNAIL_PADDING + THUMBNAIL_CAPTION_HEIGHT
+        self.columns = 0
+        self.current_page = None
+        self.photos = {}
+        self.images = OrderedDict()
+        self.file_keys = {}
+        self.pending = {}
+        self.failed = set()
+        self.executor = None
+        self.poll_job = None
+        # Thumbnails are not rendered while files are saved, see pause
+        self.paused = app.tasks.running("save")
+
+        scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scroll)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas = tk.Canvas(
+            self,
+            width=self.cell_width * 5,
+            height=self.cell_height * 4,
+            yscrollcommand=scrollbar.set,
+            yscrollincrement=self.cell_height // 4,
+        )
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.canvas.bind("<Configure>", lambda event: self.redraw())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind(
+            "<Button-4>", lambda event: self.on_scroll("scroll", -1, "units")
+        )
+        self.canvas.bind(
+            "<Button-5>", lambda event: self.on_scroll("scroll", 1, "units")
+        )
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+    def close(self):
+        if self.poll_job is not None:
+            self.after_cancel(self.poll_job)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        # No thumbnail is in use anymore
+        threading.Thread(target=prune_thumbnails, daemon=True).start()
+        self.app.overview = None
+        self.destroy()
+
+    def pause(self):
+        # Worker processes keep documents open, so they are stopped until
+        # resume. Thumbnails they finished are in the disk cache.
+        self.paused = True
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        self.pending = {}
+
+    def resume(self):
+        self.paused = False
+        for page_number in self.visible_pages():
+            self.update_page(page_number)
+
+    def reset(self):
+        # Called when other files are loaded
+        self.clear()
+        self.canvas.yview_moveto(0)
+        self.redraw()
+
+    def clear(self):
+        # Called when some files changed, page numbers may have moved
+        for future, page_number in self.pending.values():
+            future.cancel()
+        self.pending = {}
+        self.failed = set()
+        self.file_keys = {}
+        self.photos = {}
+        self.current_page = None
+        self.canvas.delete("all")
 
-    def merge_files(self):
-            selected_files = filedialog.askopenfilenames(
-		        filetypes=[("Portable Document Format", ".pdf")]
-	        )
+    def on_scroll(self, *args):
+        self.canvas.yview(*args)
+        self.redraw()
 
-            if selected_files:
-                output_file_path = filedialog.asksaveasfilename(
-		        filetypes=[("Portable Document Format", ".pdf")],
-		        defaultextension=".pdf",
-		    )
+    def on_mouse_wheel(self, event):
+        self.on_scroll("scroll", -1 if event.delta > 0 else 1, "units")
 
-            if output_file_path:
-                merged_pdf_writer = PyPDF2.PdfWriter()
+    def on_click(self, event):
+        column = int(event.x // self.cell_width)
+        page_number = (
+            int(self.canvas.canvasy(event.y) // self.cell_height) * self.columns
+            + column
+        )
+        if column < self.columns and page_number < self.app.num_pages:
+            self.app.current_page = page_number
+            self.app.show_current_page()
+
+    def visible_pages(self):
+        top = self.canvas.canvasy(0)
+        bottom = self.canvas.canvasy(self.canvas.winfo_height())
+        first = int(top // self.cell_height) * self.columns
+        last = (int(bottom // self.cell_height) + 1) * self.columns
+        return range(first, min(last, self.app.num_pages))
+
+    def redraw(self):
+        columns = max(1, self.canvas.winfo_width() // self.cell_width)
+        if columns != self.columns:
+            self.columns = columns
+            self.photos = {}
+            self.canvas.delete("all")
+        rows = -(-self.app.num_pages // columns)
+        self.canvas.configure(
+            scrollregion=(0, 0, columns * self.cell_width, rows * self.cell_height)
+        )
 
-		    # Add pages from the currently opened file
-                current_file_path, current_page_index = self.all_pages[self.current_page]
+        visible = self.visible_pages()
+        for page_number in list(self.photos):
+            if page_number not in visible:
+                del self.photos[page_number]
+                self.canvas.delete(f"page{page_number}")
+        for cache_path, (future, page_number) in list(self.pending.items()):
+            if page_number not in visible and future.cancel():
+                del self.pending[cache_path]
+        for page_number in visible:
+            if page_number not in self.photos:
+                self.draw_page(page_number)
+
+    def update_page(self, page_number):
+        if page_number in self.photos:
+            self.draw_page(page_number)
+
+    def set_current_page(self, page_number):
+        previous_page, self.current_page = self.current_page, page_number
+        if previous_page is not None:
+            self.update_page(previous_page)
+        self.update_page(page_number)
+
+        # Keep the current page in view
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        row = page_number // max(self.columns, 1)
+        rows = -(-self.app.num_pages // max(self.columns, 1))
+        if rows and not top <= row * self.cell_height <= bottom - self.cell_height:
+            self.canvas.yview_moveto(row / rows)
+            self.redraw()
+
+    def thumbnail_source(self, page_number):
+        file_id, page_index = self.app.pages.locate(page_number)
+        file_path = self.app.pages.files[file_id]
+        first_use = file_id not in self.file_keys
+        if first_use:
+            try:
+                self.file_keys[file_id] = index_key(file_path)
+            except OSError:
+                self.file_keys[file_id] = None
+        rotation = self.app.pages.rotation_init(file_id, page_index)
+        cache_path = thumbnail_path(
+            file_path, self.file_keys[file_id], page_index, rotation
+        )
+        if first_use:
+            # Keeps the thumbnails of the file from prune_thumbnails
+            try:
+                os.utime(os.path.dirname(cache_path))
+            except OSError:
+                pass
+        return file_path, page_index, rotation, cache_path
+
+    def load_thumbnail(self, page_number):
+        # Returns the thumbnail from memory or the disk cache, or schedules
+        # its rendering and returns None
+        file_path, page_index, rotation, cache_path = self.thumbnail_source(page_number)
+        img = self.images.get(cache_path)
+        if img is not None:
+            self.images.move_to_end(cache_path)
+            metrics.count("thumbnails.memory")
+            return img
+        if cache_path in self.failed or cache_path in self.pending:
+            return None
+        try:
+            with Image.open(cache_path) as cached_img:
+                img = cached_img.convert("RGB")
+        except OSError:
+            if self.paused:
+                return None
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(THUMBNAIL_WORKERS)
+            future = self.executor.submit(
+                render_thumbnail, file_path, page_index, rotation, cache_path
+            )
+            self.pending[cache_path] = (future, page_number)
+            metrics.count("thumbnails.rendered")
+            if self.poll_job is None:
+                self.poll_job = self.after(
+                    THUMBNAIL_POLL_INTERVAL, self.poll_thumbnails
+                )
+            return None
+        metrics.count("thumbnails.disk")
+        self.images[cache_path] = img
+        while len(self.images) > THUMBNAIL_MEMORY_ITEMS:
+            self.images.popitem(last=False)
+        return img
+
+    def poll_thumbnails(self):
+        self.poll_job = None
+        for cache_path, (future, page_number) in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[cache_path]
+            if future.cancelled():
+                continue
             try:
-                current_pdf_reader = PyPDF2.PdfReader(current_file_path)
-                for page in current_pdf_reader.pages:
-                    merged_pdf_writer.add_page(page)
+                error = future.result()[1]
             except Exception as e:
-                messagebox.showinfo("Error", f"Failed to merge pages from current file: {str(e)}")
-                return
+                error = str(e)
+            if error is not None:
+                self.failed.add(cache_path)
+            if page_number < self.app.num_pages:
+                self.update_page(page_number)
+        if self.pending:
+            self.poll_job = self.after(THUMBNAIL_POLL_INTERVAL, self.poll_thumbnails)
+
+    def draw_page(self, page_number):
+        tag = f"page{page_number}"
+        self.canvas.delete(tag)
+        row, column = divmod(page_number, self.columns)
+        x0 = column * self.cell_width + THUMBNAIL_PADDING / 2
+        y0 = row * self.cell_height + THUMBNAIL_PADDING / 2
+        center_x = x0 + THUMBNAIL_SIZE / 2
+        center_y = y0 + THUMBNAIL_SIZE / 2
+
+        file_id, page_index = self.app.pages.locate(page_number)
+        img = self.load_thumbnail(page_number)
+        if img is None:
+            self.photos[page_number] = None
+            width = height = THUMBNAIL_SIZE * 3 / 4
+            self.canvas.create_rectangle(
+                center_x - width / 2,
+                center_y - height / 2,
+                center_x + width / 2,
+                center_y + height / 2,
+                outline="gray",
+                tags=tag,
+            )
+        else:
+            # Thumbnails are cached at the rotation stored in the file
+            rotation = self.app.pages.rotation(file_id, page_index)
+            rotation_init = self.app.pages.rotation_init(file_id, page_index)
+            if rotation != rotation_init:
+                img = img.rotate(rotation_init - rotation, expand=True)
+            width, height = img.size
+            self.photos[page_number] = ImageTk.PhotoImage(img)
+            self.canvas.create_image(
+                center_x, center_y, image=self.photos[page_number], tags=tag
+            )
 
-		    # Add pages from the selected files
-            for file_path in selected_files:
-                try:
-                    pdf_reader = PyPDF2.PdfReader(file_path)
-                    for page in pdf_reader.pages:
-                        merged_pdf_writer.add_page(page)
-                except Exception as e:
-                    messagebox.showinfo("Error", f"Failed to merge {file_path}: {str(e)}")
-                    continue
+        bbox = (
+            center_x - width / 2,
+            center_y - height / 2,
+            center_x + width / 2,
+            center_y + height / 2,
+        )
+        if self.app.pages.is_deleted(file_id, page_index):
+            self.canvas.create_rectangle(
+                *bbox, outline=DELETED_MARKER_COLOR, width=3, tags=tag
+            )
+            self.canvas.create_line(*bbox, fill=DELETED_MARKER_COLOR, width=3, tags=tag)
+        if page_number == self.current_page:
+            self.canvas.create_rectangle(
+                x0 - 3,
+                y0 - 3,
+                x0 + THUMBNAIL_SIZE + 3,
+                y0 + THUMBNAIL_SIZE + THUMBNAIL_CAPTION_HEIGHT,
+                outline=CURRENT_PAGE_COLOR,
+                width=2,
+                tags=tag,
+            )
+        self.canvas.create_text(
+            center_x,
+            y0 + THUMBNAIL_SIZE + THUMBNAIL_CAPTION_HEIGHT / 2,
+            text=str(page_number + 1),
+            tags=tag,
+        )
 
+
+class FolderScanDialog(simpledialog.Dialog):
+    # Asks which files of a folder tree are loaded. result is a FolderScan,
+    # or None if the dialog was cancelled.
+
+    def __init__(self, parent, folder_path):
+        self.folder_path = folder_path
+        super().__init__(parent, "Load folder tree")
+
+    def body(self, master):
+        tk.Label(
+            master,
+            text=f"PDF files of {self.folder_path} and all its subfolders.\nLeave fields empty to load all of them.",
+            justify=tk.LEFT,
+        ).grid(row=0, columnspan=2, sticky=tk.W, pady=(0, 5))
+        self.entries = []
+        for row, text in enumerate(
+            (
+                "Only paths matching (e.g. 2023/*/*.pdf):",
+                "Modified from (YYYY-MM-DD):",
+                "Modified until (YYYY-MM-DD):",
+            ),
+            1,
+        ):
+            tk.Label(master, text=text).grid(row=row, column=0, sticky=tk.W)
+            entry = tk.Entry(master, width=30)
+            entry.grid(row=row, column=1, padx=5, pady=2)
+            self.entries.append(entry)
+        return self.entries[0]
+
+    def validate(self):
+        self.dates = []
+        for entry in self.entries[1:]:
+            text = entry.get().strip()
+            if not text:
+                self.dates.append(None)
+                continue
             try:
-                with open(output_file_path, "wb") as output_file:
-                    merged_pdf_writer.write(output_file)
-            except Exception as e:
-                messagebox.showinfo("Error", f"Failed to save merged PDF: {str(e)}")
-            else:
-                messagebox.showinfo("Merge Complete", f"PDF files merged successfully: {output_file_path}")
+                self.dates.append(datetime.datetime.strptime(text, "%Y-%m-%d"))
+            except ValueError:
+                messagebox.showinfo(
+                    "Invalid date",
+                    f"{text} is not a date like 2023-12-31.",
+                    parent=self,
+                )
+                return False
+        return True
+
+    def apply(self):
+        modified_after, modified_until = self.dates
+        self.result = FolderScan(
+            self.folder_path,
+            recursive=True,
+            pattern=self.entries[0].get().strip() or None,
+            modified_after=modified_after and modified_after.timestamp(),
+            # The whole last day is included
+            modified_before=modified_until
+            and (modified_until + datetime.timedelta(days=1)).timestamp(),
+        )
+
+
+class MetricsOverlay(tk.Frame):
+    # Debug overlay in the corner of the page view with timings and counters
+    # collected since it was opened or reset
+
+    def __init__(self, app):
+        super().__init__(app.canvas_frame, bg="black", padx=6, pady=4)
+        self.app = app
+        self.label = tk.Label(
+            self,
+            bg="black",
+            fg="#33ff66",
+            font=("Courier", 9),
+            justify=tk.LEFT,
+            anchor=tk.W,
+        )
+        self.label.pack(fill=tk.X)
+        button_frame = tk.Frame(self, bg="black")
+        button_frame.pack(fill=tk.X, pady=(4, 0))
+        tk.Button(button_frame, text="Export...", command=self.export).pack(
+            side=tk.LEFT
+        )
+        tk.Button(button_frame, text="Reset", command=self.reset).pack(
+            side=tk.LEFT, padx=5
+        )
+        tk.Button(button_frame, text="Close", command=self.close).pack(side=tk.RIGHT)
+        self.place(x=8, y=8)
+        self.refresh_job = None
+        self.refresh()
+
+    def refresh(self):
+        snapshot = metrics.snapshot()
+        lines = [f"{'timing':16} {'count':>6} {'p50':>8} {'p95':>8} {'max':>8}"]
+        for name, timing in snapshot["timings"].items():
+            lines.append(
+                f"{name:16} {timing['count']:>6} "
+                + " ".join(
+                    f"{timing[field] * 1000:>6.1f}ms" for field in ("p50", "p95", "max")
+                )
+            )
+        for name, value in snapshot["counters"].items():
+            lines.append(f"{name:23} {value}")
+        if len(lines) == 1:
+            lines.append("No timings yet")
+        self.label.config(text="\n".join(lines))
+        self.refresh_job = self.after(METRICS_OVERLAY_INTERVAL, self.refresh)
+
+    def export(self):
+        file_path = filedialog.asksaveasfilename(
+            filetypes=[("JSON", ".json"), ("CSV", ".csv")],
+            defaultextension=".json",
+        )
+        if not file_path:
+            return
+        try:
+            metrics.export(file_path)
+        except OSError as e:
+            messagebox.showinfo("Error", f"Failed to export timings: {e}")
+
+    def reset(self):
+        metrics.reset()
+
+    def close(self):
+        if self.refresh_job is not None:
+            self.after_cancel(self.refresh_job)
+        # Collection stays on if it was enabled from the start
+        metrics.enabled = METRICS_ENABLED
+        self.app.metrics_overlay = None
+        self.destroy()
+
+
+class BlankPageReview(tk.Toplevel):
+    # Pages marked as deleted by blank page detection. Selecting a page shows
+    # it, pages that should stay can be unmarked here.
+
+    def __init__(self, app, suggestions):
+        super().__init__(app.root)
+        self.app = app
+        self.suggestions = suggestions
+        self.title("Blank pages")
+
+        tk.Label(
+            self,
+            text=f"{len(suggestions)} page(s) look blank and were marked as deleted.",
+            anchor=tk.W,
+        ).pack(fill=tk.X, padx=10, pady=5)
+
+        list_frame = tk.Frame(self)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=10)
+        scrollbar = tk.Scrollbar(list_frame, orient=tk.VERTICAL)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(
+            list_frame,
+            height=20,
+            width=60,
+            selectmode=tk.EXTENDED,
+            yscrollcommand=scrollbar.set,
+        )
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.configure(command=self.listbox.yview)
+        for page_number, score in suggestions:
+            self.listbox.insert(tk.END, self.suggestion_text(page_number, score))
+        self.listbox.bind("<<ListboxSelect>>", self.on_select)
+
+        button_frame = tk.Frame(self)
+        button_frame.pack(fill=tk.X, padx=10, pady=5)
+        tk.Button(button_frame, text="Keep Selected", command=self.keep_selected).pack(
+            side=tk.LEFT
+        )
+        tk.Button(button_frame, text="Done", command=self.close).pack(side=tk.RIGHT)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+    def suggestion_text(self, page_number, score):
+        file_id, page_index = self.app.pages.locate(page_number)
+        file_name = os.path.relpath(
+            self.app.pages.files[file_id], self.app.current_folder
+        )
+        kept = "" if self.app.pages.is_deleted(file_id, page_index) else ", kept"
+        return f"{file_name} page {page_index + 1} (blank score {score:.2f}{kept})"
+
+    def on_select(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.app.current_page = self.suggestions[selection[-1]][0]
+            self.app.show_current_page()
+
+    def keep_selected(self):
+        for row in self.listbox.curselection():
+            page_number, score = self.suggestions[row]
+            file_id, page_index = self.app.pages.locate(page_number)
+            if self.app.pages.is_deleted(file_id, page_index):
+                self.app.toggle_page_deleted(page_number)
+            self.listbox.delete(row)
+            self.listbox.insert(row, self.suggestion_text(page_number, score))
+
+    def close(self):
+        self.app.blank_review = None
+        self.destroy()
+
+
+class RotationReview(tk.Toplevel):
+    # Files with pages whose detected orientation differs from the rotation
+    # stored in the file. Proposals are applied per file or all at once.
+
+    def __init__(self, app, proposals):
+        super().__init__(app.root)
+        self.app = app
+        self.proposals = proposals
+        self.accepted = set()
+        self.title("Rotations")
+
+        tk.Label(
+            self,
+            text=f"Pages in {len(proposals)} file(s) seem to be rotated.",
+            anchor=tk.W,
+        ).pack(fill=tk.X, padx=10, pady=5)
+
+        list_frame = tk.Frame(self)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=10)
+        scrollbar = tk.Scrollbar(list_frame, orient=tk.VERTICAL)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(
+            list_frame,
+            height=20,
+            width=70,
+            selectmode=tk.EXTENDED,
+            yscrollcommand=scrollbar.set,
+        )
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.configure(command=self.listbox.yview)
+        for row in range(len(proposals)):
+            self.listbox.insert(tk.END, self.proposal_text(row))
+        self.listbox.bind("<<ListboxSelect>>", self.on_select)
+
+        button_frame = tk.Frame(self)
+        button_frame.pack(fill=tk.X, padx=10, pady=5)
+        tk.Button(
+            button_frame, text="Accept Selected", command=self.accept_selected
+        ).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="Accept All", command=self.accept_all).pack(
+            side=tk.LEFT, padx=5
+        )
+        tk.Button(button_frame, text="Done", command=self.close).pack(side=tk.RIGHT)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+    def proposal_text(self, row):
+        file_id, file_proposals = self.proposals[row]
+        file_name = os.path.relpath(
+            self.app.pages.files[file_id], self.app.current_folder
+        )
+        confidence = min(proposal[2] for proposal in file_proposals)
+        accepted = ", accepted" if row in self.accepted else ""
+        return f"{file_name}: {len(file_proposals)} page(s) (confidence from {confidence:.2f}{accepted})"
+
+    def on_select(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            file_id, file_proposals = self.proposals[selection[-1]]
+            self.app.current_page = (
+                self.app.pages.starts[file_id] + file_proposals[0][0]
+            )
+            self.app.show_current_page()
+
+    def accept(self, rows):
+        for row in rows:
+            if row in self.accepted:
+                continue
+            self.accepted.add(row)
+            self.app.apply_rotations(*self.proposals[row])
+            self.listbox.delete(row)
+            self.listbox.insert(row, self.proposal_text(row))
+
+    def accept_selected(self):
+        self.accept(self.listbox.curselection())
+
+    def accept_all(self):
+        self.accept(range(len(self.proposals)))
+
+    def close(self):
+        self.app.rotation_review = None
+        self.destroy()
+
 
 class CustomMessageBox(tk.Toplevel):
     def __init__(self, title, message, hyperlinks=None):
@@ -552,5 +2239,25 @@ def show_custom_message_box(title, message, hyperlinks=None):
     CustomMessageBox(title, message, hyperlinks).wait_window()
 
 
+def format_size(size):
+    for unit in ("bytes", "KB", "MB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "GB"
+    return f"{size:.0f} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+
+
+def size_change_text(bytes_before, bytes_after):
+    text = f"{format_size(bytes_before)} -> {format_size(bytes_after)}"
+    if bytes_before:
+        text += f" ({(bytes_after - bytes_before) / bytes_before:+.0%})"
+    return text
+
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        sys.exit(engine_main(sys.argv[1:]))
     app = PDFEditorApp()
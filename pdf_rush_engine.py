@@ -0,0 +1,1984 @@
+# Copyright (c) 2023, Timur Moziev
+# All rights reserved.
+
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Editing core of PDF Rush without any UI: page table, document pool, folder
+# indexing, rendering and saving. Run it directly to apply edit manifests or
+# merge files in batch, see main().
+
+import sys, os
+import argparse
+import bisect
+import contextlib
+import copy
+import csv
+import fnmatch
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import re
+import shutil
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import fitz
+import numpy
+from PIL import Image
+
+# Memory budget for rendered page images, in bytes
+RENDER_CACHE_BUDGET = 256 * 1024 * 1024
+# Zoomed pages are rendered in square tiles of this many pixels, only the
+# visible ones
+TILE_SIZE = 256
+# Memory budget for rendered tiles of zoomed pages, in bytes
+TILE_CACHE_BUDGET = 64 * 1024 * 1024
+# How many PDF documents are kept open between page views
+MAX_OPEN_DOCUMENTS = 16
+# How many pages keep their display list for rendering tiles, so tiles don't
+# interpret the page contents again
+MAX_DISPLAY_LISTS = 4
+# Images of a page with a display list are decoded whole up to this many
+# pixels in total, larger ones are decoded again by every tile
+MAX_PREDECODE_PIXELS = 16 * 1024 * 1024
+# Folders with fewer files are indexed without starting worker processes
+PARALLEL_INDEX_MIN_FILES = 4
+# Worker processes used to index a folder, None means one per CPU
+INDEX_WORKERS = None
+# How many files are sent to an index worker at once
+INDEX_CHUNK_SIZE = 8
+# Files found by a folder scan are indexed in batches of at most this many,
+# or of the files found in INDEX_STREAM_LATENCY seconds, so the first pages
+# show while the rest of the tree is still being scanned
+INDEX_STREAM_CHUNK = 512
+INDEX_STREAM_LATENCY = 0.2
+# Folder edited files are saved to, it is never scanned for files to load
+OUTPUT_FOLDER_NAME = "_pdf_rush"
+# Saves of fewer files are done without starting worker processes. A save
+# in this process holds fitz_lock and stalls rendering for the whole file, so
+# the app saves even one file in a worker process.
+PARALLEL_SAVE_MIN_FILES = 1
+# Worker processes used to save files, None means one per CPU
+SAVE_WORKERS = None
+# Save rotation-only edits as an incremental update appended to the file
+INCREMENTAL_SAVE = True
+# JPEG quality of page images recompressed by size optimization
+OPTIMIZE_IMAGE_QUALITY = 75
+# Images are downsampled only when they are this much sharper than the target
+# resolution, and replaced only when the new image is this much smaller
+OPTIMIZE_DPI_TOLERANCE = 1.2
+OPTIMIZE_MIN_SAVING = 0.1
+# Smaller images, e.g. logos and icons, are left as they are
+OPTIMIZE_MIN_IMAGE_PIXELS = 128 * 128
+# Size optimization of a file spreads its images over worker processes when
+# it has at least this many, in chunks of this many images per worker
+PARALLEL_OPTIMIZE_MIN_IMAGES = 4
+OPTIMIZE_CHUNK_SIZE = 4
+# Worker processes used to recompress images, None means one per CPU
+OPTIMIZE_WORKERS = None
+# Bump when the format of cached folder indexes changes
+INDEX_CACHE_VERSION = 1
+# Also compare a hash of the head and tail of each file, not only size and mtime
+INDEX_CACHE_HASH = False
+INDEX_CACHE_HASH_BYTES = 64 * 1024
+# Merges of fewer files are validated without starting worker processes
+PARALLEL_MERGE_MIN_FILES = 8
+# Worker processes used to validate merged files, None means one per CPU
+MERGE_WORKERS = None
+# How many files are sent to a validation worker at once
+MERGE_CHUNK_SIZE = 8
+# Bytes of copied pages kept in memory before a merge is written to disk
+MERGE_MEMORY_BUDGET = 128 * 1024 * 1024
+# Object references in the source MuPDF prints for an object. Strings are
+# matched too so references inside them are left alone, MuPDF escapes
+# parentheses in strings.
+PDF_REFERENCE = re.compile(r"\((?:\\.|[^\\()])*\)|(?<![\w/#.])(\d+) \d+ R")
+# Longest side of overview thumbnails, in pixels
+THUMBNAIL_SIZE = 160
+# JPEG quality of thumbnails stored in the user cache directory
+THUMBNAIL_QUALITY = 80
+# Worker processes used to render thumbnails, None means one per CPU
+THUMBNAIL_WORKERS = None
+# Disk space of the thumbnail cache, thumbnails of the least recently shown
+# files are removed past it
+THUMBNAIL_CACHE_BUDGET = 256 * 1024 * 1024
+# Longest side of pages rendered for blank page detection, in pixels
+BLANK_ANALYSIS_SIZE = 200
+# Share of each side left out of blank page detection, scanners leave dark
+# edges and punch holes there
+BLANK_MARGIN = 0.05
+# Pixels differing more than this from the paper color count as ink
+BLANK_INK_CONTRAST = 64
+# Pages with this share of ink or this standard deviation of pixel values
+# get a blank score of 0
+BLANK_INK_COVERAGE_LIMIT = 0.002
+BLANK_DEVIATION_LIMIT = 4.0
+# Pages with at least this blank score are suggested for deletion
+BLANK_SCORE_THRESHOLD = 0.7
+# How many pages are sent to a blank page detection worker at once
+BLANK_PAGES_PER_JOB = 32
+# Worker processes used for blank page detection, None means one per CPU
+BLANK_WORKERS = None
+# Longest side of scans rendered for orientation detection, in pixels. Text
+# lines have to be a few pixels high for their shape to show.
+ORIENTATION_ANALYSIS_SIZE = 1200
+# Pages with less text are checked as scans, even if they have a text layer
+ORIENTATION_MIN_TEXT_CHARS = 50
+# Pages with less ink than this share are not checked
+ORIENTATION_MIN_INK = 0.001
+# Rows and columns with less ink than this share are cropped from the edges of
+# the text block, empty margins would otherwise make every profile look striped
+ORIENTATION_CROP_INK = 0.01
+# Difference between ink above and below text lines that gives confidence 1
+ORIENTATION_BALANCE_SCALE = 0.25
+# Proposals with less confidence are not offered
+ORIENTATION_MIN_CONFIDENCE = 0.5
+# How many pages are sent to an orientation detection worker at once
+ORIENTATION_PAGES_PER_JOB = 16
+# Worker processes used for orientation detection, None means one per CPU
+ORIENTATION_WORKERS = None
+# Collect timings and counters of hot paths from the start, see Metrics
+METRICS_ENABLED = bool(os.environ.get("PDF_RUSH_METRICS"))
+# Upper bounds of the latency histogram buckets, 0.1 ms to 13 s, in seconds
+METRICS_BUCKETS = tuple(0.0001 * 2**i for i in range(18))
+
+# PyMuPDF is not thread-safe, every fitz call has to hold this lock
+fitz_lock = threading.RLock()
+
+
+class Metrics:
+    # Latency histograms and counters of hot paths. While disabled, timer()
+    # returns a shared no-op context and count() returns right away, so
+    # instrumented code costs a method call.
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+
+    def timer(self, name):
+        if not self.enabled:
+            return null_timer
+        return MetricsTimer(self, name)
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "buckets": [0] * (len(METRICS_BUCKETS) + 1),
+                }
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+            timing["buckets"][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+    def snapshot(self):
+        with self.lock:
+            timings = {
+                name: {
+                    "count": timing["count"],
+                    "total": timing["total"],
+                    "mean": timing["total"] / timing["count"],
+                    "p50": percentile(timing, 0.5),
+                    "p95": percentile(timing, 0.95),
+                    "max": timing["max"],
+                    # Upper bound of the last bucket is None, it has no limit
+                    "buckets": [
+                        [bound, count]
+                        for bound, count in zip(
+                            METRICS_BUCKETS + (None,), timing["buckets"]
+                        )
+                        if count
+                    ],
+                }
+                for name, timing in sorted(self.timings.items())
+            }
+            return {"timings": timings, "counters": dict(sorted(self.counters.items()))}
+
+    def export(self, path):
+        # Writes CSV for a .csv path and JSON otherwise
+        snapshot = self.snapshot()
+        if path.lower().endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(
+                    ["kind", "name", "count", "total", "mean", "p50", "p95", "max"]
+                )
+                for name, timing in snapshot["timings"].items():
+                    writer.writerow(
+                        ["timing", name]
+                        + [
+                            timing[field]
+                            for field in ("count", "total", "mean", "p50", "p95", "max")
+                        ]
+                    )
+                for name, value in snapshot["counters"].items():
+                    writer.writerow(["counter", name, value])
+        else:
+            snapshot["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            with open(path, "w") as f:
+                json.dump(snapshot, f, indent=2)
+
+
+class MetricsTimer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+
+
+null_timer = contextlib.nullcontext()
+
+
+def percentile(timing, fraction):
+    # Upper bound of the bucket holding the fraction-th timing, never more
+    # than the slowest one
+    rank = fraction * timing["count"]
+    seen = 0
+    for bound, count in zip(METRICS_BUCKETS, timing["buckets"]):
+        seen += count
+        if seen >= rank:
+            return min(bound, timing["max"])
+    return timing["max"]
+
+
+# Timings of this process. Work done in worker processes is recorded from
+# the results they send back.
+metrics = Metrics(METRICS_ENABLED)
+
+
+def image_size(img):
+    return img.width * img.height * len(img.getbands())
+
+
+def file_signature(file_path):
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class DocumentPool:
+    # Documents are used and closed only while fitz_lock is held. The Tk
+    # thread must not wait for fitz_lock behind a render or a merge, so
+    # invalidate, unblock and close_all take only the pool lock and leave the
+    # documents to be closed by the next get.
+    def __init__(self, max_documents):
+        self.max_documents = max_documents
+        self.documents = OrderedDict()
+        self.display_lists = OrderedDict()
+        self.blocked = set()
+        self.closing = []
+        self.lock = threading.Lock()
+
+    def get(self, file_path):
+        signature = file_signature(file_path)
+        with fitz_lock:
+            self.close_pending()
+            with self.lock:
+                if file_path in self.blocked:
+                    raise BlockingIOError(f"{file_path} is being saved")
+                entry = self.documents.pop(file_path, None)
+                if entry is not None:
+                    if entry[0] == signature:
+                        self.documents[file_path] = entry
+                        metrics.count("documents.reused")
+                        return entry[1]
+                    self.closing.append(entry[1])
+            metrics.count("documents.opened")
+            with metrics.timer("fitz.open"):
+                doc = fitz.open(file_path)
+            with self.lock:
+                self.documents[file_path] = (signature, doc)
+                while len(self.documents) > self.max_documents:
+                    _, (_, evicted_doc) = self.documents.popitem(last=False)
+                    self.closing.append(evicted_doc)
+            self.close_pending()
+            return doc
+
+    def display_list(self, file_path, page_index):
+        # Returns the display list of a page and the rotation of the page
+        with fitz_lock:
+            doc = self.get(file_path)
+            with self.lock:
+                entry = self.display_lists.pop((file_path, page_index), None)
+            # Display lists of a document that was opened again are stale
+            if entry is None or entry[0] is not doc:
+                page = doc.load_page(page_index)
+                with metrics.timer("render.display_list"):
+                    # Each image decoded once as a whole stays in MuPDF's
+                    # store for the tiles, else every tile decodes its part
+                    # of a scan from the top of the image
+                    pixels = 0
+                    for image in page.get_images():
+                        if pixels + image[2] * image[3] > MAX_PREDECODE_PIXELS:
+                            continue
+                        pixels += image[2] * image[3]
+                        try:
+                            fitz.Pixmap(doc, image[0])
+                        except RuntimeError:
+                            pass
+                    entry = (doc, page.get_displaylist(), page.rotation)
+            with self.lock:
+                self.display_lists[(file_path, page_index)] = entry
+                while len(self.display_lists) > MAX_DISPLAY_LISTS:
+                    self.display_lists.popitem(last=False)
+            return entry[1:]
+
+    def close_pending(self):
+        # Closes the documents given up by the other methods, callers hold
+        # fitz_lock
+        with self.lock:
+            closing, self.closing = self.closing, []
+        for doc in closing:
+            doc.close()
+
+    def block(self, file_paths):
+        # Closes file_paths and keeps them closed until unblock. Files are
+        # replaced by rename, which fails on Windows while they are open.
+        # Waits for fitz_lock, so tasks call it rather than the Tk thread.
+        with self.lock:
+            self.blocked.update(file_paths)
+            for file_path in file_paths:
+                self.drop(file_path)
+        with fitz_lock:
+            self.close_pending()
+
+    def unblock(self, file_paths):
+        with self.lock:
+            self.blocked.difference_update(file_paths)
+
+    def invalidate(self, file_path):
+        with self.lock:
+            self.drop(file_path)
+
+    def drop(self, file_path):
+        # Callers hold the pool lock
+        entry = self.documents.pop(file_path, None)
+        if entry is not None:
+            self.closing.append(entry[1])
+        for key in [key for key in self.display_lists if key[0] == file_path]:
+            del self.display_lists[key]
+
+    def close_all(self):
+        with self.lock:
+            self.closing += [doc for _, doc in self.documents.values()]
+            self.documents.clear()
+            self.display_lists.clear()
+
+
+class PageTable:
+    # Pages of all loaded files. Files are interned to ids, rotations are kept
+    # as quarter turns in one byte per page, deletions as bits, and global page
+    # numbers are mapped to files through prefix sums of page counts.
+
+    def __init__(self):
+        self.files = []
+        self.file_ids = {}
+        self.starts = array("q")
+        self.rotations = []
+        self.rotations_init = []
+        self.deleted = []
+        self.rotated_count = array("l")
+        self.deleted_count = array("l")
+        self.num_pages = 0
+
+    def __len__(self):
+        return self.num_pages
+
+    def add_file(self, file_path, rotations):
+        file_id = len(self.files)
+        self.files.append(file_path)
+        self.file_ids[file_path] = file_id
+        self.starts.append(self.num_pages)
+        quarter_turns = bytearray(rotation // 90 % 4 for rotation in rotations)
+        self.rotations.append(bytearray(quarter_turns))
+        self.rotations_init.append(quarter_turns)
+        self.deleted.append(bytearray((len(rotations) + 7) // 8))
+        self.rotated_count.append(0)
+        self.deleted_count.append(0)
+        self.num_pages += len(rotations)
+        return file_id
+
+    def locate(self, page_number):
+        file_id = bisect.bisect_right(self.starts, page_number) - 1
+        return file_id, page_number - self.starts[file_id]
+
+    def page(self, page_number):
+        file_id, page_index = self.locate(page_number)
+        return self.files[file_id], page_index
+
+    def page_count(self, file_id):
+        return len(self.rotations[file_id])
+
+    def rotation(self, file_id, page_index):
+        return self.rotations[file_id][page_index] * 90
+
+    def rotation_init(self, file_id, page_index):
+        return self.rotations_init[file_id][page_index] * 90
+
+    def file_rotations(self, file_id):
+        return [quarter_turns * 90 for quarter_turns in self.rotations[file_id]]
+
+    def file_rotations_init(self, file_id):
+        return [quarter_turns * 90 for quarter_turns in self.rotations_init[file_id]]
+
+    def rotate(self, file_id, page_index, degree):
+        rotations = self.rotations[file_id]
+        init = self.rotations_init[file_id][page_index]
+        was_rotated = rotations[page_index] != init
+        rotations[page_index] = (rotations[page_index] + degree // 90) % 4
+        self.rotated_count[file_id] += (rotations[page_index] != init) - was_rotated
+
+    def is_deleted(self, file_id, page_index):
+        return bool(self.deleted[file_id][page_index >> 3] & (1 << (page_index & 7)))
+
+    def file_deleted(self, file_id):
+        return {
+            page_index
+            for page_index in range(self.page_count(file_id))
+            if self.is_deleted(file_id, page_index)
+        }
+
+    def toggle_deleted(self, file_id, page_index):
+        # Bits past the last page would pass for deleted pages in file_deleted
+        if not 0 <= page_index < self.page_count(file_id):
+            raise IndexError(f"page index {page_index} is out of range")
+        self.deleted[file_id][page_index >> 3] ^= 1 << (page_index & 7)
+        self.deleted_count[file_id] += 1 if self.is_deleted(file_id, page_index) else -1
+
+    def has_changes(self, file_id):
+        return self.rotated_count[file_id] > 0 or self.deleted_count[file_id] > 0
+
+    def changed_files(self):
+        return [
+            file_id for file_id in range(len(self.files)) if self.has_changes(file_id)
+        ]
+
+    def changes_text(self, file_id, folder_path):
+        # Row of the unsaved changes list
+        file_name = os.path.relpath(self.files[file_id], folder_path)
+        return f"{file_name} (rot {self.rotated_count[file_id]}, del {self.deleted_count[file_id]})"
+
+    def update_files(self, file_rotations):
+        # Replaces the pages of the files in file_rotations, which drops their
+        # edits, and removes files mapped to None. Files that were not loaded
+        # are added at the end. Other files keep their edits. Returns the new
+        # id of every old file id, None for removed files.
+        old = copy.copy(self)
+        self.__init__()
+        new_ids = []
+        for file_id, file_path in enumerate(old.files):
+            if file_path in file_rotations:
+                if file_rotations[file_path] is None:
+                    new_ids.append(None)
+                else:
+                    new_ids.append(self.add_file(file_path, file_rotations[file_path]))
+                continue
+            new_ids.append(len(self.files))
+            self.file_ids[file_path] = len(self.files)
+            self.files.append(file_path)
+            self.starts.append(self.num_pages)
+            self.rotations.append(old.rotations[file_id])
+            self.rotations_init.append(old.rotations_init[file_id])
+            self.deleted.append(old.deleted[file_id])
+            self.rotated_count.append(old.rotated_count[file_id])
+            self.deleted_count.append(old.deleted_count[file_id])
+            self.num_pages += len(old.rotations[file_id])
+        for file_path, rotations in file_rotations.items():
+            if rotations is not None and file_path not in self.file_ids:
+                self.add_file(file_path, rotations)
+        return new_ids
+
+
+def user_cache_dir():
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "pdf-rush")
+
+
+def write_json_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+
+def index_key(file_path):
+    stat = os.stat(file_path)
+    key = [stat.st_size, stat.st_mtime_ns]
+    if INDEX_CACHE_HASH:
+        content_hash = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            content_hash.update(f.read(INDEX_CACHE_HASH_BYTES))
+            if stat.st_size > INDEX_CACHE_HASH_BYTES:
+                f.seek(-INDEX_CACHE_HASH_BYTES, os.SEEK_END)
+                content_hash.update(f.read(INDEX_CACHE_HASH_BYTES))
+        key.append(content_hash.hexdigest())
+    return key
+
+
+class FolderIndex:
+    # Page rotations of every file in a folder, stored in the user cache
+    # directory and reused for files whose index key did not change. Safe to
+    # share between threads, save only holds the lock to copy the entries.
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        folder_hash = hashlib.sha1(os.path.abspath(folder_path).encode()).hexdigest()
+        self.path = os.path.join(user_cache_dir(), "index", f"{folder_hash}.json")
+        self.files = {}
+        self.changed = False
+        self.pruned = False
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == INDEX_CACHE_VERSION:
+                self.files = data["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def lookup(self, file_path, key):
+        entry = self.files.get(os.path.relpath(file_path, self.folder_path))
+        if entry is None or entry["key"] != key:
+            return None
+        return entry.get("rotations") or [0] * entry["pages"]
+
+    def store(self, file_path, key, rotations):
+        entry = {"key": key, "pages": len(rotations)}
+        if any(rotations):
+            entry["rotations"] = rotations
+        with self.lock:
+            self.files[os.path.relpath(file_path, self.folder_path)] = entry
+            self.changed = True
+
+    def remove(self, file_path):
+        with self.lock:
+            if self.files.pop(os.path.relpath(file_path, self.folder_path), None):
+                self.changed = True
+
+    def lookup_rotations(self, file_path, key):
+        entry = self.files.get(os.path.relpath(file_path, self.folder_path))
+        if entry is None or entry["key"] != key:
+            return None
+        return entry.get("proposed_rotations")
+
+    def store_rotations(self, file_path, key, proposals):
+        # Proposals are dropped with the rest of the entry once the file changes
+        with self.lock:
+            entry = self.files.get(os.path.relpath(file_path, self.folder_path))
+            if entry is not None and entry["key"] == key:
+                entry["proposed_rotations"] = proposals
+                self.changed = True
+
+    def prune(self):
+        # Drops entries of files removed while the folder was not loaded, the
+        # app removes the ones it sees go. Stats every entry, so save does it
+        # once per index.
+        self.pruned = True
+        with self.lock:
+            names = list(self.files)
+        for name in names:
+            if not os.path.exists(os.path.join(self.folder_path, name)):
+                with self.lock:
+                    self.files.pop(name, None)
+                    self.changed = True
+
+    def save(self):
+        if not self.pruned:
+            self.prune()
+        with self.save_lock:
+            with self.lock:
+                if not self.changed:
+                    return
+                files = {name: dict(entry) for name, entry in self.files.items()}
+                self.changed = False
+            try:
+                write_json_atomic(
+                    self.path, {"version": INDEX_CACHE_VERSION, "files": files}
+                )
+            except OSError:
+                # The index is only a cache, the folder is parsed again next time
+                with self.lock:
+                    self.changed = True
+
+
+def save_folder_index(folder_index, results, cancel):
+    # Task target, writing the index of a large folder takes a while
+    folder_index.save()
+    results.put(None)
+
+
+def read_page_rotations(doc):
+    return [page.rotation for page in doc]
+
+
+def index_pdf(file_path):
+    try:
+        with fitz.open(file_path) as doc:
+            return read_page_rotations(doc), None
+    except Exception as e:
+        return None, str(e)
+
+
+def index_pooled_pdf(doc_pool, file_path):
+    try:
+        with fitz_lock:
+            return read_page_rotations(doc_pool.get(file_path)), None
+    except Exception as e:
+        return None, str(e)
+
+
+def stream_chunks(items, cancel):
+    # Batches of items for INDEX_STREAM_CHUNK and INDEX_STREAM_LATENCY. items
+    # are taken on another thread, so a slow generator, e.g. a folder scan
+    # over a network share, never holds back items it has already yielded.
+    if isinstance(items, list):
+        for start in range(0, len(items), INDEX_STREAM_CHUNK):
+            yield items[start : start + INDEX_STREAM_CHUNK]
+        return
+
+    found = deque()
+    arrived = threading.Event()
+    end = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in items:
+                if cancel.is_set():
+                    return
+                found.append(item)
+                if not arrived.is_set():
+                    arrived.set()
+        except Exception as e:
+            errors.append(e)
+        found.append(end)
+        arrived.set()
+
+    threading.Thread(target=produce, daemon=True).start()
+    chunk = []
+    deadline = None
+    while not cancel.is_set():
+        if chunk and (len(chunk) == INDEX_STREAM_CHUNK or time.monotonic() >= deadline):
+            yield chunk
+            chunk = []
+            continue
+        if not found:
+            # Checked again after clearing, an item added since sets it again
+            arrived.clear()
+            if not found:
+                arrived.wait(
+                    0.1 if not chunk else min(0.1, deadline - time.monotonic())
+                )
+        while found and len(chunk) < INDEX_STREAM_CHUNK:
+            item = found.popleft()
+            if item is end:
+                if chunk:
+                    yield chunk
+                if errors:
+                    raise errors[0]
+                return
+            if not chunk:
+                deadline = time.monotonic() + INDEX_STREAM_LATENCY
+            chunk.append(item)
+
+
+def index_files(file_paths, doc_pool, folder_index, results, cancel):
+    # Puts (file_path, rotations, key, error) into results in file_paths order
+    # and None when finished. file_paths may be a generator, files are indexed
+    # in batches while it runs. Only files missing from folder_index are opened.
+    start = time.perf_counter()
+    executor = None
+    try:
+        for chunk in stream_chunks(file_paths, cancel):
+            if cancel.is_set():
+                break
+            keys = {}
+            cached = {}
+            for file_path in chunk:
+                try:
+                    keys[file_path] = index_key(file_path)
+                except OSError:
+                    keys[file_path] = None
+                cached[file_path] = folder_index.lookup(file_path, keys[file_path])
+            misses = [file_path for file_path in chunk if cached[file_path] is None]
+            metrics.count("index.cached", len(chunk) - len(misses))
+            metrics.count("index.parsed", len(misses))
+
+            if executor is None and len(misses) < PARALLEL_INDEX_MIN_FILES:
+                miss_results = (index_pooled_pdf(doc_pool, f) for f in misses)
+            else:
+                if executor is None:
+                    executor = ProcessPoolExecutor(INDEX_WORKERS)
+                miss_results = executor.map(
+                    index_pdf, misses, chunksize=INDEX_CHUNK_SIZE
+                )
+            for file_path in chunk:
+                if cancel.is_set():
+                    break
+                rotations, error = cached[file_path], None
+                if rotations is None:
+                    rotations, error = next(miss_results)
+                    if error is not None:
+                        metrics.count("index.failed")
+                    elif keys[file_path] is not None:
+                        folder_index.store(file_path, keys[file_path], rotations)
+                results.put((file_path, rotations, keys[file_path], error))
+        if not cancel.is_set():
+            folder_index.save()
+            metrics.record("index.folder", time.perf_counter() - start)
+    except Exception as e:
+        results.put((None, None, None, str(e)))
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    results.put(None)
+
+
+class FolderScan:
+    # PDF files of a folder, and with recursive of all its subfolders except
+    # output folders. pattern is a glob matched against paths relative to the
+    # folder with / separators, e.g. "2023/*/*.pdf" or "*invoice*";
+    # modified_after and modified_before are timestamps. Subfolders are
+    # walked depth-first in name order and files are yielded as they are
+    # found, so loading can start before the scan ends. The modification
+    # time and subfolders of each folder are kept, see iter_new_files.
+
+    def __init__(
+        self,
+        folder_path,
+        recursive=False,
+        pattern=None,
+        modified_after=None,
+        modified_before=None,
+    ):
+        self.folder_path = folder_path
+        self.recursive = recursive
+        self.pattern = pattern
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+        self.folders = {}
+
+    def iter_files(self):
+        self.folders = {}
+        return self.walk(None)
+
+    def iter_new_files(self, known_files):
+        # Files not in known_files. Adding, removing or renaming a file
+        # changes the modification time of its folder, so only folders whose
+        # time changed since the last scan are listed again, the others
+        # cost one stat.
+        return self.walk(known_files)
+
+    def walk(self, known_files):
+        pending_folders = [self.folder_path]
+        while pending_folders:
+            folder_path = pending_folders.pop()
+            try:
+                # Taken before listing, a file added meanwhile is found next time
+                modified = os.stat(folder_path).st_mtime_ns
+            except OSError:
+                self.folders.pop(folder_path, None)
+                continue
+            known_folder = self.folders.get(folder_path)
+            if (
+                known_files is not None
+                and known_folder is not None
+                and known_folder[0] == modified
+            ):
+                pending_folders.extend(reversed(known_folder[1]))
+                continue
+            try:
+                with os.scandir(folder_path) as scan:
+                    entries = sorted(scan, key=lambda entry: entry.name)
+            except OSError:
+                # Unreadable folders are skipped like in a file manager
+                continue
+            subfolders = []
+            file_paths = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.recursive and entry.name != OUTPUT_FOLDER_NAME:
+                            subfolders.append(entry.path)
+                    elif entry.name.lower().endswith(".pdf") and self.matches(entry):
+                        file_paths.append(entry.path)
+                except OSError:
+                    continue
+            self.folders[folder_path] = (modified, subfolders)
+            for file_path in file_paths:
+                if known_files is None or file_path not in known_files:
+                    yield file_path
+            pending_folders.extend(reversed(subfolders))
+
+    def matches(self, entry):
+        if self.pattern is not None:
+            relative_path = os.path.relpath(entry.path, self.folder_path)
+            if not fnmatch.fnmatch(relative_path.replace(os.sep, "/"), self.pattern):
+                return False
+        if self.modified_after is None and self.modified_before is None:
+            return True
+        modified = entry.stat().st_mtime
+        if self.modified_after is not None and modified < self.modified_after:
+            return False
+        if self.modified_before is not None and modified >= self.modified_before:
+            return False
+        return True
+
+
+def refresh_files(file_keys, folder_scan, doc_pool, folder_index, results, cancel):
+    # Stat-based rescan of loaded files, file_keys maps each of them to its
+    # index key. Puts (file_path, None, None, None) for files that are gone,
+    # then indexes files whose key changed and, unless folder_scan is None,
+    # files new in folder_scan like index_files does. Only folders changed
+    # since the last scan are listed, see FolderScan.iter_new_files.
+    try:
+        file_paths = list(file_keys)
+        if folder_scan is not None:
+            file_paths += folder_scan.iter_new_files(file_keys)
+        changed = []
+        for file_path in file_paths:
+            if cancel.is_set():
+                break
+            try:
+                key = index_key(file_path)
+            except OSError:
+                if not os.path.exists(file_path):
+                    folder_index.remove(file_path)
+                    results.put((file_path, None, None, None))
+                    continue
+                key = None
+            if file_path not in file_keys or key != file_keys[file_path]:
+                changed.append(file_path)
+        metrics.count("refresh.changed", len(changed))
+    except Exception as e:
+        results.put((None, None, None, str(e)))
+        results.put(None)
+        return
+    index_files(changed, doc_pool, folder_index, results, cancel)
+
+
+def save_pdf_atomic(doc, target_path, **save_options):
+    # A crash while saving leaves only the temp file behind, never a
+    # half-written target
+    temp_path = f"{target_path}.{os.getpid()}.tmp"
+    try:
+        doc.save(temp_path, **save_options)
+        with open(temp_path, "rb+") as f:
+            os.fsync(f.fileno())
+        if os.path.exists(target_path):
+            shutil.copymode(target_path, temp_path)
+        os.replace(temp_path, target_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def fsync_file(path):
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+def save_rotations_incremental(file_path, target_path, rotations):
+    # Appends an update with only the rotated page objects instead of writing
+    # the whole document again. Returns False if the document can't be
+    # updated incrementally, e.g. because MuPDF had to repair it.
+    in_place = os.path.abspath(target_path) == os.path.abspath(file_path)
+    if in_place:
+        work_path = file_path
+    else:
+        work_path = f"{target_path}.{os.getpid()}.tmp"
+        shutil.copyfile(file_path, work_path)
+    original_size = os.path.getsize(work_path)
+    try:
+        with fitz.open(work_path) as doc:
+            if not doc.can_save_incrementally():
+                return False
+            for i, page in enumerate(doc):
+                if page.rotation != rotations[i]:
+                    page.set_rotation(rotations[i])
+            doc.save(work_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        fsync_file(work_path)
+        if not in_place:
+            os.replace(work_path, target_path)
+        return True
+    except BaseException:
+        if in_place:
+            # Cut off the partially appended update, the original bytes are
+            # never touched
+            with open(work_path, "rb+") as f:
+                f.truncate(original_size)
+        raise
+    finally:
+        if not in_place and os.path.exists(work_path):
+            os.remove(work_path)
+
+
+def image_tasks(doc, image_dpi, image_quality):
+    # Lists (xref, width, height) of the images of doc worth recompressing,
+    # with the size they are scaled to. Images that aren't plain gray or RGB
+    # pictures, like masks, line art and transparent images, are skipped.
+    images = {}
+    for page in doc:
+        for xref, smask, width, height, bpc, _, _, _, image_filter in (
+            image[:9] for image in page.get_images(full=True)
+        ):
+            if (
+                smask
+                or bpc != 8
+                or width * height < OPTIMIZE_MIN_IMAGE_PIXELS
+                or image_filter in ("JBIG2Decode", "CCITTFaxDecode", "JPXDecode")
+            ):
+                continue
+            shown_size = images.setdefault(xref, [width, height, 0])
+            if image_dpi:
+                # Pages show an image at least as large as its biggest copy
+                for rect in page.get_image_rects(xref):
+                    shown_size[2] = max(shown_size[2], rect.width, rect.height)
+
+    tasks = []
+    for xref, (width, height, shown_size) in images.items():
+        if any(
+            doc.xref_get_key(xref, key)[0] != "null"
+            for key in ("Decode", "Mask", "ImageMask")
+        ):
+            continue
+        scale = 1
+        if image_dpi and shown_size:
+            scale = image_dpi / (max(width, height) * 72 / shown_size)
+            if scale * OPTIMIZE_DPI_TOLERANCE >= 1:
+                scale = 1
+        if scale == 1 and not image_quality:
+            continue
+        tasks.append(
+            (xref, max(1, round(width * scale)), max(1, round(height * scale)))
+        )
+    return tasks
+
+
+def recompress_image(data, width, height, quality):
+    # Decodes an extracted image, scales it to width x height and encodes it
+    # as JPEG. Returns (jpeg, grayscale) or None if the image doesn't suit JPEG.
+    with Image.open(io.BytesIO(data)) as img:
+        if img.mode == "L":
+            img.load()
+        elif img.mode in ("RGB", "P"):
+            img = img.convert("RGB")
+        else:
+            return None
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.LANCZOS)
+        output = io.BytesIO()
+        img.save(output, "JPEG", quality=quality, optimize=True)
+        return output.getvalue(), img.mode == "L"
+
+
+def replace_image_stream(doc, xref, jpeg, width, height, grayscale):
+    doc.update_stream(xref, jpeg, compress=False)
+    doc.xref_set_key(xref, "Filter", "/DCTDecode")
+    doc.xref_set_key(xref, "DecodeParms", "null")
+    doc.xref_set_key(xref, "Width", str(width))
+    doc.xref_set_key(xref, "Height", str(height))
+    doc.xref_set_key(xref, "BitsPerComponent", "8")
+    doc.xref_set_key(xref, "ColorSpace", "/DeviceGray" if grayscale else "/DeviceRGB")
+
+
+def optimize_images(doc, image_dpi, image_quality):
+    # Downsamples images of doc shown sharper than image_dpi and recompresses
+    # them as JPEG of image_quality, in place. Returns the number of replaced
+    # images.
+    quality = image_quality or OPTIMIZE_IMAGE_QUALITY
+    tasks = image_tasks(doc, image_dpi, image_quality)
+    executor = None
+    chunk_size = OPTIMIZE_CHUNK_SIZE
+    # Worker processes of a parallel save already keep all CPUs busy
+    if (
+        len(tasks) >= PARALLEL_OPTIMIZE_MIN_IMAGES
+        and multiprocessing.parent_process() is None
+    ):
+        executor = ProcessPoolExecutor(OPTIMIZE_WORKERS)
+        chunk_size *= OPTIMIZE_WORKERS or os.cpu_count() or 1
+    replaced = 0
+    try:
+        # Only a chunk of extracted images is held in memory at a time
+        for start in range(0, len(tasks), chunk_size):
+            chunk = []
+            for xref, width, height in tasks[start : start + chunk_size]:
+                image = doc.extract_image(xref)
+                if image and image["colorspace"] in (1, 3):
+                    chunk.append((xref, image["image"], width, height))
+            arguments = (
+                [image for _, image, _, _ in chunk],
+                [width for _, _, width, _ in chunk],
+                [height for _, _, _, height in chunk],
+                [quality] * len(chunk),
+            )
+            if executor is None:
+                recompressed = map(recompress_image, *arguments)
+            else:
+                recompressed = executor.map(recompress_image, *arguments)
+            for (xref, _, width, height), result in zip(chunk, recompressed):
+                if result is None:
+                    continue
+                jpeg, grayscale = result
+                if len(jpeg) > len(doc.xref_stream_raw(xref)) * (
+                    1 - OPTIMIZE_MIN_SAVING
+                ):
+                    continue
+                replace_image_stream(doc, xref, jpeg, width, height, grayscale)
+                replaced += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return replaced
+
+
+def save_pdf(file_path, target_path, rotations, deleted_pages, optimize=None):
+    # optimize is None or a dict with image_dpi and image_quality, both
+    # optional. Optimized files are rewritten without unused and duplicate
+    # objects, and their images are downsampled to image_dpi and recompressed
+    # as JPEG of image_quality.
+    start = time.perf_counter()
+    incremental = False
+    images = 0
+    bytes_before = bytes_after = None
+    error = None
+    try:
+        # A PDF needs at least one page, removing the file is left to the user
+        if all(i in deleted_pages for i in range(len(rotations))):
+            raise ValueError(
+                "every page is marked as deleted, the file was not saved; "
+                "keep at least one page or remove the file"
+            )
+        bytes_before = os.path.getsize(file_path)
+        os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+        incremental = (
+            INCREMENTAL_SAVE
+            and not deleted_pages
+            and optimize is None
+            and save_rotations_incremental(file_path, target_path, rotations)
+        )
+        if not incremental:
+            pdf_writer = fitz.open()
+            with fitz.open(file_path) as source:
+                pdf_writer.insert_pdf(source)
+            for i, page in enumerate(pdf_writer):
+                page.set_rotation(rotations[i])
+            pdf_writer.select(
+                [i for i in range(len(pdf_writer)) if i not in deleted_pages]
+            )
+            if optimize is None:
+                save_pdf_atomic(pdf_writer, target_path, garbage=1)
+            else:
+                images = optimize_images(
+                    pdf_writer,
+                    optimize.get("image_dpi"),
+                    optimize.get("image_quality"),
+                )
+                save_pdf_atomic(pdf_writer, target_path, garbage=4, deflate=True)
+            pdf_writer.close()
+        bytes_after = os.path.getsize(target_path)
+    except Exception as e:
+        error = str(e)
+    return {
+        "file": file_path,
+        "target": target_path,
+        "error": error,
+        "incremental": incremental,
+        "images": images,
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def job_error(file_path, target_path, error):
+    return {
+        "file": file_path,
+        "target": target_path,
+        "error": str(error),
+        "incremental": False,
+        "images": 0,
+        "bytes_before": None,
+        "bytes_after": None,
+        "seconds": 0,
+    }
+
+
+def iter_jobs(function, jobs, workers=None, min_parallel=2, cancel=None):
+    # Yields function(*job) for every job in completion order. Enough jobs are
+    # spread over worker processes, a few are run right here.
+    if len(jobs) < min_parallel:
+        for job in jobs:
+            if cancel is not None and cancel.is_set():
+                return
+            with fitz_lock:
+                result = function(*job)
+            yield result
+        return
+
+    executor = ProcessPoolExecutor(workers)
+    cancelled = False
+    try:
+        futures = [executor.submit(function, *job) for job in jobs]
+        for future in as_completed(futures):
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                return
+            yield future.result()
+    finally:
+        executor.shutdown(wait=not cancelled, cancel_futures=True)
+
+
+def save_files(jobs, doc_pool, results, cancel):
+    # Puts a save_pdf result into results for every job as it completes and
+    # None when finished. jobs are save_pdf argument tuples. The files of jobs
+    # are blocked in doc_pool, if given, the caller unblocks them.
+    try:
+        if doc_pool is not None:
+            doc_pool.block({path for job in jobs for path in job[:2]})
+        for result in iter_jobs(
+            save_pdf, jobs, SAVE_WORKERS, PARALLEL_SAVE_MIN_FILES, cancel
+        ):
+            if result["error"] is not None:
+                metrics.count("save.failed")
+            else:
+                metrics.record("save.file", result["seconds"])
+                metrics.count(
+                    "save.incremental" if result["incremental"] else "save.rewritten"
+                )
+                metrics.count("save.images", result["images"])
+            results.put(result)
+    except Exception as e:
+        results.put(job_error(None, None, e))
+    results.put(None)
+
+
+def fit_matrix(page_rect, rotation, width, height):
+    # Turns the page by rotation degrees and scales it to fit width x height
+    if rotation in (90, 270):
+        page_width, page_height = page_rect.height, page_rect.width
+    else:
+        page_width, page_height = page_rect.width, page_rect.height
+    zoom = min(width / page_width, height / page_height)
+    return fitz.Matrix(zoom, zoom).prerotate(rotation)
+
+
+def render_page(doc_pool, key, width, height):
+    file_path, page_index, page_rotation = key
+
+    with fitz_lock:
+        # Pooled documents are shared, so rotation goes to the render matrix
+        # instead of the page itself
+        page = doc_pool.get(file_path).load_page(page_index)
+        matrix = fit_matrix(
+            page.rect, (page_rotation - page.rotation) % 360, width, height
+        )
+        with metrics.timer("render.pixmap"):
+            pix = page.get_pixmap(matrix=matrix, alpha=False)
+
+    with metrics.timer("render.image"):
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
+def stretch_matrix(page_rect, rotation, width, height):
+    # Turns the page by rotation degrees and stretches it to exactly width x
+    # height pixels, with its top left corner at 0, 0
+    if rotation in (90, 270):
+        page_width, page_height = page_rect.height, page_rect.width
+    else:
+        page_width, page_height = page_rect.width, page_rect.height
+    matrix = fitz.Matrix(width / page_width, height / page_height).prerotate(rotation)
+    bounds = page_rect * matrix
+    return matrix * fitz.Matrix(1, 0, 0, 1, -bounds.x0, -bounds.y0)
+
+
+def render_tile(doc_pool, key, width, height, column, row):
+    # Renders one TILE_SIZE tile of the page zoomed to width x height. Only
+    # the tile is rasterized, so zooming in costs no more than the visible
+    # tiles.
+    file_path, page_index, page_rotation = key
+    tile = fitz.IRect(
+        column * TILE_SIZE,
+        row * TILE_SIZE,
+        min((column + 1) * TILE_SIZE, width),
+        min((row + 1) * TILE_SIZE, height),
+    )
+
+    with fitz_lock:
+        display_list, rotation = doc_pool.display_list(file_path, page_index)
+        matrix = stretch_matrix(
+            display_list.rect, (page_rotation - rotation) % 360, width, height
+        )
+        with metrics.timer("render.tile"):
+            pix = display_list.get_pixmap(
+                matrix=matrix, clip=fitz.Rect(tile) * ~matrix, alpha=False
+            )
+
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
+class RenderCache:
+    def __init__(self, budget, name="render_cache"):
+        self.budget = budget
+        # Prefix of the hit and miss counters in metrics
+        self.name = name
+        self.size = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.images
+
+    def get(self, key):
+        with self.lock:
+            img = self.images.get(key)
+            if img is not None:
+                self.images.move_to_end(key)
+        metrics.count(f"{self.name}.miss" if img is None else f"{self.name}.hit")
+        return img
+
+    def put(self, key, img):
+        with self.lock:
+            old = self.images.pop(key, None)
+            if old is not None:
+                self.size -= image_size(old)
+            self.images[key] = img
+            self.size += image_size(img)
+            # The newest image is kept even if it alone exceeds the budget
+            while self.size > self.budget and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.size -= image_size(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.size = 0
+
+    def discard_files(self, file_paths):
+        # Keys of rendered pages start with (file_path, page_index, rotation)
+        with self.lock:
+            for key in [key for key in self.images if key[0][0] in file_paths]:
+                self.size -= image_size(self.images.pop(key))
+
+
+class PagePrefetcher(threading.Thread):
+    # Renders jobs in background into cache, a job is a tuple of the
+    # arguments of render after doc_pool: render_page by default, render_tile
+    # for tiles of zoomed pages
+
+    def __init__(self, cache, doc_pool, render=render_page):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.doc_pool = doc_pool
+        self.render = render
+        self.jobs = []
+        self.failures = {}
+        self.condition = threading.Condition()
+
+    def schedule(self, jobs):
+        # Pending jobs are stale after a page change, so they are replaced
+        with self.condition:
+            self.jobs = list(jobs)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                job = self.jobs.pop(0)
+            if job in self.cache:
+                continue
+            try:
+                img = self.render(self.doc_pool, *job)
+            except BlockingIOError:
+                # The file is being saved, the app schedules the job again
+                continue
+            except Exception as e:
+                self.failures[job] = str(e)
+                continue
+            self.failures.pop(job, None)
+            self.cache.put(job, img)
+
+
+def thumbnail_path(file_path, key, page_index, rotation):
+    # Thumbnails of one version of a file share a directory named after its
+    # path and index key, so an edited file never shows stale thumbnails
+    file_hash = hashlib.sha1(
+        json.dumps([os.path.abspath(file_path), key, THUMBNAIL_SIZE]).encode()
+    ).hexdigest()
+    return os.path.join(
+        user_cache_dir(), "thumbnails", file_hash, f"{page_index}-{rotation}.jpg"
+    )
+
+
+def prune_thumbnails(budget=THUMBNAIL_CACHE_BUDGET):
+    # Removes thumbnail directories, oldest modification time first, until
+    # the cache fits in budget. Rendering a thumbnail or showing a file in
+    # the overview updates the time of its directory, and thumbnails of
+    # files that changed are never shown again, so they go first. Returns
+    # the number of directories removed.
+    folders = []
+    try:
+        with os.scandir(os.path.join(user_cache_dir(), "thumbnails")) as scan:
+            for entry in scan:
+                try:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    with os.scandir(entry.path) as files:
+                        size = sum(f.stat().st_size for f in files)
+                    folders.append((entry.stat().st_mtime, size, entry.path))
+                except OSError:
+                    continue
+    except OSError:
+        return 0
+    total = sum(size for _, size, _ in folders)
+    removed = 0
+    for _, size, folder_path in sorted(folders):
+        if total <= budget:
+            break
+        shutil.rmtree(folder_path, ignore_errors=True)
+        total -= size
+        removed += 1
+    metrics.count("thumbnails.pruned", removed)
+    return removed
+
+
+# Documents kept open by a thumbnail worker process between its jobs
+thumbnail_doc_pool = None
+
+
+def render_thumbnail(file_path, page_index, rotation, cache_path):
+    # Renders a page turned by rotation degrees into cache_path. Runs in
+    # thumbnail worker processes. Returns (cache_path, error).
+    global thumbnail_doc_pool
+    if thumbnail_doc_pool is None:
+        thumbnail_doc_pool = DocumentPool(MAX_OPEN_DOCUMENTS)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        img = render_page(
+            thumbnail_doc_pool,
+            (file_path, page_index, rotation),
+            THUMBNAIL_SIZE,
+            THUMBNAIL_SIZE,
+        )
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        img.save(temp_path, "JPEG", quality=THUMBNAIL_QUALITY)
+        os.replace(temp_path, cache_path)
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return cache_path, str(e)
+    return cache_path, None
+
+
+def page_statistics(pix):
+    # Ink coverage and standard deviation of a grayscale pixmap, margins left
+    # out
+    pixels = numpy.frombuffer(pix.samples, numpy.uint8).reshape(pix.height, pix.stride)[
+        :, : pix.width
+    ]
+    margin_y = int(pix.height * BLANK_MARGIN)
+    margin_x = int(pix.width * BLANK_MARGIN)
+    pixels = pixels[margin_y : pix.height - margin_y, margin_x : pix.width - margin_x]
+    if pixels.size == 0:
+        return 0.0, 0.0
+    background = int(numpy.median(pixels))
+    ink = numpy.abs(pixels.astype(numpy.int16) - background) > BLANK_INK_CONTRAST
+    return float(ink.mean()), float(pixels.std())
+
+
+def blank_score(ink_coverage, deviation):
+    # 1 for an evenly colored page, 0 once either measure reaches its limit
+    return max(
+        0.0,
+        1.0
+        - max(
+            ink_coverage / BLANK_INK_COVERAGE_LIMIT, deviation / BLANK_DEVIATION_LIMIT
+        ),
+    )
+
+
+def analyze_blank_pages(file_path, first_page, last_page):
+    # Scores pages first_page..last_page - 1 of file_path. Runs in blank page
+    # detection workers. Returns (file_path, first_page, scores, error).
+    scores = []
+    try:
+        with fitz.open(file_path) as doc:
+            for page_index in range(first_page, last_page):
+                page = doc.load_page(page_index)
+                zoom = BLANK_ANALYSIS_SIZE / max(page.rect.width, page.rect.height)
+                pix = page.get_pixmap(
+                    matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False
+                )
+                scores.append(blank_score(*page_statistics(pix)))
+    except Exception as e:
+        return file_path, first_page, scores, str(e)
+    return file_path, first_page, scores, None
+
+
+def detect_blank_pages(files, results, cancel):
+    # Puts analyze_blank_pages results into results as they complete and None
+    # when finished. files are (file_path, page_count) tuples.
+    jobs = [
+        (file_path, first_page, min(first_page + BLANK_PAGES_PER_JOB, page_count))
+        for file_path, page_count in files
+        for first_page in range(0, page_count, BLANK_PAGES_PER_JOB)
+    ]
+    try:
+        for result in iter_jobs(analyze_blank_pages, jobs, BLANK_WORKERS, 1, cancel):
+            results.put(result)
+    except Exception as e:
+        results.put((None, 0, [], str(e)))
+    results.put(None)
+
+
+def text_orientation(page):
+    # Text line directions are given in unrotated page space, so every line
+    # votes, by its length, for the page rotation that makes it upright.
+    # Returns (rotation change, confidence) or None if there is little text.
+    votes = [0] * 4
+    for block in page.get_text("dict", flags=0)["blocks"]:
+        for line in block.get("lines", ()):
+            dx, dy = line["dir"]
+            quarter = round(math.degrees(math.atan2(-dy, dx)) / 90) % 4
+            votes[quarter] += sum(len(span["text"].strip()) for span in line["spans"])
+    total = sum(votes)
+    if total < ORIENTATION_MIN_TEXT_CHARS:
+        return None
+    quarter = max(range(4), key=votes.__getitem__)
+    return (quarter * 90 - page.rotation) % 360, max(
+        0.0, 2 * votes[quarter] / total - 1
+    )
+
+
+def profile_strength(profile):
+    mean = profile.mean()
+    return profile.std() / mean if mean else 0.0
+
+
+def ascender_balance(ink):
+    # Latin text has more ascenders than descenders, so upright lines carry
+    # more ink above their densest rows than below. Positive when upright,
+    # negative when upside down.
+    rows = ink.sum(axis=1)
+    text_rows = (rows > rows.max() * 0.05).astype(numpy.int8)
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], text_rows, [0]))))
+    above = below = 0
+    for start, end in zip(edges[::2], edges[1::2]):
+        band = rows[start:end]
+        core = numpy.flatnonzero(band >= band.max() / 2)
+        above += int(band[: core[0]].sum())
+        below += int(band[core[-1] + 1 :].sum())
+    return (above - below) / (above + below) if above + below else 0.0
+
+
+def crop_text_block(ink):
+    # Cuts the scan edges and the empty margins around the text
+    margin_y = int(ink.shape[0] * BLANK_MARGIN)
+    margin_x = int(ink.shape[1] * BLANK_MARGIN)
+    ink = ink[margin_y : ink.shape[0] - margin_y, margin_x : ink.shape[1] - margin_x]
+    rows = numpy.flatnonzero(ink.sum(axis=1) > ink.shape[1] * ORIENTATION_CROP_INK)
+    columns = numpy.flatnonzero(ink.sum(axis=0) > ink.shape[0] * ORIENTATION_CROP_INK)
+    if len(rows) == 0 or len(columns) == 0:
+        return ink
+    return ink[rows[0] : rows[-1] + 1, columns[0] : columns[-1] + 1]
+
+
+def image_orientation(pix):
+    # Text lines show as stripes in the ink profile across them. The profile
+    # tells sideways from upright pages, ascender_balance up from down.
+    # Returns (rotation change, confidence).
+    pixels = numpy.frombuffer(pix.samples, numpy.uint8).reshape(pix.height, pix.stride)[
+        :, : pix.width
+    ]
+    ink = pixels < int(numpy.median(pixels)) - BLANK_INK_CONTRAST
+    if ink.mean() < ORIENTATION_MIN_INK:
+        return 0, 0.0
+    ink = crop_text_block(ink)
+    across_rows = profile_strength(ink.sum(axis=1))
+    across_columns = profile_strength(ink.sum(axis=0))
+    sideways = across_columns > across_rows
+    if sideways:
+        ink = numpy.rot90(ink)
+    balance = ascender_balance(ink)
+    if sideways:
+        rotation = 270 if balance > 0 else 90
+    else:
+        rotation = 0 if balance > 0 else 180
+    weaker, stronger = sorted((across_rows, across_columns))
+    axis_confidence = min(1.0, stronger / weaker - 1) if weaker else 1.0
+    confidence = min(axis_confidence, abs(balance) / ORIENTATION_BALANCE_SCALE, 1.0)
+    return rotation, float(confidence)
+
+
+def analyze_rotations(file_path, first_page, last_page):
+    # Proposes rotation changes for pages first_page..last_page - 1 of
+    # file_path. Runs in orientation detection workers. Returns (file_path,
+    # first_page, [(rotation change, confidence)], error).
+    proposals = []
+    try:
+        with fitz.open(file_path) as doc:
+            for page_index in range(first_page, last_page):
+                page = doc.load_page(page_index)
+                proposal = text_orientation(page)
+                if proposal is None:
+                    zoom = ORIENTATION_ANALYSIS_SIZE / max(
+                        page.rect.width, page.rect.height
+                    )
+                    pix = page.get_pixmap(
+                        matrix=fitz.Matrix(zoom, zoom),
+                        colorspace=fitz.csGRAY,
+                        alpha=False,
+                    )
+                    proposal = image_orientation(pix)
+                proposals.append((proposal[0], round(proposal[1], 2)))
+    except Exception as e:
+        return file_path, first_page, proposals, str(e)
+    return file_path, first_page, proposals, None
+
+
+def detect_rotations(files, folder_index, results, cancel):
+    # Puts analyze_rotations results into results as they complete and None
+    # when finished. files are (file_path, page_count) tuples. Files analyzed
+    # before are answered from folder_index.
+    try:
+        jobs = []
+        keys = {}
+        pending = {}
+        for file_path, page_count in files:
+            try:
+                keys[file_path] = index_key(file_path)
+            except OSError:
+                keys[file_path] = None
+            cached = folder_index.lookup_rotations(file_path, keys[file_path])
+            if cached is not None and len(cached) == page_count:
+                results.put((file_path, 0, [tuple(p) for p in cached], None))
+                continue
+            pending[file_path] = [None] * page_count
+            for first_page in range(0, page_count, ORIENTATION_PAGES_PER_JOB):
+                last_page = min(first_page + ORIENTATION_PAGES_PER_JOB, page_count)
+                jobs.append((file_path, first_page, last_page))
+
+        for result in iter_jobs(
+            analyze_rotations, jobs, ORIENTATION_WORKERS, 1, cancel
+        ):
+            results.put(result)
+            file_path, first_page, proposals, error = result
+            file_proposals = pending.get(file_path)
+            if file_proposals is None:
+                continue
+            if error is not None:
+                del pending[file_path]
+                continue
+            file_proposals[first_page : first_page + len(proposals)] = proposals
+            if None not in file_proposals:
+                del pending[file_path]
+                if keys[file_path] is not None:
+                    folder_index.store_rotations(
+                        file_path, keys[file_path], file_proposals
+                    )
+        folder_index.save()
+    except Exception as e:
+        results.put((None, 0, [], str(e)))
+    results.put(None)
+
+
+def apply_edits(file_path, target_path, rotate, rotate_all, delete, optimize=None):
+    # Applies edits given with 1-based page numbers: rotate maps pages to
+    # degrees added to their rotation, rotate_all is added to every page.
+    # optimize is passed on to save_pdf.
+    try:
+        with fitz.open(file_path) as doc:
+            rotations = read_page_rotations(doc)
+        page_count = len(rotations)
+        for page_number in list(rotate) + list(delete):
+            if not 1 <= page_number <= page_count:
+                raise ValueError(f"page {page_number} is out of range 1-{page_count}")
+        for degree in list(rotate.values()) + [rotate_all]:
+            if degree % 90:
+                raise ValueError(f"rotation {degree} is not a multiple of 90")
+        rotations = [
+            (rotation + rotate_all + rotate.get(i + 1, 0)) % 360
+            for i, rotation in enumerate(rotations)
+        ]
+        deleted_pages = {page_number - 1 for page_number in delete}
+        os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+    except Exception as e:
+        return job_error(file_path, target_path, e)
+    return save_pdf(file_path, target_path, rotations, deleted_pages, optimize)
+
+
+def load_manifest(manifest_path, output_dir=None, replace=None):
+    # Manifest format:
+    # {
+    #     "output_dir": "_pdf_rush",
+    #     "replace": false,
+    #     "files": [
+    #         {"path": "a.pdf", "rotate": {"1": 90, "3": -90}, "delete": [2]},
+    #         {"path": "scans/b.pdf", "rotate_all": 180}
+    #     ]
+    # }
+    # Paths are relative to the manifest, page numbers start at 1.
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    base_folder = os.path.dirname(os.path.abspath(manifest_path))
+    if output_dir is None:
+        output_dir = manifest.get("output_dir", "_pdf_rush")
+    output_dir = os.path.join(base_folder, output_dir)
+    if replace is None:
+        replace = manifest.get("replace", False)
+
+    jobs = []
+    for entry in manifest["files"]:
+        file_path = os.path.join(base_folder, entry["path"])
+        if replace:
+            target_path = file_path
+        else:
+            target_path = os.path.join(
+                output_dir, os.path.relpath(file_path, base_folder)
+            )
+        rotate = {
+            int(page_number): int(degree)
+            for page_number, degree in entry.get("rotate", {}).items()
+        }
+        jobs.append(
+            (
+                file_path,
+                target_path,
+                rotate,
+                int(entry.get("rotate_all", 0)),
+                [int(page_number) for page_number in entry.get("delete", [])],
+            )
+        )
+    return jobs
+
+
+def probe_pdf(file_path):
+    # Returns (page_count, error) for a file that is going to be merged
+    try:
+        with fitz.open(file_path) as doc:
+            if not doc.is_pdf:
+                return 0, "not a PDF document"
+            if doc.needs_pass:
+                return 0, "document is encrypted"
+            if doc.page_count == 0:
+                return 0, "document has no pages"
+            return doc.page_count, None
+    except Exception as e:
+        return 0, str(e)
+
+
+def concatenate_parts(part_paths, output_path):
+    # Writes the pages of PDF files saved by MuPDF into one file, object by
+    # object, so only one object is in memory and fitz_lock is held only
+    # while it is read. Objects of each part are renumbered after those of
+    # the parts before it; the catalog and page tree of each part are
+    # replaced by one catalog (object 1) and a flat page tree (object 2).
+    # Inherited page attributes are not looked up, MuPDF copies them into
+    # the pages it inserts. Returns the number of pages.
+    offsets = [0, 0, 0]
+    kids = []
+    with open(output_path, "wb") as f:
+        f.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        for part_path in part_paths:
+            with fitz_lock:
+                doc = fitz.open(part_path)
+            try:
+                with fitz_lock:
+                    xref_count = doc.xref_length()
+                    page_xrefs = [page.xref for page in doc]
+                    tree_xrefs = [
+                        xref
+                        for xref in range(1, xref_count)
+                        if doc.xref_get_key(xref, "Type")[1] in ("/Catalog", "/Pages")
+                    ]
+                base = len(offsets) - 1
+                replaced = {xref: "2 0 R" for xref in tree_xrefs}
+
+                def renumber(match):
+                    if match.group(1) is None:
+                        return match.group(0)
+                    xref = int(match.group(1))
+                    return replaced.get(xref) or f"{base + xref} 0 R"
+
+                for xref in range(1, xref_count):
+                    offsets.append(f.tell())
+                    if xref in replaced:
+                        # Keeps the numbering, nothing refers to it anymore
+                        f.write(f"{base + xref} 0 obj\nnull\nendobj\n".encode())
+                        continue
+                    with fitz_lock:
+                        source = doc.xref_object(xref, compressed=True)
+                        stream = (
+                            doc.xref_stream_raw(xref)
+                            if doc.xref_is_stream(xref)
+                            else None
+                        )
+                    f.write(f"{base + xref} 0 obj\n".encode())
+                    f.write(PDF_REFERENCE.sub(renumber, source).encode("latin-1"))
+                    if stream is not None:
+                        f.write(b"\nstream\n" + stream + b"\nendstream")
+                    f.write(b"\nendobj\n")
+                kids += [f"{base + xref} 0 R" for xref in page_xrefs]
+            finally:
+                with fitz_lock:
+                    doc.close()
+
+        offsets[1] = f.tell()
+        f.write(b"1 0 obj\n<</Type/Catalog/Pages 2 0 R>>\nendobj\n")
+        offsets[2] = f.tell()
+        f.write(
+            f"2 0 obj\n<</Type/Pages/Count {len(kids)}/Kids[{' '.join(kids)}]>>\n"
+            "endobj\n".encode()
+        )
+        xref_offset = f.tell()
+        f.write(f"xref\n0 {len(offsets)}\n0000000000 65535 f\r\n".encode())
+        f.write(
+            "".join(f"{offset:010d} 00000 n\r\n" for offset in offsets[1:]).encode()
+        )
+        f.write(
+            f"trailer\n<</Size {len(offsets)}/Root 1 0 R>>\n"
+            f"startxref\n{xref_offset}\n%%EOF\n".encode()
+        )
+    return len(kids)
+
+
+def merge_pdfs(file_paths, output_path, progress=None, cancel=None):
+    # Copies all pages of file_paths into output_path. Inputs are validated by
+    # worker processes ahead of the writer, and the writer never holds more
+    # than about MERGE_MEMORY_BUDGET bytes of copied pages: past the budget
+    # they are saved to a part file and a new writer starts. Several parts
+    # are joined by concatenate_parts, so every page is written twice at
+    # most. Invalid inputs are skipped. progress(done, total, file_path,
+    # error) is called after every input.
+    start = time.perf_counter()
+    result = {
+        "target": output_path,
+        "pages": 0,
+        "failures": [],
+        "cancelled": False,
+        "error": None,
+        "seconds": 0,
+    }
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    part_paths = []
+    pending_bytes = 0
+
+    executor = None
+    if len(file_paths) >= PARALLEL_MERGE_MIN_FILES:
+        executor = ProcessPoolExecutor(MERGE_WORKERS)
+        probes = executor.map(probe_pdf, file_paths, chunksize=MERGE_CHUNK_SIZE)
+
+    with fitz_lock:
+        pdf_writer = fitz.open()
+    try:
+        for done, file_path in enumerate(file_paths, 1):
+            if cancel is not None and cancel.is_set():
+                result["cancelled"] = True
+                break
+            if executor is None:
+                with fitz_lock:
+                    page_count, error = probe_pdf(file_path)
+            else:
+                page_count, error = next(probes)
+            with fitz_lock:
+                if error is None:
+                    try:
+                        with fitz.open(file_path) as source:
+                            pdf_writer.insert_pdf(source)
+                        pending_bytes += os.path.getsize(file_path)
+                    except Exception as e:
+                        error = str(e)
+                if error is not None:
+                    result["failures"].append((file_path, error))
+                elif pending_bytes >= MERGE_MEMORY_BUDGET and done < len(file_paths):
+                    part_paths.append(f"{temp_path}.part{len(part_paths)}")
+                    with metrics.timer("merge.flush"):
+                        pdf_writer.save(part_paths[-1], garbage=1)
+                    pdf_writer.close()
+                    pdf_writer = fitz.open()
+                    pending_bytes = 0
+            if progress is not None:
+                progress(done, len(file_paths), file_path, error)
+
+        if not result["cancelled"]:
+            with fitz_lock:
+                if pdf_writer.page_count > 0:
+                    part_paths.append(f"{temp_path}.part{len(part_paths)}")
+                    pdf_writer.save(part_paths[-1], garbage=1)
+                    result["pages"] = pdf_writer.page_count
+                pdf_writer.close()
+            if not part_paths:
+                result["error"] = "none of the files could be merged"
+            elif len(part_paths) == 1:
+                os.replace(part_paths[0], output_path)
+            else:
+                with metrics.timer("merge.write"):
+                    result["pages"] = concatenate_parts(part_paths, temp_path)
+                os.replace(temp_path, output_path)
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        with fitz_lock:
+            if not pdf_writer.is_closed:
+                pdf_writer.close()
+        for path in part_paths + [temp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    result["seconds"] = time.perf_counter() - start
+    if result["error"] is None and not result["cancelled"]:
+        metrics.record("merge.total", result["seconds"])
+    return result
+
+
+def merge_files(file_paths, output_path, doc_pool, results, cancel):
+    # Puts (done, total, file_path, error) into results after every input, then
+    # the merge_pdfs result and None. output_path is blocked in doc_pool, the
+    # caller unblocks it.
+    doc_pool.block([output_path])
+
+    def progress(done, total, file_path, error):
+        results.put((done, total, file_path, error))
+
+    results.put(merge_pdfs(file_paths, output_path, progress, cancel))
+    results.put(None)
+
+
+def print_result(result):
+    print(json.dumps(result), flush=True)
+
+
+def merge_progress(done, total, file_path, error):
+    if error is not None:
+        print(f"Skipped {file_path}: {error}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="pdf-rush",
+        description="Apply PDF Rush edits without the user interface. "
+        "Results are printed as one JSON object per line.",
+    )
+    parser.add_argument(
+        "--metrics", help="write timings to this JSON or CSV file when finished"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    apply_parser = commands.add_parser(
+        "apply", help="rotate and delete pages as listed in a JSON edit manifest"
+    )
+    apply_parser.add_argument("manifest")
+    apply_parser.add_argument(
+        "--output-dir", help="folder for edited files, relative to the manifest"
+    )
+    apply_parser.add_argument(
+        "--replace",
+        action="store_true",
+        default=None,
+        help="replace the original files",
+    )
+    apply_parser.add_argument(
+        "--workers", type=int, help="worker processes, one per CPU by default"
+    )
+    apply_parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="rewrite files without unused and duplicate objects",
+    )
+    apply_parser.add_argument(
+        "--image-dpi",
+        type=int,
+        help="with --optimize, downsample page images to this resolution",
+    )
+    apply_parser.add_argument(
+        "--image-quality",
+        type=int,
+        help="with --optimize, recompress page images as JPEG of this quality",
+    )
+
+    merge_parser = commands.add_parser("merge", help="merge files into one")
+    merge_parser.add_argument("output")
+    merge_parser.add_argument("inputs", nargs="+")
+
+    args = parser.parse_args(argv)
+    if args.metrics:
+        metrics.enabled = True
+
+    if args.command == "apply":
+        try:
+            jobs = load_manifest(args.manifest, args.output_dir, args.replace)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Invalid manifest {args.manifest}: {e}", file=sys.stderr)
+            return 2
+        if args.optimize:
+            optimize = {
+                "image_dpi": args.image_dpi,
+                "image_quality": args.image_quality,
+            }
+            jobs = [job + (optimize,) for job in jobs]
+        failed = 0
+        for result in iter_jobs(apply_edits, jobs, args.workers):
+            if result["error"] is not None:
+                failed += 1
+            else:
+                metrics.record("save.file", result["seconds"])
+            print_result(result)
+        print(f"{len(jobs) - failed} file(s) saved, {failed} failed", file=sys.stderr)
+        exit_code = 1 if failed else 0
+    else:
+        result = merge_pdfs(args.inputs, args.output, merge_progress)
+        print_result(result)
+        exit_code = 1 if result["error"] or result["failures"] else 0
+
+    if args.metrics:
+        try:
+            metrics.export(args.metrics)
+        except OSError as e:
+            print(f"Failed to write metrics to {args.metrics}: {e}", file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,4 @@
+import sys, os
+
+# pdf_rush_engine.py is a module at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
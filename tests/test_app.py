@@ -0,0 +1,219 @@
+import importlib.util
+import os
+import time
+
+import fitz
+import pytest
+from PIL import Image
+
+import pdf_rush_engine as engine
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "pdf-rush.py")
+
+
+class Widget:
+    # Accepts every widget call, the tests look at the app state only
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: 0
+
+
+class Root(Widget):
+    # Runs after callbacks when pump is called instead of in a main loop
+    def __init__(self):
+        self.callbacks = []
+
+    def after(self, ms, function=None, *args):
+        self.callbacks.append((function, args))
+        return len(self.callbacks)
+
+    def after_idle(self, function, *args):
+        self.callbacks.append((function, args))
+
+
+class Var:
+    def __init__(self, value=False):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+class MessageBox:
+    def __init__(self):
+        self.shown = []
+
+    def showinfo(self, title, message):
+        self.shown.append((title, message))
+
+
+def make_pdf(path, page_count):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    doc = fitz.open()
+    for _ in range(page_count):
+        doc.new_page()
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def pump(app, timeout=30):
+    # Runs after callbacks until the tasks of the app are done
+    end = time.monotonic() + timeout
+    while app.root.callbacks and time.monotonic() < end:
+        function, args = app.root.callbacks.pop(0)
+        function(*args)
+        time.sleep(0.001)
+    assert app.tasks.current() is None
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "user_cache_dir", lambda: str(tmp_path / "cache"))
+    spec = importlib.util.spec_from_file_location("pdf_rush_app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module.tk, "Tk", Root)
+    monkeypatch.setattr(module.tk, "BooleanVar", Var)
+    monkeypatch.setattr(module.tk, "StringVar", Var)
+    monkeypatch.setattr(module.ImageTk, "PhotoImage", lambda img: img)
+    monkeypatch.setattr(module, "messagebox", MessageBox())
+
+    def create_ui(app):
+        for name in (
+            "canvas",
+            "file_name_label",
+            "page_number_label",
+            "page_info_label",
+            "folder_info_label",
+            "status_label",
+            "progress_bar",
+            "cancel_button",
+            "unsaved_changes_listbox",
+            "save_button",
+            "replace_checkbox",
+            "optimize_menu",
+            "prev_button",
+            "next_button",
+            "jump_button",
+            "rotate_button",
+            "delete_button",
+            "merge_button",
+        ):
+            setattr(app, name, Widget())
+
+    monkeypatch.setattr(module.PDFEditorApp, "create_ui", create_ui)
+    app = module.PDFEditorApp()
+    app.messages = module.messagebox.shown
+    return app
+
+
+@pytest.fixture
+def folders(tmp_path):
+    first = str(tmp_path / "first")
+    second = str(tmp_path / "second")
+    make_pdf(os.path.join(first, "a.pdf"), 2)
+    make_pdf(os.path.join(first, "b.pdf"), 1)
+    make_pdf(os.path.join(second, "c.pdf"), 3)
+    return first, second
+
+
+@pytest.mark.parametrize("replace", [False, True])
+def test_loading_during_save_keeps_the_new_session(app, folders, replace):
+    first, second = folders
+    app.load_folder(first)
+    pump(app)
+    app.replace_existing.set(replace)
+    app.rotate_page(90)
+
+    app.save_changes()
+    app.load_folder(second)
+    pump(app)
+
+    assert app.messages[-1][0] == "Saved"
+    assert "a.pdf" in app.messages[-1][1]
+    assert app.pages.files == [os.path.join(second, "c.pdf")]
+    assert app.num_pages == 3
+    assert list(app.file_keys) == [os.path.join(second, "c.pdf")]
+    assert list(app.folder_index.files) == ["c.pdf"]
+    saved_path = (
+        os.path.join(first, "a.pdf")
+        if replace
+        else os.path.join(first, engine.OUTPUT_FOLDER_NAME, "a.pdf")
+    )
+    with fitz.open(saved_path) as doc:
+        assert doc[0].rotation == 90
+
+
+def test_save_updates_the_session_it_started_in(app, folders):
+    first, _ = folders
+    app.load_folder(first)
+    pump(app)
+    app.replace_existing.set(True)
+    app.rotate_page(90)
+
+    app.save_changes()
+    pump(app)
+
+    assert app.messages[-1][0] == "Saved"
+    assert not app.pages.has_changes(0)
+    assert app.pages.file_rotations(0) == [90, 0]
+
+
+def start_rescan(app):
+    app.last_rescan = time.monotonic() - app.rescan_interval
+    app.rescan_files()
+    return app.tasks.tasks["refresh"]
+
+
+def test_rescan_is_not_restarted_while_it_runs(app, folders):
+    first, _ = folders
+    app.load_folder(first)
+    pump(app)
+    refresh = start_rescan(app)
+
+    # The window gets the focus again while files are checked
+    app.rescan_files()
+    assert not app.busy()
+
+    assert app.tasks.tasks["refresh"] is refresh
+    assert not refresh.cancel_event.is_set()
+    assert not app.rescan_pending
+    pump(app)
+
+
+def test_save_pauses_a_running_rescan(app, folders):
+    first, _ = folders
+    app.load_folder(first)
+    pump(app)
+    app.rotate_page(90)
+    refresh = start_rescan(app)
+
+    app.save_changes()
+
+    assert refresh.cancel_event.is_set()
+    assert app.rescan_pending
+    assert app.tasks.running("save")
+    pump(app)
+    # The check runs again once the save is done
+    assert not app.rescan_pending
+    assert app.last_rescan > 0
+    assert app.messages[-1][0] == "Saved"
+
+
+def test_loading_drops_the_page_waiting_to_render(app, folders):
+    first, second = folders
+    app.load_folder(first)
+    pump(app)
+    job = (app.page_key(0), 800, 600)
+    app.render_job = job
+
+    app.load_folder(second)
+    # The render of the old page ends after the new session started
+    app.render_cache.put(job, Image.new("RGB", (80, 60)))
+    app.poll_render(job)
+    pump(app)
+
+    assert app.pages.files == [os.path.join(second, "c.pdf")]
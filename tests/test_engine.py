@@ -0,0 +1,844 @@
+import io
+import json
+import os
+import queue
+import threading
+import time
+
+import fitz
+import numpy
+import pytest
+from PIL import Image
+
+import pdf_rush_engine as engine
+
+
+def make_pdf(path, rotations):
+    doc = fitz.open()
+    for rotation in rotations:
+        page = doc.new_page()
+        page.insert_text((72, 72), f"page {page.number + 1}")
+        page.set_rotation(rotation)
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+def read_rotations(path):
+    with fitz.open(path) as doc:
+        return [page.rotation for page in doc]
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / "cache"
+    monkeypatch.setattr(engine, "user_cache_dir", lambda: str(path))
+    return path
+
+
+def test_page_table_locates_pages_across_files():
+    pages = engine.PageTable()
+    pages.add_file("a.pdf", [0, 90])
+    pages.add_file("b.pdf", [180, 0, 0])
+    assert len(pages) == 5
+    assert pages.locate(1) == (0, 1)
+    assert pages.locate(2) == (1, 0)
+    assert pages.page(4) == ("b.pdf", 2)
+    assert pages.rotation(0, 1) == 90
+
+
+def test_page_table_rotate_counts_changed_pages():
+    pages = engine.PageTable()
+    pages.add_file("a.pdf", [0, 90])
+    pages.rotate(0, 0, 90)
+    pages.rotate(0, 1, -90)
+    assert pages.file_rotations(0) == [90, 0]
+    assert pages.rotated_count[0] == 2
+    pages.rotate(0, 0, 270)
+    assert pages.rotated_count[0] == 1
+    pages.rotate(0, 1, 90)
+    assert not pages.has_changes(0)
+    assert pages.file_rotations_init(0) == [0, 90]
+
+
+def test_page_table_toggle_deleted():
+    pages = engine.PageTable()
+    pages.add_file("a.pdf", [0] * 10)
+    pages.toggle_deleted(0, 9)
+    pages.toggle_deleted(0, 3)
+    assert pages.file_deleted(0) == {3, 9}
+    assert pages.deleted_count[0] == 2
+    pages.toggle_deleted(0, 3)
+    assert pages.file_deleted(0) == {9}
+    assert pages.deleted_count[0] == 1
+
+
+@pytest.mark.parametrize("page_index", [-1, 3, 7])
+def test_page_table_toggle_deleted_out_of_range(page_index):
+    pages = engine.PageTable()
+    pages.add_file("a.pdf", [0, 0, 0])
+    with pytest.raises(IndexError):
+        pages.toggle_deleted(0, page_index)
+    assert pages.file_deleted(0) == set()
+    assert not pages.has_changes(0)
+
+
+def test_page_table_update_files_keeps_other_edits():
+    pages = engine.PageTable()
+    pages.add_file("a.pdf", [0, 0])
+    pages.add_file("b.pdf", [0, 0, 0])
+    pages.add_file("c.pdf", [0])
+    pages.rotate(0, 0, 90)
+    pages.toggle_deleted(1, 2)
+    pages.rotate(2, 0, 90)
+
+    new_ids = pages.update_files({"a.pdf": [90, 0, 0], "c.pdf": None, "d.pdf": [0]})
+
+    assert new_ids == [0, 1, None]
+    assert pages.files == ["a.pdf", "b.pdf", "d.pdf"]
+    assert pages.file_ids == {"a.pdf": 0, "b.pdf": 1, "d.pdf": 2}
+    assert len(pages) == 7
+    assert not pages.has_changes(0)
+    assert pages.file_rotations(0) == [90, 0, 0]
+    assert pages.file_deleted(1) == {2}
+    assert pages.locate(3) == (1, 0)
+    assert pages.changed_files() == [1]
+
+
+def test_page_table_changes_text():
+    pages = engine.PageTable()
+    pages.add_file(os.path.join("folder", "sub", "a.pdf"), [0, 0])
+    pages.rotate(0, 0, 90)
+    pages.toggle_deleted(0, 1)
+    assert pages.changes_text(0, "folder") == (
+        os.path.join("sub", "a.pdf") + " (rot 1, del 1)"
+    )
+
+
+def test_folder_index_lookup_and_store(tmp_path, cache_dir):
+    index = engine.FolderIndex(str(tmp_path))
+    file_path = str(tmp_path / "a.pdf")
+    assert index.lookup(file_path, [1, 2]) is None
+    index.store(file_path, [1, 2], [0, 0, 0])
+    assert index.lookup(file_path, [1, 2]) == [0, 0, 0]
+    assert index.lookup(file_path, [1, 3]) is None
+    index.store(file_path, [1, 3], [90, 0])
+    assert index.lookup(file_path, [1, 3]) == [90, 0]
+
+
+def test_folder_index_store_drops_proposals(tmp_path, cache_dir):
+    index = engine.FolderIndex(str(tmp_path))
+    file_path = str(tmp_path / "a.pdf")
+    index.store(file_path, [1, 2], [0, 0])
+    index.store_rotations(file_path, [1, 3], [90, 0])
+    assert index.lookup_rotations(file_path, [1, 2]) is None
+    index.store_rotations(file_path, [1, 2], [90, 0])
+    assert index.lookup_rotations(file_path, [1, 2]) == [90, 0]
+    index.store(file_path, [1, 2], [0, 0])
+    assert index.lookup_rotations(file_path, [1, 2]) is None
+
+
+def test_folder_index_save_and_reload(tmp_path, cache_dir):
+    kept = make_pdf(tmp_path / "kept.pdf", [0, 90])
+    removed = make_pdf(tmp_path / "removed.pdf", [0])
+    gone = str(tmp_path / "gone.pdf")
+    index = engine.FolderIndex(str(tmp_path))
+    for file_path, rotations in ((kept, [0, 90]), (removed, [0]), (gone, [0])):
+        index.store(file_path, [1], rotations)
+    index.remove(removed)
+    index.save()
+
+    # Files missing from the folder are pruned on the first save
+    with open(index.path) as f:
+        assert sorted(json.load(f)["files"]) == ["kept.pdf"]
+    reloaded = engine.FolderIndex(str(tmp_path))
+    assert reloaded.lookup(kept, [1]) == [0, 90]
+    assert reloaded.lookup(removed, [1]) is None
+    assert not reloaded.changed
+
+
+def test_folder_index_ignores_other_versions(tmp_path, cache_dir):
+    index = engine.FolderIndex(str(tmp_path))
+    os.makedirs(os.path.dirname(index.path))
+    with open(index.path, "w") as f:
+        json.dump({"version": -1, "files": {"a.pdf": {"key": [1], "pages": 1}}}, f)
+    assert engine.FolderIndex(str(tmp_path)).files == {}
+
+
+def test_stream_chunks_splits_lists(monkeypatch):
+    monkeypatch.setattr(engine, "INDEX_STREAM_CHUNK", 2)
+    chunks = list(engine.stream_chunks([1, 2, 3, 4, 5], threading.Event()))
+    assert chunks == [[1, 2], [3, 4], [5]]
+
+
+def test_stream_chunks_streams_generators(monkeypatch):
+    monkeypatch.setattr(engine, "INDEX_STREAM_CHUNK", 3)
+    chunks = list(engine.stream_chunks(iter(range(10)), threading.Event()))
+    assert all(0 < len(chunk) <= 3 for chunk in chunks)
+    assert [item for chunk in chunks for item in chunk] == list(range(10))
+
+
+def test_stream_chunks_raises_generator_errors():
+    def items():
+        yield 1
+        yield 2
+        raise OSError("scan failed")
+
+    received = []
+    with pytest.raises(OSError, match="scan failed"):
+        for chunk in engine.stream_chunks(items(), threading.Event()):
+            received += chunk
+    assert received == [1, 2]
+
+
+def test_stream_chunks_stops_when_cancelled():
+    cancel = threading.Event()
+
+    def items():
+        yield 1
+        cancel.set()
+        yield from range(2, 1000)
+
+    received = [
+        item for chunk in engine.stream_chunks(items(), cancel) for item in chunk
+    ]
+    assert len(received) < 999
+
+
+def test_save_pdf_rotations_only_is_incremental(tmp_path):
+    file_path = make_pdf(tmp_path / "a.pdf", [0, 0, 0])
+    target_path = str(tmp_path / "out" / "a.pdf")
+    result = engine.save_pdf(file_path, target_path, [90, 0, 180], set())
+    assert result["error"] is None
+    assert result["incremental"]
+    assert read_rotations(target_path) == [90, 0, 180]
+    assert read_rotations(file_path) == [0, 0, 0]
+
+
+def test_save_pdf_deleting_pages_rewrites_the_file(tmp_path):
+    file_path = make_pdf(tmp_path / "a.pdf", [0, 0, 0])
+    result = engine.save_pdf(file_path, file_path, [0, 270, 0], {0, 2})
+    assert result["error"] is None
+    assert not result["incremental"]
+    assert read_rotations(file_path) == [270]
+    with fitz.open(file_path) as doc:
+        assert "page 2" in doc[0].get_text()
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_save_pdf_refuses_to_delete_every_page(tmp_path):
+    file_path = make_pdf(tmp_path / "a.pdf", [0, 0])
+    target_path = str(tmp_path / "out" / "a.pdf")
+    result = engine.save_pdf(file_path, target_path, [0, 0], {0, 1})
+    assert "every page is marked as deleted" in result["error"]
+    assert not os.path.exists(target_path)
+    assert read_rotations(file_path) == [0, 0]
+
+
+def test_load_manifest(tmp_path):
+    manifest_path = tmp_path / "edits.json"
+    manifest_path.write_text(
+        json.dumps(
+            {
+                "output_dir": "done",
+                "files": [
+                    {"path": "a.pdf", "rotate": {"1": 90, "3": -90}, "delete": [2]},
+                    {"path": "scans/b.pdf", "rotate_all": 180},
+                ],
+            }
+        )
+    )
+    jobs = engine.load_manifest(str(manifest_path))
+    assert jobs == [
+        (
+            str(tmp_path / "a.pdf"),
+            str(tmp_path / "done" / "a.pdf"),
+            {1: 90, 3: -90},
+            0,
+            [2],
+        ),
+        (
+            str(tmp_path / "scans" / "b.pdf"),
+            str(tmp_path / "done" / "scans" / "b.pdf"),
+            {},
+            180,
+            [],
+        ),
+    ]
+    replaced = engine.load_manifest(str(manifest_path), replace=True)
+    assert [job[1] for job in replaced] == [job[0] for job in jobs]
+
+
+@pytest.mark.parametrize(
+    "manifest",
+    [
+        {"files": [{"path": "a.pdf", "delete": ["two"]}]},
+        {"files": [{"path": "a.pdf", "rotate": {"first": 90}}]},
+        {"files": [{"path": "a.pdf", "rotate_all": "half"}]},
+    ],
+)
+def test_load_manifest_rejects_invalid_numbers(tmp_path, manifest):
+    manifest_path = tmp_path / "edits.json"
+    manifest_path.write_text(json.dumps(manifest))
+    with pytest.raises(ValueError):
+        engine.load_manifest(str(manifest_path))
+
+
+def test_load_manifest_requires_files(tmp_path):
+    manifest_path = tmp_path / "edits.json"
+    manifest_path.write_text(json.dumps({"replace": True}))
+    with pytest.raises(KeyError):
+        engine.load_manifest(str(manifest_path))
+
+
+def test_apply_edits(tmp_path):
+    file_path = make_pdf(tmp_path / "a.pdf", [0, 90, 0])
+    target_path = str(tmp_path / "out" / "a.pdf")
+    result = engine.apply_edits(file_path, target_path, {2: -90}, 180, [3])
+    assert result["error"] is None
+    assert read_rotations(target_path) == [180, 180]
+
+
+@pytest.mark.parametrize(
+    "rotate, rotate_all, delete, error",
+    [
+        ({4: 90}, 0, [], "page 4 is out of range 1-3"),
+        ({}, 0, [0], "page 0 is out of range 1-3"),
+        ({1: 45}, 0, [], "rotation 45 is not a multiple of 90"),
+        ({}, 100, [], "rotation 100 is not a multiple of 90"),
+    ],
+)
+def test_apply_edits_rejects_invalid_edits(tmp_path, rotate, rotate_all, delete, error):
+    file_path = make_pdf(tmp_path / "a.pdf", [0, 0, 0])
+    target_path = str(tmp_path / "out" / "a.pdf")
+    result = engine.apply_edits(file_path, target_path, rotate, rotate_all, delete)
+    assert result["error"] == error
+    assert not os.path.exists(target_path)
+
+
+def test_apply_edits_reports_unreadable_files(tmp_path):
+    file_path = str(tmp_path / "missing.pdf")
+    result = engine.apply_edits(file_path, str(tmp_path / "out.pdf"), {}, 90, [])
+    assert result["file"] == file_path
+    assert result["error"]
+
+
+def make_scan_pdf(path, rotations):
+    # Image-only pages of ragged text lines, the image turned by rotations
+    text = (
+        "It was the best of times, it was the worst of times, it was the age of "
+        "wisdom, it was the age of foolishness, it was the epoch of belief, it was "
+        "the epoch of incredulity, it was the season of Light, it was the season of "
+        "Darkness, it was the spring of hope, it was the winter of despair."
+    ).split()
+    source = fitz.open()
+    page = source.new_page()
+    for line in range(40):
+        start = line * 7 % len(text)
+        words = [text[(start + i) % len(text)] for i in range(4 + line * 5 % 10)]
+        page.insert_text((72, 90 + line * 16), " ".join(words), fontsize=11)
+    pix = page.get_pixmap(dpi=150, colorspace=fitz.csGRAY)
+    doc = fitz.open()
+    for rotation in rotations:
+        width, height = page.rect.width, page.rect.height
+        if rotation % 180:
+            width, height = height, width
+        scan = doc.new_page(width=width, height=height)
+        scan.insert_image(scan.rect, pixmap=pix, rotate=rotation)
+    doc.save(str(path))
+    doc.close()
+    source.close()
+    return str(path)
+
+
+def test_analyze_rotations_proposes_turning_scans_upright(tmp_path):
+    file_path = make_scan_pdf(tmp_path / "scan.pdf", [0, 90, 180, 270])
+    _, first_page, proposals, error = engine.analyze_rotations(file_path, 0, 4)
+    assert error is None
+    assert [rotation for rotation, _ in proposals] == [0, 90, 180, 270]
+    for rotation, confidence in proposals:
+        assert confidence >= engine.ORIENTATION_MIN_CONFIDENCE
+
+    # The proposed changes turn every page like the upright one
+    with fitz.open(file_path) as doc:
+        upright = doc[0].get_pixmap(colorspace=fitz.csGRAY).samples
+        for page, (rotation, _) in zip(doc, proposals):
+            page.set_rotation((page.rotation + rotation) % 360)
+            assert page.get_pixmap(colorspace=fitz.csGRAY).samples == upright
+
+
+def test_document_pool_does_not_wait_for_fitz_lock(tmp_path):
+    file_path = make_pdf(tmp_path / "a.pdf", [0])
+    other_path = make_pdf(tmp_path / "b.pdf", [0])
+    pool = engine.DocumentPool(4)
+    doc = pool.get(file_path)
+    other_doc = pool.get(other_path)
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with engine.fitz_lock:
+            held.set()
+            release.wait(10)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    held.wait(10)
+    # The Tk thread calls these while a long task may hold the lock
+    caller = threading.Thread(
+        target=lambda: (pool.invalidate(file_path), pool.unblock([]), pool.close_all())
+    )
+    caller.start()
+    caller.join(5)
+    finished = not caller.is_alive()
+    release.set()
+    holder.join()
+    assert finished
+
+    # The documents are closed by the next call holding the lock
+    assert not doc.is_closed
+    pool.get(file_path)
+    assert doc.is_closed and other_doc.is_closed
+
+
+def test_document_pool_block_closes_files(tmp_path):
+    file_path = make_pdf(tmp_path / "a.pdf", [0])
+    pool = engine.DocumentPool(4)
+    doc = pool.get(file_path)
+    pool.block([file_path])
+    assert doc.is_closed
+    with pytest.raises(BlockingIOError):
+        pool.get(file_path)
+    pool.unblock([file_path])
+    assert not pool.get(file_path).is_closed
+
+
+def test_iter_jobs_runs_few_jobs_here_without_holding_fitz_lock():
+    acquired = []
+
+    def try_lock():
+        acquired.append(engine.fitz_lock.acquire(timeout=5))
+        if acquired[-1]:
+            engine.fitz_lock.release()
+
+    for result in engine.iter_jobs(abs, [(-1,), (-2,)], min_parallel=3):
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+    assert acquired == [True, True]
+
+
+def make_merge_input(path, name, rotations):
+    # Pages say which file and page they are. The first page links to the
+    # last one and to a web page and has a note.
+    doc = fitz.open()
+    for rotation in rotations:
+        page = doc.new_page()
+        page.insert_text((72, 72), f"{name} {page.number + 1}")
+        page.set_rotation(rotation)
+    first = doc[0]
+    first.insert_link(
+        {
+            "kind": fitz.LINK_GOTO,
+            "from": fitz.Rect(72, 100, 200, 120),
+            "page": len(rotations) - 1,
+        }
+    )
+    first.insert_link(
+        {
+            "kind": fitz.LINK_URI,
+            "from": fitz.Rect(72, 130, 200, 150),
+            "uri": "https://example.com/",
+        }
+    )
+    # Looks like a reference, the merge must not renumber it
+    first.add_text_annot((300, 300), f"note on {name}, see 3 0 R (twice)")
+    doc.save(str(path))
+    doc.close()
+    return str(path)
+
+
+@pytest.fixture
+def merge_inputs(tmp_path, monkeypatch):
+    # Every input becomes a part of its own, so they are concatenated
+    monkeypatch.setattr(engine, "MERGE_MEMORY_BUDGET", 1)
+    broken = tmp_path / "broken.pdf"
+    broken.write_bytes(b"not a pdf")
+    return [
+        make_merge_input(tmp_path / "a.pdf", "a", [0, 90]),
+        str(broken),
+        make_merge_input(tmp_path / "b.pdf", "b", [180]),
+        make_merge_input(tmp_path / "c.pdf", "c", [0, 270, 0]),
+    ]
+
+
+def test_merge_pdfs_joins_parts(tmp_path, merge_inputs):
+    output_path = str(tmp_path / "merged.pdf")
+    progress = []
+    result = engine.merge_pdfs(
+        merge_inputs, output_path, lambda *args: progress.append(args)
+    )
+
+    assert result["error"] is None
+    assert result["pages"] == 6
+    assert [file_path for file_path, _ in result["failures"]] == [merge_inputs[1]]
+    assert [done for done, *_ in progress] == [1, 2, 3, 4]
+    assert sorted(os.listdir(tmp_path)) == [
+        "a.pdf",
+        "b.pdf",
+        "broken.pdf",
+        "c.pdf",
+        "merged.pdf",
+    ]
+    fitz.TOOLS.mupdf_warnings()
+    with fitz.open(output_path) as doc:
+        assert not doc.is_repaired
+        assert [page.get_text().split()[:2] for page in doc] == [
+            ["a", "1"],
+            ["a", "2"],
+            ["b", "1"],
+            ["c", "1"],
+            ["c", "2"],
+            ["c", "3"],
+        ]
+        assert [page.rotation for page in doc] == [0, 90, 180, 0, 270, 0]
+        for first_page, last_page, name in ((0, 1, "a"), (2, 2, "b"), (3, 5, "c")):
+            links = doc[first_page].get_links()
+            assert [link["page"] for link in links if "page" in link] == [last_page]
+            assert [link["uri"] for link in links if "uri" in link] == [
+                "https://example.com/"
+            ]
+            notes = [annot.info["content"] for annot in doc[first_page].annots()]
+            assert notes == [f"note on {name}, see 3 0 R (twice)"]
+    assert not fitz.TOOLS.mupdf_warnings()
+
+
+def test_concatenate_parts_is_a_valid_file(tmp_path, merge_inputs):
+    output_path = str(tmp_path / "joined.pdf")
+    part_paths = merge_inputs[:1] + merge_inputs[2:]
+    assert engine.concatenate_parts(part_paths, output_path) == 6
+    fitz.TOOLS.mupdf_warnings()
+    with fitz.open(output_path) as doc:
+        assert not doc.is_repaired
+        assert doc.page_count == 6
+        for xref in range(1, doc.xref_length()):
+            doc.xref_object(xref)
+    assert not fitz.TOOLS.mupdf_warnings()
+
+
+def test_merge_pdfs_cancelled_leaves_nothing_behind(tmp_path, merge_inputs):
+    output_path = str(tmp_path / "merged.pdf")
+    cancel = threading.Event()
+
+    # Cancelled after the first part was written
+    def progress(done, total, file_path, error):
+        cancel.set()
+
+    result = engine.merge_pdfs(merge_inputs, output_path, progress, cancel)
+    assert result["cancelled"]
+    assert sorted(os.listdir(tmp_path)) == ["a.pdf", "b.pdf", "broken.pdf", "c.pdf"]
+
+
+def test_merge_pdfs_without_readable_files(tmp_path, merge_inputs):
+    output_path = str(tmp_path / "merged.pdf")
+    result = engine.merge_pdfs(merge_inputs[1:2], output_path)
+    assert result["error"] == "none of the files could be merged"
+    assert not os.path.exists(output_path)
+
+
+def test_render_thumbnail_writes_the_cache(tmp_path, cache_dir):
+    file_path = make_pdf(tmp_path / "a.pdf", [0, 90])
+    cache_path = engine.thumbnail_path(file_path, [1, 2], 1, 90)
+    assert cache_path.startswith(str(cache_dir))
+    assert engine.render_thumbnail(file_path, 1, 90, cache_path) == (cache_path, None)
+    with Image.open(cache_path) as img:
+        assert max(img.size) == engine.THUMBNAIL_SIZE
+    # Another version of the file gets other thumbnails
+    assert engine.thumbnail_path(file_path, [1, 3], 1, 90) != cache_path
+
+
+def test_prune_thumbnails_removes_least_recently_shown_files(cache_dir):
+    folders = []
+    for age in (3, 1, 2):
+        folder = cache_dir / "thumbnails" / f"shown-{age}-days-ago"
+        folder.mkdir(parents=True)
+        (folder / "0-0.jpg").write_bytes(b"x" * 1000)
+        shown = time.time() - age * 24 * 3600
+        os.utime(folder, (shown, shown))
+        folders.append(folder)
+
+    assert engine.prune_thumbnails(budget=2500) == 1
+    assert [folder.exists() for folder in folders] == [False, True, True]
+    assert engine.prune_thumbnails(budget=1000) == 1
+    assert [folder.exists() for folder in folders] == [False, True, False]
+    assert engine.prune_thumbnails(budget=1000) == 0
+
+
+def test_prune_thumbnails_without_cache(cache_dir):
+    assert engine.prune_thumbnails(budget=0) == 0
+
+
+def test_blank_score():
+    assert engine.blank_score(0, 0) == 1
+    assert engine.blank_score(engine.BLANK_INK_COVERAGE_LIMIT / 2, 0) == 0.5
+    assert engine.blank_score(0, engine.BLANK_DEVIATION_LIMIT / 4) == 0.75
+    assert engine.blank_score(engine.BLANK_INK_COVERAGE_LIMIT, 0) == 0
+    assert engine.blank_score(0.5, engine.BLANK_DEVIATION_LIMIT * 3) == 0
+
+
+def test_analyze_blank_pages(tmp_path):
+    doc = fitz.open()
+    doc.new_page()
+    tinted = doc.new_page()
+    tinted.draw_rect(tinted.rect, color=None, fill=(0.9, 0.9, 0.8))
+    # Punch holes and scan edges lie in the margin that is left out
+    punched = doc.new_page()
+    punched.draw_circle((12, 400), 6, color=None, fill=(0, 0, 0))
+    punched.draw_rect(fitz.Rect(0, 0, punched.rect.width, 8), color=None, fill=0)
+    written = doc.new_page()
+    written.insert_text((72, 300), "A single short line of text")
+    file_path = str(tmp_path / "a.pdf")
+    doc.save(file_path)
+    doc.close()
+
+    _, first_page, scores, error = engine.analyze_blank_pages(file_path, 1, 4)
+    assert error is None and first_page == 1
+    _, _, [empty_score], _ = engine.analyze_blank_pages(file_path, 0, 1)
+    assert empty_score == 1
+    assert [score >= engine.BLANK_SCORE_THRESHOLD for score in scores] == [
+        True,
+        True,
+        False,
+    ]
+
+
+def test_analyze_rotations_reads_the_text_layer(tmp_path):
+    doc = fitz.open()
+    for rotation in (0, 90, 180, 270):
+        page = doc.new_page()
+        page.insert_textbox(
+            fitz.Rect(72, 72, 520, 770),
+            "Text that reads along its lines. " * 20,
+            rotate=rotation,
+        )
+    # Too little text and ink to tell
+    doc.new_page()
+    short_page = doc.new_page()
+    short_page.insert_text((72, 72), "page 6")
+    file_path = str(tmp_path / "a.pdf")
+    doc.save(file_path)
+    doc.close()
+
+    _, _, proposals, error = engine.analyze_rotations(file_path, 0, 6)
+    assert error is None
+    assert proposals == [(0, 1.0), (90, 1.0), (180, 1.0), (270, 1.0), (0, 0), (0, 0)]
+
+
+@pytest.fixture
+def folder_tree(tmp_path):
+    for relative_path in (
+        "a.pdf",
+        "B.PDF",
+        "notes.txt",
+        "sub/c.pdf",
+        "sub/deep/d.pdf",
+        "2023/03/invoice-1.pdf",
+        f"{engine.OUTPUT_FOLDER_NAME}/a.pdf",
+    ):
+        path = tmp_path / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"%PDF-1.7\n")
+    return tmp_path
+
+
+def relative_paths(folder_path, file_paths):
+    return [
+        os.path.relpath(file_path, folder_path).replace(os.sep, "/")
+        for file_path in file_paths
+    ]
+
+
+def test_folder_scan_walks_subfolders_in_name_order(folder_tree):
+    scan = engine.FolderScan(str(folder_tree))
+    assert relative_paths(folder_tree, scan.iter_files()) == ["B.PDF", "a.pdf"]
+    scan = engine.FolderScan(str(folder_tree), recursive=True)
+    assert relative_paths(folder_tree, scan.iter_files()) == [
+        "B.PDF",
+        "a.pdf",
+        "2023/03/invoice-1.pdf",
+        "sub/c.pdf",
+        "sub/deep/d.pdf",
+    ]
+
+
+@pytest.mark.parametrize(
+    "pattern, expected",
+    [
+        ("*invoice*", ["2023/03/invoice-1.pdf"]),
+        ("sub/*/*.pdf", ["sub/deep/d.pdf"]),
+        ("*/c.pdf", ["sub/c.pdf"]),
+    ],
+)
+def test_folder_scan_pattern(folder_tree, pattern, expected):
+    scan = engine.FolderScan(str(folder_tree), recursive=True, pattern=pattern)
+    assert relative_paths(folder_tree, scan.iter_files()) == expected
+
+
+def test_folder_scan_modification_times(folder_tree):
+    for relative_path, day in (("a.pdf", 1), ("B.PDF", 2), ("sub/c.pdf", 3)):
+        os.utime(folder_tree / relative_path, (day * 86400, day * 86400))
+    scan = engine.FolderScan(
+        str(folder_tree),
+        recursive=True,
+        modified_after=2 * 86400,
+        modified_before=4 * 86400,
+    )
+    assert relative_paths(folder_tree, scan.iter_files()) == ["B.PDF", "sub/c.pdf"]
+
+
+def test_folder_scan_lists_only_changed_folders(folder_tree, monkeypatch):
+    scan = engine.FolderScan(str(folder_tree), recursive=True)
+    known_files = set(scan.iter_files())
+    (folder_tree / "sub" / "e.pdf").write_bytes(b"%PDF-1.7\n")
+    # Also where folder times are too coarse to change within the test
+    modified = os.stat(folder_tree / "sub").st_mtime_ns + 1000
+    os.utime(folder_tree / "sub", ns=(modified, modified))
+
+    listed = []
+    scandir = os.scandir
+
+    def listing_scandir(path):
+        listed.append(os.path.relpath(path, folder_tree))
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", listing_scandir)
+    new_files = list(scan.iter_new_files(known_files))
+    assert relative_paths(folder_tree, new_files) == ["sub/e.pdf"]
+    assert listed == ["sub"]
+
+
+def drain(results):
+    items = []
+    while (item := results.get(timeout=10)) is not None:
+        items.append(item)
+    return items
+
+
+def test_refresh_files_reports_changed_removed_and_new_files(tmp_path, cache_dir):
+    folder = tmp_path / "folder"
+    folder.mkdir()
+    unchanged = make_pdf(folder / "a.pdf", [0])
+    changed = make_pdf(folder / "b.pdf", [0, 0])
+    removed = make_pdf(folder / "c.pdf", [0])
+    scan = engine.FolderScan(str(folder))
+    file_keys = {
+        file_path: engine.index_key(file_path) for file_path in scan.iter_files()
+    }
+    folder_index = engine.FolderIndex(str(folder))
+    for file_path in file_keys:
+        folder_index.store(file_path, file_keys[file_path], read_rotations(file_path))
+
+    make_pdf(changed, [90, 0, 180])
+    os.remove(removed)
+    added = make_pdf(folder / "d.pdf", [270])
+    results = queue.Queue()
+    engine.refresh_files(
+        file_keys,
+        scan,
+        engine.DocumentPool(4),
+        folder_index,
+        results,
+        threading.Event(),
+    )
+
+    items = drain(results)
+    assert [item[:2] for item in items] == [
+        (removed, None),
+        (changed, [90, 0, 180]),
+        (added, [270]),
+    ]
+    assert items[1][2] == engine.index_key(changed)
+    assert folder_index.lookup(changed, items[1][2]) == [90, 0, 180]
+    assert "c.pdf" not in folder_index.files
+    assert folder_index.lookup(unchanged, file_keys[unchanged]) == [0]
+
+
+def test_refresh_files_stops_when_cancelled(tmp_path, cache_dir):
+    file_path = make_pdf(tmp_path / "a.pdf", [0])
+    os.remove(file_path)
+    cancel = threading.Event()
+    cancel.set()
+    results = queue.Queue()
+    folder_index = engine.FolderIndex(str(tmp_path))
+    engine.refresh_files(
+        {file_path: [1]}, None, engine.DocumentPool(4), folder_index, results, cancel
+    )
+    assert drain(results) == []
+
+
+def image_bytes(width, height):
+    # A smooth gradient with some noise, like a photo
+    y, x = numpy.mgrid[0:height, 0:width]
+    noise = numpy.random.default_rng(0).integers(0, 24, (height, width))
+    pixels = numpy.stack(
+        [x * 200 // width + noise, y * 200 // height + noise, (x + y) % 256], axis=2
+    )
+    stream = io.BytesIO()
+    Image.fromarray(pixels.astype(numpy.uint8)).save(stream, "PNG", compress_level=1)
+    return stream.getvalue()
+
+
+def test_save_pdf_optimizes_images(tmp_path):
+    doc = fitz.open()
+    page = doc.new_page()
+    # 1100 pixels over about 5.6 inches is about 200 dpi
+    page.insert_image(fitz.Rect(0, 0, 400, 470), stream=image_bytes(1100, 1290))
+    page.insert_image(fitz.Rect(20, 720, 84, 784), stream=image_bytes(64, 64))
+    file_path = str(tmp_path / "a.pdf")
+    doc.save(file_path)
+    doc.close()
+    target_path = str(tmp_path / "out" / "a.pdf")
+
+    result = engine.save_pdf(file_path, target_path, [0], set(), {"image_dpi": 150})
+
+    assert result["error"] is None
+    assert result["images"] == 1
+    assert result["bytes_after"] < result["bytes_before"] / 2
+    with fitz.open(file_path) as original, fitz.open(target_path) as optimized:
+        widths = sorted(image[2] for image in optimized[0].get_images())
+        assert widths[0] == 64
+        assert 800 <= widths[1] <= 870
+        before = numpy.frombuffer(original[0].get_pixmap().samples, numpy.uint8)
+        after = numpy.frombuffer(optimized[0].get_pixmap().samples, numpy.uint8)
+        assert numpy.abs(before.astype(int) - after).mean() < 8
+
+
+@pytest.mark.parametrize("rotation", [0, 90])
+def test_render_tile_pieces_make_the_page(tmp_path, rotation):
+    file_path = make_pdf(tmp_path / "a.pdf", [0])
+    width, height = engine.TILE_SIZE * 2 + 37, engine.TILE_SIZE + 50
+    pool = engine.DocumentPool(4)
+    key = (file_path, 0, rotation)
+
+    tiled = Image.new("RGB", (width, height))
+    for column in range(3):
+        for row in range(2):
+            tile = engine.render_tile(pool, key, width, height, column, row)
+            assert tile.size == (
+                min(engine.TILE_SIZE, width - column * engine.TILE_SIZE),
+                min(engine.TILE_SIZE, height - row * engine.TILE_SIZE),
+            )
+            tiled.paste(tile, (column * engine.TILE_SIZE, row * engine.TILE_SIZE))
+
+    # Stretched to width x height, the whole page is the same picture
+    with fitz.open(file_path) as doc:
+        page = doc[0]
+        matrix = engine.stretch_matrix(page.rect, rotation, width, height)
+        whole = page.get_pixmap(matrix=matrix, alpha=False)
+    assert (whole.width, whole.height) == (width, height)
+    difference = numpy.abs(
+        numpy.asarray(tiled, int)
+        - numpy.asarray(Image.frombytes("RGB", (width, height), whole.samples), int)
+    )
+    assert difference.mean() < 1
+    assert numpy.asarray(tiled).min() < 128